@@ -78,7 +78,7 @@ ag = ig
                       
 # Create noisy data. Apply Gaussian noise
 np.random.seed(10)
-noisy_data = ImageData( data.as_array() + np.random.normal(0, 0.25, size=ig.shape) )
+noisy_data = ImageData( data.as_array() + np.random.normal(0, 0.25, size=ig.shape).astype(np.float32) )
 
 # time-frames index
 tindex = [8, 16, 24]
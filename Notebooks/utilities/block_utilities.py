@@ -0,0 +1,165 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Fused normal equations of column BlockOperators.
+
+Regularised least squares is usually written with a stacked operator
+
+             K = BlockOperator(A, alpha * Gradient),   b = (g, 0)
+
+which needs a zero filled gradient sized block for the data and creates
+BlockDataContainer temporaries every iteration. NormalOperator evaluates
+instead
+
+             K^T K x = \sum_i w_i K_i^T K_i x     (= A^T A x + alpha^2 \nabla^T \nabla x)
+
+into preallocated buffers, and normal_rhs computes K^T b skipping the zero
+blocks, given as None. RegularisedCGLS (reconstruction_utilities) runs
+conjugate gradients on K^T K x = K^T b with these, so the stacked residual
+is never formed.
+"""
+
+from __future__ import print_function, division
+
+from ccpi.optimisation.operators import LinearOperator
+
+
+def _unscale(operator):
+    '''(operator, scalar) with the (signed) scalars of nested ScaledOperators multiplied out'''
+    if hasattr(operator, 'scalar') and hasattr(operator, 'operator'):
+        inner, scalar = _unscale(operator.operator)
+        return inner, scalar * operator.scalar
+    return operator, 1.
+
+
+def split_block_operator(operator):
+    '''Components and scalars of a column BlockOperator, a list of operators or a single operator
+
+    A component s * B (ScaledOperator) is returned as B with scalar s.
+    '''
+    if hasattr(operator, 'get_item'):
+        rows, cols = operator.shape
+        if cols != 1:
+            raise ValueError('Expected a column BlockOperator, got shape {}'.format(operator.shape))
+        operators = [operator.get_item(i, 0) for i in range(rows)]
+    elif isinstance(operator, (list, tuple)):
+        operators = list(operator)
+    else:
+        operators = [operator]
+    pairs = [_unscale(op) for op in operators]
+    return [p[0] for p in pairs], [p[1] for p in pairs]
+
+
+def split_block_data(data, num_blocks):
+    '''List of the blocks of data, with None for implicit zero blocks
+
+    data may be a BlockDataContainer, a list with None entries or, for the
+    common regularised case, just the DataContainer of the first block.
+    '''
+    if hasattr(data, 'containers'):
+        blocks = list(data.containers)
+        # an explicit zero block costs a norm once here and nothing afterwards
+        blocks = [None if b is not None and b.norm() == 0 else b for b in blocks]
+    elif isinstance(data, (list, tuple)):
+        blocks = list(data)
+    else:
+        blocks = [data]
+    if len(blocks) > num_blocks:
+        raise ValueError('Got {} data blocks for {} operators'.format(len(blocks), num_blocks))
+    return blocks + [None] * (num_blocks - len(blocks))
+
+
+class NormalOperator(LinearOperator):
+
+    '''x -> \\sum_i w_i K_i^T K_i x, self-adjoint and positive semi-definite
+
+    A component K_i = s_i B_i (ScaledOperator) is applied as s_i^2 B_i^T B_i,
+    while the data terms use s_i: K_i^T b_i = s_i B_i^T b_i.
+
+    :param operators: list of LinearOperator K_i with the same domain, a column BlockOperator
+                      or a single operator
+    :param weights: optional list of w_i, 1 by default
+    '''
+
+    def __init__(self, operators, weights=None):
+        super(NormalOperator, self).__init__()
+        self.operators, self.scalars = split_block_operator(operators)
+        self.weights = [1.] * len(self.operators) if weights is None else list(weights)
+        self.ig = self.operators[0].domain_geometry()
+        self._range = [op.range_geometry().allocate() for op in self.operators]
+        self._domain = self.ig.allocate()
+
+    @classmethod
+    def regularised(cls, operator, alpha, regulariser=None):
+        '''A^T A + alpha^2 L^T L, L the Gradient of the domain by default'''
+        if regulariser is None:
+            from ccpi.optimisation.operators import Gradient
+            regulariser = Gradient(operator.domain_geometry())
+        return cls([operator, regulariser], [1., alpha ** 2])
+
+    def direct(self, x, out=None):
+        if out is None:
+            out = self.ig.allocate()
+        out.fill(0)
+        for op, w, s, y in zip(self.operators, self.weights, self.scalars, self._range):
+            op.direct(x, out=y)
+            op.adjoint(y, out=self._domain)
+            if w * s * s != 1:
+                self._domain *= w * s * s
+            out += self._domain
+        return out
+
+    def adjoint(self, x, out=None):
+        return self.direct(x, out=out)
+
+    def residual_norms(self, x, data):
+        '''[w_i ||K_i x - b_i||^2], the terms of the least squares objective'''
+        res = []
+        for op, w, s, y, b in zip(self.operators, self.weights, self.scalars, self._range, data):
+            op.direct(x, out=y)
+            if s != 1:
+                y *= s
+            if b is not None:
+                y -= b
+            res.append(w * y.squared_norm())
+        return res
+
+    def domain_geometry(self):
+        return self.ig
+
+    def range_geometry(self):
+        return self.ig
+
+
+def normal_rhs(normal, data, out=None):
+    '''\\sum_i w_i K_i^T b_i of a NormalOperator, skipping the None (zero) blocks'''
+    if out is None:
+        out = normal.domain_geometry().allocate()
+    out.fill(0)
+    for op, w, s, b in zip(normal.operators, normal.weights, normal.scalars, data):
+        if b is None:
+            continue
+        op.adjoint(b, out=normal._domain)
+        if w * s != 1:
+            normal._domain *= w * s
+        out += normal._domain
+    return out
@@ -0,0 +1,345 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Checkpoint and resume of iterative algorithms (CGLS, FISTA, PDHG and the
+algorithms of reconstruction_utilities).
+
+The state of an algorithm is every attribute that is
+
+    a DataContainer, BlockDataContainer, numpy array or list of them   (iterates,
+                                                                          duals, residuals)
+    a number, bool, None or list of numbers                             (step sizes, momentum,
+                                                                          iteration, objective history)
+    a numpy RandomState                                                 (SPDHG sampling)
+
+except the problem definition (data, operators, functions), which is rebuilt
+by the caller. Arrays keep their dtype, numpy scalars are stored as 0-d
+arrays, so a resumed run continues bit-identically.
+
+Checkpoints are written on a background thread, from a copy of the state taken
+between iterations, to an HDF5 file ('h5') or a directory of .npy files that
+can be memory-mapped ('npy'). The previous checkpoint is replaced only once
+the new one is complete.
+
+    algo = PDHG(f=f, g=g, operator=operator, tau=tau, sigma=sigma)
+    checkpointed_run(algo, 1000, 'pdhg_tv.h5', every=100)    # resumes if the file exists
+"""
+
+from __future__ import print_function, division
+import json
+import os
+import shutil
+import threading
+import numpy
+
+# containers holding the problem, not the state; operators and functions are never saved
+EXCLUDE = ('data', 'b')
+
+_NUMBERS = (bool, int, float)
+
+
+def _is_container(v):
+    return hasattr(v, 'as_array') and hasattr(v, 'fill')
+
+
+def _is_block(v):
+    return hasattr(v, 'containers')
+
+
+def _is_number_list(v):
+    return isinstance(v, list) and all(isinstance(e, _NUMBERS + (numpy.generic, list, tuple)) or e is None
+                                       for e in v)
+
+
+def _jsonable(v):
+    if isinstance(v, (list, tuple)):
+        return [_jsonable(e) for e in v]
+    if isinstance(v, numpy.generic):
+        return v.item()
+    return v
+
+
+def _collect(name, value, arrays, scalars):
+    '''Adds the state in value to arrays/scalars, returns False if value is not state'''
+    if _is_block(value):
+        for i, c in enumerate(value.containers):
+            _collect('{}.{}'.format(name, i), c, arrays, scalars)
+    elif _is_container(value):
+        arrays[name] = numpy.array(value.as_array(), copy=True)
+    elif isinstance(value, numpy.ndarray):
+        arrays[name] = value.copy()
+    elif isinstance(value, numpy.generic):
+        arrays[name] = numpy.array(value)
+    elif isinstance(value, numpy.random.RandomState):
+        algo, keys, pos, has_gauss, gauss = value.get_state()
+        arrays[name + '.keys'] = keys.copy()
+        scalars[name] = {'RandomState': [algo, int(pos), int(has_gauss), float(gauss)]}
+    elif value is None or isinstance(value, _NUMBERS):
+        scalars[name] = value
+    elif isinstance(value, list) and value and all(_is_container(e) or _is_block(e) for e in value):
+        scalars[name] = {'list': len(value)}
+        for i, c in enumerate(value):
+            _collect('{}.{}'.format(name, i), c, arrays, scalars)
+    elif _is_number_list(value):
+        scalars[name] = {'values': _jsonable(value)}
+    else:
+        return False
+    return True
+
+
+def get_state(algorithm, exclude=EXCLUDE):
+    '''(arrays, scalars): copies of the state of algorithm'''
+    arrays, scalars = {}, {}
+    for name, value in vars(algorithm).items():
+        if name in exclude:
+            continue
+        _collect(name, value, arrays, scalars)
+    return arrays, scalars
+
+
+def _restore(obj, name, value, arrays, scalars):
+    '''Restores value (the current attribute) from the state, returns the restored value'''
+    if _is_block(value):
+        for i, c in enumerate(value.containers):
+            _restore(obj, '{}.{}'.format(name, i), c, arrays, scalars)
+        return value
+    if _is_container(value):
+        value.fill(numpy.asarray(arrays[name]).reshape(value.shape))
+        return value
+    if isinstance(value, numpy.ndarray):
+        value[...] = arrays[name]
+        return value
+    if isinstance(value, numpy.random.RandomState):
+        algo, pos, has_gauss, gauss = scalars[name]['RandomState']
+        value.set_state((algo, numpy.asarray(arrays[name + '.keys']), pos, has_gauss, gauss))
+        return value
+    if name in arrays:
+        # numpy scalar, possibly a python number before the first iteration
+        return numpy.asarray(arrays[name])[()]
+    state = scalars.get(name, None)
+    if isinstance(state, dict) and 'list' in state:
+        for i, c in enumerate(value):
+            _restore(obj, '{}.{}'.format(name, i), c, arrays, scalars)
+        return value
+    if isinstance(state, dict) and 'values' in state:
+        return list(state['values'])
+    return state
+
+
+def set_state(algorithm, arrays, scalars, exclude=EXCLUDE):
+    '''Restores a state from get_state into an algorithm set up on the same problem'''
+    for name, value in list(vars(algorithm).items()):
+        if name in exclude:
+            continue
+        if name not in scalars and not any(k == name or k.startswith(name + '.') for k in arrays):
+            continue
+        setattr(algorithm, name, _restore(algorithm, name, value, arrays, scalars))
+
+
+# storage
+
+def _write_h5(path, arrays, scalars):
+    import h5py
+    tmp = path + '.tmp'
+    with h5py.File(tmp, 'w') as f:
+        for name, arr in arrays.items():
+            f.create_dataset(name.replace('/', '|'), data=arr)
+        f.attrs['state'] = json.dumps(scalars)
+    os.replace(tmp, path)
+
+
+def _read_h5(path):
+    import h5py
+    with h5py.File(path, 'r') as f:
+        arrays = {k.replace('|', '/'): f[k][()] for k in f.keys()}
+        scalars = json.loads(f.attrs['state'])
+    return arrays, scalars
+
+
+def _write_npy(path, arrays, scalars):
+    tmp = path + '.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    names = {}
+    for i, (name, arr) in enumerate(arrays.items()):
+        fname = 'array_{}.npy'.format(i)
+        numpy.save(os.path.join(tmp, fname), arr)
+        names[name] = fname
+    with open(os.path.join(tmp, 'state.json'), 'w') as f:
+        json.dump({'arrays': names, 'scalars': scalars}, f)
+    # swap the directories, a complete checkpoint always exists
+    old = path + '.old'
+    if os.path.isdir(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+
+
+def _read_npy(path, mmap_mode='r'):
+    with open(os.path.join(path, 'state.json')) as f:
+        meta = json.load(f)
+    arrays = {name: numpy.load(os.path.join(path, fname), mmap_mode=mmap_mode)
+              for name, fname in meta['arrays'].items()}
+    return arrays, meta['scalars']
+
+
+def _format(path, fmt):
+    if fmt is not None:
+        return fmt
+    return 'h5' if os.path.splitext(path)[1] in ('.h5', '.hdf5', '.nxs') else 'npy'
+
+
+def save_checkpoint(algorithm, path, fmt=None, exclude=EXCLUDE):
+    '''Writes the state of algorithm to path synchronously'''
+    arrays, scalars = get_state(algorithm, exclude)
+    (_write_h5 if _format(path, fmt) == 'h5' else _write_npy)(path, arrays, scalars)
+
+
+def load_checkpoint(algorithm, path, fmt=None, exclude=EXCLUDE):
+    '''Restores the state saved in path into algorithm, which must be set up on the same problem'''
+    if _format(path, fmt) == 'h5':
+        arrays, scalars = _read_h5(path)
+    else:
+        arrays, scalars = _read_npy(path)
+    set_state(algorithm, arrays, scalars, exclude)
+    return algorithm
+
+
+def checkpoint_exists(path, fmt=None):
+    if _format(path, fmt) == 'h5':
+        return os.path.isfile(path)
+    return os.path.isfile(os.path.join(path, 'state.json'))
+
+
+class Checkpointer(object):
+
+    '''Asynchronous checkpoints of an algorithm
+
+    save() copies the state on the calling thread and writes it on a
+    background thread; a new save waits for the previous write, so at most one
+    copy of the state is in flight. Also usable as the callback of
+    Algorithm.run, saving every `every` iterations.
+
+    :param algorithm: the algorithm to checkpoint
+    :param path: .h5 file or directory of .npy files
+    :param every: iterations between checkpoints when used as a callback
+    :param fmt: 'h5' or 'npy', from the extension of path by default
+    '''
+
+    def __init__(self, algorithm, path, every=100, fmt=None, exclude=EXCLUDE):
+        self.algorithm = algorithm
+        self.path = path
+        self.every = every
+        self.fmt = _format(path, fmt)
+        self.exclude = exclude
+        self._thread = None
+        self.error = None
+
+    def save(self):
+        self.wait()
+        arrays, scalars = get_state(self.algorithm, self.exclude)
+        writer = _write_h5 if self.fmt == 'h5' else _write_npy
+
+        def work():
+            try:
+                writer(self.path, arrays, scalars)
+            except Exception as e:
+                self.error = e
+        self._thread = threading.Thread(target=work, name='Checkpointer')
+        self._thread.start()
+
+    def wait(self):
+        '''Waits for the pending write, raises its error if it failed'''
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def __call__(self, iteration, objective, x):
+        if iteration % self.every == 0:
+            self.save()
+
+    def resume(self):
+        '''Loads the checkpoint into the algorithm if there is one, returns True if so'''
+        self.wait()
+        if not checkpoint_exists(self.path, self.fmt):
+            return False
+        load_checkpoint(self.algorithm, self.path, self.fmt, self.exclude)
+        return True
+
+
+def checkpointed_run(algorithm, iterations, path, every=100, verbose=False, resume=True, fmt=None):
+    '''Runs algorithm up to iteration `iterations`, saving a checkpoint every `every` iterations
+
+    If resume and a checkpoint exists at path, the run continues from it.
+    '''
+    checkpointer = Checkpointer(algorithm, path, every, fmt)
+    if resume and checkpointer.resume() and verbose:
+        print('Resumed from {} at iteration {}'.format(path, algorithm.iteration))
+    algorithm.max_iteration = max(algorithm.max_iteration, iterations)
+    while algorithm.iteration < iterations:
+        start = algorithm.iteration
+        algorithm.run(min(every - start % every, iterations - start), verbose=verbose)
+        if algorithm.iteration == start:
+            # stopping criterion met
+            break
+        checkpointer.save()
+    checkpointer.wait()
+    return algorithm
+
+
+if __name__ == '__main__':
+
+    from ccpi.framework import ImageGeometry, AcquisitionGeometry
+    from ccpi.astra.operators import AstraProjectorSimple
+    from ccpi.optimisation.algorithms import PDHG
+    from ccpi.optimisation.operators import BlockOperator, Gradient
+    from ccpi.optimisation.functions import L2NormSquared, MixedL21Norm, BlockFunction, ZeroFunction
+
+    N = 128
+    ig = ImageGeometry(voxel_num_x = N, voxel_num_y = N)
+    angles = numpy.linspace(0, numpy.pi, 180, dtype=numpy.float32)
+    ag = AcquisitionGeometry('parallel','2D', angles, N)
+    Aop = AstraProjectorSimple(ig, ag, 'cpu')
+    data = Aop.direct(ig.allocate('random'))
+
+    def make_pdhg():
+        operator = BlockOperator(Gradient(ig), Aop, shape=(2,1))
+        f = BlockFunction(0.1 * MixedL21Norm(), 0.5 * L2NormSquared(b=data))
+        normK = operator.norm()
+        pdhg = PDHG(f=f, g=ZeroFunction(), operator=operator, tau=1/normK, sigma=1/normK)
+        pdhg.update_objective_interval = 10
+        return pdhg
+
+    straight = make_pdhg()
+    straight.max_iteration = 200
+    straight.run(200, verbose=False)
+
+    # interrupted after 100 iterations, then resumed in a new algorithm
+    checkpointed_run(make_pdhg(), 100, 'pdhg_checkpoint.h5', every=50)
+    resumed = checkpointed_run(make_pdhg(), 200, 'pdhg_checkpoint.h5', every=50)
+    print('Bit-identical resume:', numpy.array_equal(straight.get_output().as_array(),
+                                                     resumed.get_output().as_array()))
@@ -0,0 +1,339 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Fast numpy denoising paths for multi-channel images.
+
+Vectorial Total Variation denoising using PDHG:
+
+Problem:     min_u  \alpha * ||\nabla u||_{2,1} + Fidelity(u, g)
+
+             ||\nabla u||_{2,1} = \sum_{pixels} \sqrt{ \sum_{c} \sum_{d} (\nabla_{d} u_{c})^{2} }
+
+             i.e. the MixedL21Norm is coupled across the channels (colour TV).
+
+             Fidelity =  1) 0.5 * || u - g ||_{2}^{2}  ('gaussian')
+                         2) || u - g ||_{1}            ('s&p')
+                         3) \int u - g * log(u)        ('poisson')
+
+The image is kept channel-last and contiguous, so the gradient, divergence
+and the coupled projection act on all channels at once.
+
+stream_tv_denoising applies the same solver to a sliding temporal window of a
+2D + time sequence ('SpaceChannels' correlation), emitting finished frames as
+the window advances.
+"""
+
+from __future__ import print_function, division
+import numpy
+
+if __package__:
+    from .precision_utilities import _as_array
+else:
+    # loaded as a top-level module, e.g. python denoising_utilities.py
+    from precision_utilities import _as_array
+
+
+def to_channel_last(data, channel_axis=0):
+    '''Returns a contiguous channel-last float32 copy of a DataContainer or numpy array'''
+    arr = _as_array(data)
+    return numpy.ascontiguousarray(numpy.moveaxis(arr, channel_axis, -1), dtype=numpy.float32)
+
+
+def from_channel_last(arr, like=None, channel_axis=0):
+    '''Moves the channel axis back and, if like is a DataContainer, returns a container with its geometry'''
+    out = numpy.ascontiguousarray(numpy.moveaxis(arr, -1, channel_axis))
+    if like is not None and hasattr(like, 'geometry'):
+        res = like.geometry.allocate()
+        res.fill(out)
+        return res
+    return out
+
+
+def gradient_channel_last(u, out=None):
+    '''Forward differences with Neumann boundary over the spatial axes of a channel-last array
+
+    :param u: numpy array of shape spatial_shape + (channels,)
+    :param out: optional array of shape (ndim_spatial,) + u.shape
+    '''
+    ndim = u.ndim - 1
+    if out is None:
+        out = numpy.empty((ndim,) + u.shape, dtype=u.dtype)
+    for d in range(ndim):
+        hi = [slice(None)] * u.ndim
+        lo = [slice(None)] * u.ndim
+        last = [slice(None)] * u.ndim
+        hi[d] = slice(1, None)
+        lo[d] = slice(None, -1)
+        last[d] = -1
+        numpy.subtract(u[tuple(hi)], u[tuple(lo)], out=out[d][tuple(lo)])
+        out[d][tuple(last)] = 0
+    return out
+
+
+def divergence_channel_last(p, out=None):
+    '''Negative adjoint of gradient_channel_last, i.e. out = -\nabla^{T} p'''
+    ndim = p.shape[0]
+    if out is None:
+        out = numpy.empty(p.shape[1:], dtype=p.dtype)
+    out.fill(0)
+    for d in range(ndim):
+        if p.shape[d + 1] == 1:
+            # the gradient along an axis of length 1 is 0
+            continue
+        sl = [slice(None)] * (p.ndim - 1)
+        first, inner, prev, last = list(sl), list(sl), list(sl), list(sl)
+        first[d] = 0
+        inner[d] = slice(1, -1)
+        prev[d] = slice(None, -2)
+        last[d] = -1
+        pd = p[d]
+        out[tuple(first)] += pd[tuple(first)]
+        out[tuple(inner)] += pd[tuple(inner)]
+        out[tuple(inner)] -= pd[tuple(prev)]
+        sl_m2 = list(sl)
+        sl_m2[d] = -2
+        out[tuple(last)] -= pd[tuple(sl_m2)]
+    return out
+
+
+def coupled_l21_norm(p):
+    '''MixedL21Norm coupled over gradient components and channels (axis 0 and last axis)'''
+    return numpy.sqrt(numpy.einsum('d...c,d...c->...', p, p, dtype=numpy.float64)).sum()
+
+
+def _project_coupled(p, alpha, tmp):
+    # proximal of the convex conjugate of alpha * ||.||_{2,1}: p / max(1, |p|/alpha)
+    numpy.einsum('d...c,d...c->...', p, p, out=tmp)
+    numpy.sqrt(tmp, out=tmp)
+    tmp /= alpha
+    numpy.maximum(tmp, 1, out=tmp)
+    p /= tmp[None, ..., None]
+
+
+def _fidelity_prox(v, b, tau, fidelity, out):
+    if fidelity == 'gaussian':
+        numpy.multiply(b, tau, out=out)
+        out += v
+        out /= (1 + tau)
+    elif fidelity == 's&p':
+        numpy.subtract(v, b, out=out)
+        numpy.sign(out, out=v)
+        numpy.abs(out, out=out)
+        out -= tau
+        numpy.maximum(out, 0, out=out)
+        out *= v
+        out += b
+    elif fidelity == 'poisson':
+        v -= tau
+        numpy.multiply(v, v, out=out)
+        out += (4 * tau) * b
+        numpy.sqrt(out, out=out)
+        out += v
+        out *= 0.5
+    else:
+        raise ValueError('Unsupported fidelity ', fidelity)
+    return out
+
+
+def _fidelity_value(u, b, fidelity):
+    if fidelity == 'gaussian':
+        return 0.5 * numpy.sum((u - b) ** 2, dtype=numpy.float64)
+    elif fidelity == 's&p':
+        return numpy.sum(numpy.abs(u - b), dtype=numpy.float64)
+    elif fidelity == 'poisson':
+        pos = u > 0
+        return numpy.sum(u[pos] - b[pos] * numpy.log(u[pos]), dtype=numpy.float64)
+    raise ValueError('Unsupported fidelity ', fidelity)
+
+
+def _pdhg_tv_channel_last(b, alpha, fidelity, iterations, sigma, tau, x_init=None,
+                          update_objective_interval=0, verbose=False):
+    # PDHG for coupled TV on a contiguous channel-last array b
+    ndim = b.ndim - 1
+    if tau is None:
+        tau = 1. / (sigma * 4 * ndim)
+
+    x = b.copy() if x_init is None else x_init.astype(b.dtype, copy=True)
+    x_old = numpy.empty_like(x)
+    xbar = x.copy()
+    tmp = numpy.empty_like(x)
+    y = numpy.zeros((ndim,) + b.shape, dtype=b.dtype)
+    grad = numpy.empty_like(y)
+    norm_tmp = numpy.empty(b.shape[:-1], dtype=b.dtype)
+
+    objective = []
+    for it in range(1, iterations + 1):
+        # dual update: y = prox_{sigma f^*}(y + sigma * \nabla xbar)
+        gradient_channel_last(xbar, out=grad)
+        grad *= sigma
+        y += grad
+        _project_coupled(y, alpha, norm_tmp)
+
+        # primal update: x = prox_{tau g}(x + tau * div y)
+        x_old[...] = x
+        divergence_channel_last(y, out=tmp)
+        tmp *= tau
+        tmp += x
+        _fidelity_prox(tmp, b, tau, fidelity, x)
+
+        # over-relaxation
+        numpy.multiply(x, 2, out=xbar)
+        xbar -= x_old
+
+        if update_objective_interval > 0 and it % update_objective_interval == 0:
+            obj = alpha * coupled_l21_norm(gradient_channel_last(x)) + _fidelity_value(x, b, fidelity)
+            objective.append(obj)
+            if verbose:
+                print('Iteration {} objective {}'.format(it, obj))
+    return x, objective
+
+
+def pdhg_vtv_denoising(noisy, alpha, fidelity='gaussian', iterations=1000, sigma=1., tau=None,
+                       channel_axis=0, update_objective_interval=0, verbose=False):
+    '''Vectorial TV denoising with PDHG on a contiguous channel-last array
+
+    :param noisy: ImageData/numpy array with a channel axis
+    :param alpha: regularisation parameter
+    :param fidelity: 'gaussian', 's&p' or 'poisson'
+    :param iterations: number of PDHG iterations
+    :param sigma: dual step size
+    :param tau: primal step size, defaults to 1/(sigma * ||\nabla||^{2})
+    :param channel_axis: position of the channel axis in noisy
+    :param update_objective_interval: compute the primal objective every so many iterations, 0 disables
+    :returns: (denoised, objective) where denoised has the layout/type of noisy
+    '''
+    b = to_channel_last(noisy, channel_axis)
+    x, objective = _pdhg_tv_channel_last(b, alpha, fidelity, iterations, sigma, tau,
+                                         update_objective_interval=update_objective_interval,
+                                         verbose=verbose)
+    return from_channel_last(x, like=noisy, channel_axis=channel_axis), objective
+
+
+def stream_tv_denoising(frames, alpha, window=8, halo=2, fidelity='gaussian', iterations=200,
+                        sigma=1., tau=None):
+    '''Sliding-window spatio-temporal TV denoising of a stream of 2D frames
+
+    Solves the 'SpaceChannels' TV problem, i.e. the gradient includes the time direction,
+    on a temporal window of frames. The central frames of each window are emitted and the
+    window advances, keeping halo frames on each side as temporal context. The frames
+    carried over to the next window warm start its solve. A short tail at the end of the
+    stream, up to window // 2 frames, is solved with the last window rather than on its
+    own. Memory depends on window only, not on the length of the sequence.
+
+    :param frames: iterable of 2D numpy arrays (e.g. a generator reading from a detector)
+    :param alpha: regularisation parameter
+    :param window: number of frames solved together
+    :param halo: number of context frames on each side of the emitted frames
+    :param fidelity: 'gaussian', 's&p' or 'poisson'
+    :param iterations: PDHG iterations per window
+    :returns: generator of (frame_index, denoised_frame)
+    '''
+    if window - 2 * halo < 1:
+        raise ValueError('window must be larger than 2 * halo, got window {} halo {}'.format(window, halo))
+
+    frames = iter(frames)
+    tail = max(window // 2, 1)
+    noisy = []
+    solved = []
+    first_index = 0
+    start = 0
+    exhausted = False
+
+    while not exhausted or len(noisy) > start:
+        # read ahead by tail frames, so that a short tail joins this window
+        while len(noisy) < window + tail and not exhausted:
+            try:
+                noisy.append(numpy.asarray(next(frames), dtype=numpy.float32))
+            except StopIteration:
+                exhausted = True
+        if len(noisy) <= start:
+            break
+
+        # (time, y, x, 1): time is differentiated like a spatial axis
+        n = len(noisy) if exhausted else window
+        b = numpy.stack(noisy[:n])[..., None]
+        x_init = b.copy()
+        for i, s in enumerate(solved):
+            x_init[i, ..., 0] = s
+        x, _ = _pdhg_tv_channel_last(b, alpha, fidelity, iterations, sigma, tau, x_init=x_init)
+
+        stop = n if exhausted else window - halo
+        for i in range(start, stop):
+            yield first_index + i, x[i, ..., 0].copy()
+
+        # keep halo emitted frames as past context and the unemitted ones
+        keep = max(stop - halo, 0)
+        noisy = noisy[keep:]
+        solved = [x[i, ..., 0].copy() for i in range(keep, x.shape[0])]
+        first_index += keep
+        start = stop - keep
+
+
+if __name__ == '__main__':
+
+    from ccpi.framework import TestData
+    import matplotlib.pyplot as plt
+    import os
+    import sys
+    import timeit
+
+    loader = TestData(data_dir=os.path.join(sys.prefix, 'share','ccpi'))
+    data = loader.load(TestData.PEPPERS, size=(256,256))
+
+    n1 = TestData.random_noise(data.as_array(), mode = 'gaussian', seed = 10)
+    noisy_data = data.geometry.allocate()
+    noisy_data.fill(n1)
+
+    channel_axis = data.get_dimension_axis('channel')
+
+    t0 = timeit.default_timer()
+    vtv, obj = pdhg_vtv_denoising(noisy_data, alpha=0.3, fidelity='gaussian', iterations=1000,
+                                  channel_axis=channel_axis, update_objective_interval=200, verbose=True)
+    print('Vectorial TV, elapsed {:.2f} s'.format(timeit.default_timer() - t0))
+
+    plt.figure(figsize=(15,5))
+    plt.subplot(1,3,1)
+    plt.imshow(data.as_array())
+    plt.title('Ground Truth')
+    plt.subplot(1,3,2)
+    plt.imshow(noisy_data.as_array())
+    plt.title('Noisy Data')
+    plt.subplot(1,3,3)
+    plt.imshow(vtv.as_array())
+    plt.title('Vectorial TV')
+    plt.show()
+
+    # Spatio-temporal TV on a stream of frames
+    import tomophantom
+    from tomophantom import TomoP2D
+
+    path = os.path.dirname(tomophantom.__file__)
+    path_library2D = os.path.join(path, "Phantom2DLibrary.dat")
+    phantom_2Dt = TomoP2D.ModelTemporal(102, 64, path_library2D)
+
+    def noisy_frames():
+        rng = numpy.random.RandomState(10)
+        for frame in phantom_2Dt:
+            yield frame + rng.normal(0, 0.25, size=frame.shape)
+
+    for index, frame in stream_tv_denoising(noisy_frames(), alpha=0.3, window=8, halo=2, iterations=200):
+        print('Frame {} done, range ({:.3f}, {:.3f})'.format(index, frame.min(), frame.max()))
@@ -0,0 +1,411 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Analytic (FBP/FDK) reconstructions used as initialisation of the iterative
+algorithms.
+
+    x_init = fbp_initialisation(ig, data)
+    cgls = CGLS(x_init=x_init, operator=Aop, data=data)
+
+or in one step
+
+    cgls = initialised_algorithm(CGLS, ig, data, operator=Aop, data=data)
+
+An FBP start is already close to the least squares solution in the well
+sampled frequencies, so CGLS/SIRT/PDHG spend their iterations on the rest.
+
+FBPEngine is a CPU implementation of FBP (parallel beam, 2D and 3D, and fan
+beam, 2D cone beam) and FDK (circular cone beam, flat detector) for machines
+without a GPU:
+
+    ramp filtering      rFFT of all the projections at once, with the filter
+                        cached per (padded detector width, pixel size, filter)
+    angle weights       the angular interval around each angle (angle_weights),
+                        for 180 and 360 degree scans and irregular angles
+    backprojection      linear (FBP, fan beam) or bilinear (FDK) interpolation,
+                        angle by angle, threaded over chunks of angles (2D) or
+                        over slabs of the volume (3D, bounded memory)
+
+Coordinates follow ASTRA: x along the columns, y decreasing along the rows,
+detector u = x cos(theta) + y sin(theta), source of the cone beam opposite the
+detector at distance dist_source_center from the rotation axis.
+"""
+
+from __future__ import print_function, division
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import os
+import numpy
+
+if __package__:
+    from .multichannel_utilities import _labels
+else:
+    # loaded as a top-level module, e.g. python fbp_utilities.py
+    from multichannel_utilities import _labels
+
+FILTERS = ['ram-lak', 'shepp-logan', 'cosine', 'hamming', 'hann']
+
+
+@lru_cache(maxsize=32)
+def ramp_filter(npad, pixel_size=1., filter_type='ram-lak'):
+    '''rFFT of the discrete ramp filter (Kak & Slaney) for npad detector samples
+
+    The filter is cached, callers must not modify the returned array.
+    '''
+    if filter_type not in FILTERS:
+        raise ValueError('Unsupported filter ', filter_type)
+    n = numpy.concatenate((numpy.arange(0, npad // 2 + 1), numpy.arange(-(npad // 2) + 1, 0)))
+    h = numpy.zeros(npad)
+    h[0] = 1. / 4
+    odd = n % 2 == 1
+    h[odd] = -1. / (numpy.pi * n[odd]) ** 2
+    filt = numpy.real(numpy.fft.rfft(h)) / pixel_size
+
+    f = numpy.fft.rfftfreq(npad)  # cycles per sample, [0, 0.5]
+    if filter_type == 'shepp-logan':
+        filt *= numpy.sinc(f)
+    elif filter_type == 'cosine':
+        filt *= numpy.cos(numpy.pi * f)
+    elif filter_type == 'hamming':
+        filt *= 0.54 + 0.46 * numpy.cos(2 * numpy.pi * f)
+    elif filter_type == 'hann':
+        filt *= 0.5 + 0.5 * numpy.cos(2 * numpy.pi * f)
+    filt = filt.astype(numpy.float32)
+    filt.setflags(write=False)
+    return filt
+
+
+def filter_projections(proj, pixel_size=1., filter_type='ram-lak', padding=2):
+    '''Ramp filters proj along its last (horizontal detector) axis'''
+    n = proj.shape[-1]
+    npad = int(2 ** numpy.ceil(numpy.log2(max(padding * n, 2))))
+    filt = ramp_filter(npad, float(pixel_size), filter_type)
+    f = numpy.fft.rfft(proj, n=npad, axis=-1)
+    f *= filt
+    return numpy.fft.irfft(f, n=npad, axis=-1)[..., :n].astype(numpy.float32)
+
+
+def angle_weights(angles, period):
+    '''Backprojection weight of each angle, the angular interval around it
+
+    The angles are wrapped into [0, period) and every angle gets half the gaps to
+    its neighbours, so repeated angles (e.g. a 360 degree parallel scan, or
+    linspace(0, 2 pi) with both ends) share their interval. If the angles only
+    cover an arc, the gap outside it is excluded: the first and last angles get
+    the step next to them.
+
+    :param angles: angles in radians
+    :param period: pi for parallel beam, 2 pi for fan and cone beam
+    :returns: (weights, full) with full False if the angles only cover an arc
+    '''
+    angles = numpy.asarray(angles, dtype=numpy.float64)
+    n = len(angles)
+    if n == 1:
+        return numpy.array([float(period)]), False
+    order = numpy.argsort(numpy.mod(angles, period), kind='stable')
+    a = numpy.mod(angles, period)[order]
+    d = numpy.diff(numpy.append(a, a[0] + period))
+    prev, nxt = numpy.roll(d, 1), d.copy()
+    gap = int(numpy.argmax(d))
+    full = d[gap] <= 4 * period / n
+    if not full:
+        # a[gap] is the last angle of the arc, a[gap + 1] the first
+        nxt[gap] = prev[gap]
+        prev[(gap + 1) % n] = nxt[(gap + 1) % n]
+    w = numpy.empty(n)
+    w[order] = (prev + nxt) / 2.
+    return w, full
+
+
+def _interp_rows(q, fi):
+    # linear interpolation of q (..., nh) at fractional indices fi, zero outside
+    nh = q.shape[-1]
+    i0 = numpy.floor(fi).astype(numpy.int64)
+    w = (fi - i0).astype(numpy.float32)
+    valid = (i0 >= 0) & (i0 < nh - 1)
+    numpy.clip(i0, 0, nh - 2, out=i0)
+    val = q[..., i0] * (1 - w) + q[..., i0 + 1] * w
+    val *= valid
+    return val
+
+
+def _interp_bilinear(q, fv, fu):
+    # bilinear interpolation of q (nv, nh) at fractional indices (fv, fu), zero outside
+    nv, nh = q.shape
+    iv = numpy.floor(fv).astype(numpy.int64)
+    iu = numpy.floor(fu).astype(numpy.int64)
+    wv = (fv - iv).astype(numpy.float32)
+    wu = (fu - iu).astype(numpy.float32)
+    valid = (iv >= 0) & (iv < nv - 1) & (iu >= 0) & (iu < nh - 1)
+    numpy.clip(iv, 0, nv - 2, out=iv)
+    numpy.clip(iu, 0, nh - 2, out=iu)
+    val = (q[iv, iu] * (1 - wu) + q[iv, iu + 1] * wu) * (1 - wv) + \
+          (q[iv + 1, iu] * (1 - wu) + q[iv + 1, iu + 1] * wu) * wv
+    val *= valid
+    return val
+
+
+class FBPEngine(object):
+
+    '''CPU filtered backprojection, FBP for parallel beam and FDK for cone beam
+
+    :param ig: ImageGeometry of the reconstruction
+    :param ag: AcquisitionGeometry, angles in radians
+    :param filter_type: one of FILTERS
+    :param padding: zero padding factor of the detector rows before filtering
+    :param num_threads: number of threads, defaults to os.cpu_count()
+    '''
+
+    def __init__(self, ig, ag, filter_type='ram-lak', padding=2, num_threads=None):
+        self.ig = ig
+        self.ag = ag
+        self.filter_type = filter_type
+        self.padding = padding
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self.angles = numpy.asarray(ag.angles, dtype=numpy.float64)
+        self.cone = ag.geom_type == 'cone'
+        # fan beam: a cone beam with a single detector row
+        self.fan = self.cone and (ag.dimension == '2D' or ag.pixel_num_v <= 1)
+        self._check_geometry()
+        self.weights = self._angle_weights()
+
+        # voxel centres, y decreasing along the rows
+        self.x = ((numpy.arange(ig.voxel_num_x) - (ig.voxel_num_x - 1) / 2.) * ig.voxel_size_x).astype(numpy.float32)
+        self.y = (((ig.voxel_num_y - 1) / 2. - numpy.arange(ig.voxel_num_y)) * ig.voxel_size_y).astype(numpy.float32)
+        nz = max(ig.voxel_num_z, 1)
+        self.z = ((numpy.arange(nz) - (nz - 1) / 2.) * ig.voxel_size_z).astype(numpy.float32)
+
+    def _check_geometry(self):
+        ig, ag = self.ig, self.ag
+        nz = max(ig.voxel_num_z, 1)
+        if ag.geom_type not in ('parallel', 'cone'):
+            raise ValueError('Unsupported geometry type {}'.format(ag.geom_type))
+        if ag.pixel_size_h <= 0:
+            raise ValueError('Expected a positive pixel_size_h, got {}'.format(ag.pixel_size_h))
+        if self.cone:
+            if ag.dist_source_center <= 0 or ag.dist_center_detector < 0:
+                raise ValueError('Cone beam needs dist_source_center > 0 and dist_center_detector >= 0, '
+                                 'got {} and {}'.format(ag.dist_source_center, ag.dist_center_detector))
+            if self.fan and nz > 1:
+                raise ValueError('Fan beam data reconstruct a 2D image, got {} slices'.format(nz))
+            if not self.fan and ag.pixel_size_v <= 0:
+                raise ValueError('Expected a positive pixel_size_v, got {}'.format(ag.pixel_size_v))
+        elif nz != max(ag.pixel_num_v, 1):
+            raise ValueError('Parallel beam needs as many slices ({}) as detector rows ({})'.format(
+                nz, max(ag.pixel_num_v, 1)))
+
+    def _angle_weights(self):
+        # FBP integrates over [0, pi) in parallel beam, FDK half the integral over [0, 2 pi)
+        if self.cone:
+            w, full = angle_weights(self.angles, 2 * numpy.pi)
+            if not full:
+                raise ValueError('Fan and cone beam need a full 360 degree scan, '
+                                 'short scans (Parker weights) are not supported')
+            return (w / 2).astype(numpy.float32)
+        # theta and theta + pi measure the same lines, 360 degree scans share the weights
+        w, _ = angle_weights(self.angles, numpy.pi)
+        return w.astype(numpy.float32)
+
+    def _projections(self, data):
+        # returns the data as (angle, vertical, horizontal)
+        labels = _labels(data)
+        order = [labels.index(l) for l in ('angle', 'vertical', 'horizontal') if l in labels]
+        proj = numpy.transpose(data.as_array(), order)
+        if proj.ndim == 2:
+            proj = proj[:, None, :]
+        return numpy.ascontiguousarray(proj, dtype=numpy.float32)
+
+    def _backproject_parallel(self, q, angle_idx, out):
+        # out (nz, ny, nx) += sum over angle_idx of q interpolated at u = x cos + y sin
+        ag = self.ag
+        X = self.x[None, :]
+        Y = self.y[:, None]
+        for a in angle_idx:
+            th = self.angles[a]
+            fi = (X * numpy.float32(numpy.cos(th)) + Y * numpy.float32(numpy.sin(th))) / ag.pixel_size_h \
+                 + (ag.pixel_num_h - 1) / 2.
+            out += _interp_rows(q[a] if out.ndim == 3 else q[a][0], fi)
+        return out
+
+    def _backproject_fan(self, q, angle_idx, out):
+        # out (ny, nx) += sum over angle_idx of (dso / L)^2 q interpolated along u
+        ag = self.ag
+        dso = ag.dist_source_center
+        du = ag.pixel_size_h * dso / (dso + ag.dist_center_detector)
+        X = self.x[None, :]
+        Y = self.y[:, None]
+        for a in angle_idx:
+            th = self.angles[a]
+            c, s = numpy.float32(numpy.cos(th)), numpy.float32(numpy.sin(th))
+            mag = dso / (dso + X * s - Y * c)
+            fu = (X * c + Y * s) * mag / du + (ag.pixel_num_h - 1) / 2.
+            out += _interp_rows(q[a][0], fu) * (mag * mag)
+        return out
+
+    def _backproject_cone(self, q, angle_idx, z, out):
+        ag = self.ag
+        dso = ag.dist_source_center
+        dsd = dso + ag.dist_center_detector
+        # detector pixels scaled to the rotation axis
+        du = ag.pixel_size_h * dso / dsd
+        dv = ag.pixel_size_v * dso / dsd
+        X = self.x[None, :]
+        Y = self.y[:, None]
+        Z = z[:, None, None]
+        nh, nv = ag.pixel_num_h, max(ag.pixel_num_v, 1)
+        for a in angle_idx:
+            th = self.angles[a]
+            c, s = numpy.float32(numpy.cos(th)), numpy.float32(numpy.sin(th))
+            L = dso + X * s - Y * c
+            mag = dso / L
+            fu = (X * c + Y * s) * mag / du + (nh - 1) / 2.
+            fv = Z * mag[None] / dv + (nv - 1) / 2.
+            val = _interp_bilinear(q[a], fv, numpy.broadcast_to(fu, fv.shape))
+            val *= (mag * mag)[None]
+            out += val
+        return out
+
+    def __call__(self, data):
+        ag = self.ag
+        proj = self._projections(data)
+        nangles, nv, nh = proj.shape
+
+        if self.cone:
+            # cosine weighting on the detector scaled to the rotation axis
+            dso = ag.dist_source_center
+            dsd = dso + ag.dist_center_detector
+            u = (numpy.arange(nh) - (nh - 1) / 2.) * ag.pixel_size_h * dso / dsd
+            v = numpy.zeros(1) if self.fan else (numpy.arange(nv) - (nv - 1) / 2.) * ag.pixel_size_v * dso / dsd
+            weight = dso / numpy.sqrt(dso ** 2 + u[None, :] ** 2 + v[:, None] ** 2)
+            proj *= weight.astype(numpy.float32)[None]
+            pixel_size = ag.pixel_size_h * dso / dsd
+        else:
+            pixel_size = ag.pixel_size_h
+        q = filter_projections(proj, pixel_size, self.filter_type, self.padding)
+        if nangles != len(self.weights):
+            raise ValueError('Expected {} angles, got {}'.format(len(self.weights), nangles))
+        q *= self.weights[:, None, None]
+
+        ig = self.ig
+        nz = len(self.z)
+        vol = numpy.zeros((nz, ig.voxel_num_y, ig.voxel_num_x), dtype=numpy.float32)
+        threads = min(self.num_threads, nangles)
+
+        if nz == 1 and (self.fan or not self.cone):
+            # 2D: chunks of angles, one partial image per thread
+            backproject = self._backproject_fan if self.fan else self._backproject_parallel
+            chunks = numpy.array_split(numpy.arange(nangles), threads)
+            if threads > 1:
+                with ThreadPoolExecutor(max_workers=threads) as pool:
+                    parts = list(pool.map(lambda idx: backproject(
+                        q, idx, numpy.zeros(vol.shape[1:], dtype=numpy.float32)), chunks))
+                vol[0] = numpy.sum(parts, axis=0)
+            else:
+                backproject(q, chunks[0], vol[0])
+        else:
+            # 3D: slabs of the volume, all angles each
+            slabs = [sl for sl in numpy.array_split(numpy.arange(nz), min(self.num_threads, nz)) if sl.size]
+
+            def work(sl):
+                out = vol[sl[0]:sl[-1] + 1]
+                if self.cone:
+                    self._backproject_cone(q, range(nangles), self.z[sl[0]:sl[-1] + 1], out)
+                else:
+                    self._backproject_parallel(q[:, sl[0]:sl[-1] + 1], range(nangles), out)
+            if len(slabs) > 1:
+                with ThreadPoolExecutor(max_workers=len(slabs)) as pool:
+                    list(pool.map(work, slabs))
+            else:
+                work(slabs[0])
+
+        out = ig.allocate()
+        out.fill(vol.reshape(out.shape))
+        return out
+
+
+def fbp(ig, data, filter_type='ram-lak', padding=2, num_threads=None):
+    '''CPU FBP/FDK reconstruction of AcquisitionData on ig'''
+    return FBPEngine(ig, data.geometry, filter_type, padding, num_threads)(data)
+
+
+def fbp_initialisation(ig, data, device='cpu', filter_type='ram-lak', nonnegative=False):
+    '''FBP (parallel beam) or FDK (cone beam) reconstruction of data on ig
+
+    :param ig: ImageGeometry of the reconstruction
+    :param data: AcquisitionData
+    :param device: 'cpu' uses FBPEngine, 'gpu' the ASTRA FBP processor
+    :param filter_type: filter name, e.g. 'ram-lak', 'hann'
+    :param nonnegative: if True negative values are set to 0
+    :returns: ImageData
+    '''
+    if device == 'cpu':
+        x = fbp(ig, data, filter_type=filter_type)
+    else:
+        from ccpi.astra.processors import FBP
+        processor = FBP(ig, data.geometry, device, filter_type)
+        processor.set_input(data)
+        x = processor.get_output()
+    if nonnegative:
+        x.maximum(0, out=x)
+    return x
+
+
+def initialised_algorithm(algorithm_class, ig, analytic_data, device='cpu', filter_type='ram-lak',
+                          nonnegative=False, **kwargs):
+    '''Creates algorithm_class(x_init=FBP/FDK of analytic_data, **kwargs)
+
+    :param algorithm_class: e.g. CGLS, SIRT, PDHG
+    :param analytic_data: AcquisitionData reconstructed analytically for x_init
+    :param kwargs: the other arguments of algorithm_class
+    '''
+    x_init = fbp_initialisation(ig, analytic_data, device=device, filter_type=filter_type,
+                                nonnegative=nonnegative)
+    return algorithm_class(x_init=x_init, **kwargs)
+
+
+if __name__ == '__main__':
+
+    from ccpi.framework import ImageGeometry, ImageData, AcquisitionGeometry
+    from ccpi.astra.operators import AstraProjectorSimple
+    from ccpi.optimisation.algorithms import CGLS
+    import tomophantom
+    from tomophantom import TomoP2D
+    import os
+
+    N = 256
+    path = os.path.dirname(tomophantom.__file__)
+    path_library2D = os.path.join(path, "Phantom2DLibrary.dat")
+    phantom_2D = TomoP2D.Model(1, N, path_library2D)
+
+    ig = ImageGeometry(voxel_num_x = N, voxel_num_y = N)
+    data = ImageData(phantom_2D, geometry=ig)
+    angles = numpy.linspace(0, numpy.pi, 180, dtype=numpy.float32)
+    ag = AcquisitionGeometry('parallel','2D', angles, N)
+    Aop = AstraProjectorSimple(ig, ag, 'cpu')
+    sin = Aop.direct(data)
+
+    for name, x_init in [('zeros', ig.allocate()), ('FBP', fbp_initialisation(ig, sin))]:
+        cgls = CGLS(x_init=x_init, operator=Aop, data=sin)
+        cgls.max_iteration = 100
+        cgls.update_objective_interval = 20
+        cgls.run(100, verbose=False)
+        print('CGLS from {}: objective {}'.format(name, cgls.objective[-1]))
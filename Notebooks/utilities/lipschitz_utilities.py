@@ -0,0 +1,145 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Cached operator norms and Lipschitz constants for FISTA.
+
+FunctionOperatorComposition and Norm2Sq run the power method on the operator
+every time they are created. cached_norm keeps the result:
+
+    per operator instance        for any LinearOperator
+    per geometry                 for projectors (class name containing 'Projector'),
+                                 so a new AstraProjectorSimple on the same
+                                 ImageGeometry/AcquisitionGeometry reuses it
+
+LeastSquares(A, b, c) is the smooth term c ||A x - b||^2 with L = 2 c ||A||^2
+taken from the cache on first use, and works with the CIL FISTA. When no safe
+bound is available, BacktrackingFISTA (reconstruction_utilities) estimates L
+with a line search instead.
+"""
+
+from __future__ import print_function, division
+import hashlib
+import weakref
+import numpy
+
+from ccpi.optimisation.functions import Function
+
+_INSTANCE_NORMS = weakref.WeakKeyDictionary()
+_GEOMETRY_NORMS = {}
+
+
+def _geometry_repr(geometry):
+    attrs = ['geom_type', 'dimension', 'shape', 'voxel_size_x', 'voxel_size_y', 'voxel_size_z',
+             'pixel_size_h', 'pixel_size_v', 'dist_source_center', 'dist_center_detector', 'channels']
+    params = tuple((a, getattr(geometry, a)) for a in attrs if hasattr(geometry, a))
+    h = hashlib.sha1(repr(params).encode('utf-8'))
+    if getattr(geometry, 'angles', None) is not None:
+        h.update(numpy.ascontiguousarray(geometry.angles, dtype=numpy.float64).tobytes())
+    return h.hexdigest()
+
+
+def operator_key(operator):
+    '''Geometry key of a projector, None for the other operators'''
+    name = type(operator).__name__
+    if 'Projector' not in name:
+        return None
+    return (type(operator).__module__, name, getattr(operator, 'device', None),
+            _geometry_repr(operator.domain_geometry()), _geometry_repr(operator.range_geometry()))
+
+
+def cached_norm(operator, **kwargs):
+    '''||operator||, computed once per operator instance or projector geometry
+
+    :param kwargs: passed to operator.norm on the first call, e.g. iterations
+    '''
+    try:
+        return _INSTANCE_NORMS[operator]
+    except (KeyError, TypeError):
+        pass
+    key = operator_key(operator)
+    if key is not None and key in _GEOMETRY_NORMS:
+        norm = _GEOMETRY_NORMS[key]
+    else:
+        norm = operator.norm(**kwargs)
+        if key is not None:
+            _GEOMETRY_NORMS[key] = norm
+    try:
+        _INSTANCE_NORMS[operator] = norm
+    except TypeError:
+        pass
+    return norm
+
+
+def set_cached_norm(operator, norm):
+    '''Stores a known norm (e.g. computed offline) for operator'''
+    _INSTANCE_NORMS[operator] = norm
+    key = operator_key(operator)
+    if key is not None:
+        _GEOMETRY_NORMS[key] = norm
+
+
+def clear_norm_cache():
+    _INSTANCE_NORMS.clear()
+    _GEOMETRY_NORMS.clear()
+
+
+class LeastSquares(Function):
+
+    '''c ||A x - b||^2 with a cached Lipschitz constant of the gradient
+
+    :param A: LinearOperator
+    :param b: data
+    :param c: scaling constant
+    '''
+
+    def __init__(self, A, b, c=1.):
+        super(LeastSquares, self).__init__()
+        self.A = A
+        self.b = b
+        self.c = c
+        self._L = None
+        self._r = A.range_geometry().allocate()
+
+    @property
+    def L(self):
+        if self._L is None:
+            self._L = 2. * self.c * cached_norm(self.A) ** 2
+        return self._L
+
+    @L.setter
+    def L(self, value):
+        self._L = value
+
+    def __call__(self, x):
+        self.A.direct(x, out=self._r)
+        self._r -= self.b
+        return self.c * self._r.squared_norm()
+
+    def gradient(self, x, out=None):
+        self.A.direct(x, out=self._r)
+        self._r -= self.b
+        if out is None:
+            out = self.A.adjoint(self._r)
+            out *= 2. * self.c
+            return out
+        self.A.adjoint(self._r, out=out)
+        out *= 2. * self.c
@@ -0,0 +1,276 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Memory footprint of a reconstruction, predicted before it is launched.
+
+An algorithm keeps a fixed number of buffers the size of the domain (x) and
+of the range (y) of its operator, plus temporaries created by every update.
+The domain and range follow from the geometries and the regulariser:
+
+    regulariser     in the operator (PDHG, SPDHG, CGLS)         as a proximal (FISTA)
+    None            x: image, y: data                           -
+    'Tikhonov'      y: data + g images (Gradient)               -
+    'TV'            y: data + g images (Gradient)               FGP: 3 g + 2 images
+    'TGV'           x: image + g images,                        PD: 2 + 4 g + g (g + 1) images
+                    y: data + g + g * g images (Gradient,
+                       SymmetrizedGradient)
+
+with g the number of Gradient components (the spatial axes, plus the channel
+axis for correlation='SpaceChannels'). For example notebook 05's 4D TV PDHG
+
+    plan = plan_memory(ig, ag, 'PDHG', regulariser='TV', correlation='SpaceChannels')
+    print(plan)
+    for settings, p in suggest_settings(ig, ag, 'PDHG', budget=64e9, regulariser='TV'):
+        print(settings, p.peak / 1e9)
+
+suggest_settings tries memopt, float32 and finally slabs of vertical slices,
+which are independent problems for parallel beam. For cone beam a slab also
+needs the detector rows its cone reaches, so the slab estimate is a lower bound.
+"""
+
+from __future__ import print_function, division
+import os
+import numpy
+
+if __package__:
+    from .multichannel_utilities import _labels
+else:
+    # loaded as a top-level module, e.g. python memory_utilities.py
+    from multichannel_utilities import _labels
+
+# buffers of each algorithm: (domain, range, domain per subset, temporary domain, temporary range)
+# the temporaries are those of one update, dropped by memopt=True for the MEMOPT algorithms
+ALGORITHMS = {
+    # CIL
+    'CGLS': (3, 2, 0, 1, 1),
+    'SIRT': (2, 2, 0, 1, 1),
+    'FISTA': (4, 0, 0, 1, 1),
+    'PDHG': (4, 3, 0, 2, 2),
+    # reconstruction_utilities
+    'PCGLS': (5, 5, 0, 1, 1),
+    'PSIRT': (4, 2, 0, 1, 1),
+    'OSSIRT': (2, 2, 1, 1, 1),
+    'OSFISTA': (5, 1, 0, 1, 1),
+    'SPDHG': (5, 2, 0, 1, 0),
+    'RegularisedCGLS': (6, 1, 0, 1, 0),
+    'BacktrackingFISTA': (6, 1, 0, 1, 0),
+}
+
+# algorithms with the regulariser inside the operator, the others use it as a proximal
+EXPLICIT = ('PDHG', 'SPDHG', 'CGLS', 'PCGLS', 'RegularisedCGLS', 'SIRT', 'PSIRT', 'OSSIRT')
+
+# algorithms whose temporaries go away with memopt=True
+MEMOPT = ('PDHG',)
+
+REGULARISERS = (None, 'Tikhonov', 'TV', 'TGV')
+
+_GB = 1024 ** 3
+
+
+def _size(geometry):
+    return int(numpy.prod(geometry.shape))
+
+
+def _vertical(geometry):
+    '''Number of vertical slices, 1 if there is no vertical axis'''
+    labels = _labels(geometry)
+    if 'vertical' not in labels:
+        return 1
+    return geometry.shape[labels.index('vertical')]
+
+
+def gradient_components(ig, correlation='Space'):
+    '''Number of components of Gradient(ig): the spatial axes, plus the channel axis with SpaceChannels'''
+    labels = _labels(ig)
+    g = len([l for l in labels if l != 'channel'])
+    if 'channel' in labels and correlation == 'SpaceChannels':
+        g += 1
+    return g
+
+
+def available_memory():
+    '''Available physical memory in bytes'''
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        import psutil
+        return psutil.virtual_memory().available
+
+
+class MemoryPlan(object):
+
+    '''Buffers of a reconstruction and their peak memory
+
+    :param buffers: list of (name, count, elements per buffer)
+    :param itemsize: bytes per element
+    '''
+
+    def __init__(self, buffers, itemsize, settings=None):
+        self.buffers = buffers
+        self.itemsize = itemsize
+        self.settings = {} if settings is None else settings
+
+    @property
+    def peak(self):
+        '''Peak memory in bytes'''
+        return sum(count * size for _, count, size in self.buffers) * self.itemsize
+
+    def fits(self, budget):
+        return self.peak <= budget
+
+    def __str__(self):
+        lines = ['{:<36} {:>6} {:>12}'.format('buffer', 'count', 'GB')]
+        for name, count, size in self.buffers:
+            if count:
+                lines.append('{:<36} {:>6g} {:>12.3f}'.format(name, count, count * size * self.itemsize / _GB))
+        lines.append('{:<36} {:>6} {:>12.3f}'.format('peak', '', self.peak / _GB))
+        return '\n'.join(lines)
+
+
+def plan_memory(ig, ag=None, algorithm='CGLS', regulariser=None, correlation='Space', subsets=1,
+                memopt=False, dtype=numpy.float32, slab=None):
+    '''Predicts the peak memory of a reconstruction
+
+    :param ig: ImageGeometry
+    :param ag: AcquisitionGeometry, None for denoising (data the size of the image)
+    :param algorithm: a key of ALGORITHMS
+    :param regulariser: None, 'Tikhonov', 'TV' or 'TGV'
+    :param correlation: 'Space' or 'SpaceChannels', the correlation of Gradient
+    :param subsets: number of subsets of OSSIRT/OSFISTA/SPDHG
+    :param memopt: PDHG with memopt=True, updates without temporaries
+    :param dtype: dtype of the containers
+    :param slab: number of vertical slices reconstructed at a time, None for all of them
+    :returns: MemoryPlan
+    '''
+    if algorithm not in ALGORITHMS:
+        raise ValueError('Unknown algorithm {}, expected one of {}'.format(algorithm, sorted(ALGORITHMS)))
+    if regulariser not in REGULARISERS:
+        raise ValueError('Unknown regulariser {}, expected one of {}'.format(regulariser, REGULARISERS))
+
+    image = _size(ig)
+    data = None if ag is None else _size(ag)
+    if slab is not None:
+        image = image * slab // _vertical(ig)
+        if ag is not None:
+            data = data * slab // _vertical(ag)
+    if data is None:
+        data = image
+    g = gradient_components(ig, correlation)
+
+    # domain and range of the operator, in elements
+    domain, dual = image, data
+    prox = 0
+    if algorithm in EXPLICIT:
+        if regulariser in ('Tikhonov', 'TV'):
+            dual += g * image
+        elif regulariser == 'TGV':
+            domain += g * image
+            dual += g * image + g * g * image
+    elif regulariser == 'TV':
+        # FGP_TV of the CCPi-Regularisation toolkit: dual fields, their previous and relaxed values
+        prox = 3 * g + 2
+    elif regulariser == 'TGV':
+        # PD_TGV: u, u_old, v, v_old, p, p_old and the symmetric q, q_old
+        prox = 2 + 4 * g + g * (g + 1)
+    elif regulariser == 'Tikhonov':
+        prox = 1
+
+    nd, nr, nsub, td, tr = ALGORITHMS[algorithm]
+    if memopt and algorithm in MEMOPT:
+        td, tr = 0, 0
+    # the pointwise norm of MixedL21Norm.proximal_conjugate, one image per component plus the sum
+    fun = g + 1 if algorithm in EXPLICIT and regulariser in ('TV', 'TGV') else 0
+
+    buffers = [('input data', 1, data),
+               ('initial image', 1, image),
+               ('domain buffers (x)', nd + nsub * subsets, domain),
+               ('range buffers (y)', nr, dual),
+               ('update temporaries, domain', td, domain),
+               ('update temporaries, range', tr, dual),
+               ('MixedL21Norm temporaries', fun, image),
+               ('regulariser proximal', prox, image),
+               ('projector temporaries', 0 if ag is None else 1, data)]
+    settings = {'algorithm': algorithm, 'regulariser': regulariser, 'memopt': memopt,
+                'dtype': numpy.dtype(dtype).name, 'slab': slab}
+    return MemoryPlan(buffers, numpy.dtype(dtype).itemsize, settings)
+
+
+def suggest_settings(ig, ag=None, algorithm='CGLS', budget=None, dtype=numpy.float32, **kwargs):
+    '''Settings that fit a memory budget, least intrusive first
+
+    Tries the given settings, then memopt (PDHG), then float32 and finally the
+    largest slab of vertical slices that fits.
+
+    :param budget: bytes available, by default the available physical memory
+    :param kwargs: passed to plan_memory
+    :returns: list of (settings, MemoryPlan), empty if not even one slice fits
+    '''
+    if budget is None:
+        budget = available_memory()
+    kwargs.pop('memopt', None)
+    kwargs.pop('slab', None)
+
+    options = [{'memopt': False, 'dtype': dtype}]
+    if algorithm in MEMOPT:
+        options.append({'memopt': True, 'dtype': dtype})
+    if numpy.dtype(dtype).itemsize > 4:
+        options += [dict(o, dtype=numpy.float32) for o in options]
+
+    fit = []
+    for option in options:
+        plan = plan_memory(ig, ag, algorithm, dtype=option['dtype'], memopt=option['memopt'], **kwargs)
+        if plan.fits(budget):
+            fit.append((plan.settings, plan))
+    if fit:
+        return fit
+
+    # slabs with the leanest settings, the footprint is linear in the slab size
+    option = options[-1]
+    nz = _vertical(ig)
+    if nz <= 1:
+        return []
+    per_slice = plan_memory(ig, ag, algorithm, dtype=option['dtype'], memopt=option['memopt'], slab=1,
+                            **kwargs).peak
+    slab = min(nz, int(budget // per_slice)) if per_slice else nz
+    if slab < 1:
+        return []
+    plan = plan_memory(ig, ag, algorithm, dtype=option['dtype'], memopt=option['memopt'], slab=slab, **kwargs)
+    return [(plan.settings, plan)]
+
+
+if __name__ == '__main__':
+
+    from ccpi.framework import ImageGeometry, AcquisitionGeometry
+
+    # notebook 05: 4D TV reconstruction of the spectral data
+    ig = ImageGeometry(voxel_num_x=80, voxel_num_y=80, voxel_num_z=80, channels=100)
+    angles = numpy.linspace(0, 2 * numpy.pi, 120, dtype=numpy.float32)
+    ag = AcquisitionGeometry('cone', '3D', angles, pixel_num_h=80, pixel_num_v=80, channels=100,
+                             dist_source_center=233.0, dist_center_detector=245.0)
+    print(plan_memory(ig, ag, 'PDHG', regulariser='TV', correlation='SpaceChannels'))
+
+    # SophiaBeads CGLS at full size
+    N = 2000
+    ig = ImageGeometry(voxel_num_x=N, voxel_num_y=N, voxel_num_z=N)
+    ag = AcquisitionGeometry('cone', '3D', numpy.linspace(0, 2 * numpy.pi, 1024), pixel_num_h=N, pixel_num_v=N)
+    for settings, plan in suggest_settings(ig, ag, 'CGLS', budget=128 * _GB):
+        print(settings, '{:.1f} GB'.format(plan.peak / _GB))
@@ -0,0 +1,389 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Channel-parallel multi-spectral reconstruction on a process pool.
+
+AstraProjectorMC/AstraProjector3DMC loop over the channels in one process.
+Here the channels are split in chunks over worker processes, and the data
+are exchanged through multiprocessing.shared_memory buffers instead of being
+pickled:
+
+    map_channels            channel-decoupled problems (CGLS, FDK, TV per
+                            channel): every worker solves its channels
+                            independently, e.g. reconstruct_channels(data, ig, 'cgls')
+
+    ChannelParallelOperator the projector of a coupled problem, e.g. PDHG with
+                            Gradient(ig, correlation='SpaceChannels'): direct
+                            and adjoint run per channel on the pool, the
+                            algorithm and its coupling steps (gradient,
+                            MixedL21Norm proximal) stay in the main process
+
+Workers build their single-channel projector once, with operator_factory,
+which must be picklable (a module level function such as default_projector).
+"""
+
+from __future__ import print_function, division
+import multiprocessing
+import os
+import sys
+import numpy
+from multiprocessing import shared_memory
+
+from ccpi.optimisation.operators import LinearOperator
+
+
+class SharedArray(object):
+
+    '''numpy array in shared memory, pickled by the name of the segment
+
+    :param shape: shape of the array
+    :param dtype: numpy dtype
+    :param name: name of an existing segment to attach to, None creates one
+    '''
+
+    def __init__(self, shape, dtype=numpy.float32, name=None):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.owner = name is None
+        nbytes = max(int(numpy.prod(self.shape)) * self.dtype.itemsize, 1)
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            self.shm = _attach(name)
+        self.array = numpy.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def from_array(cls, arr, dtype=numpy.float32):
+        out = cls(arr.shape, dtype)
+        out.array[...] = arr
+        return out
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __getstate__(self):
+        return {'shape': self.shape, 'dtype': self.dtype.str, 'name': self.shm.name}
+
+    def __setstate__(self, state):
+        self.__init__(state['shape'], numpy.dtype(state['dtype']), name=state['name'])
+
+    def close(self):
+        '''Detaches, and frees the segment if this process created it'''
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+            self.owner = False
+
+
+def _attach(name):
+    # pool workers share the resource tracker of the parent, which already
+    # tracks the segment; only the creating process unlinks it
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+
+def _labels(geometry):
+    labels = geometry.dimension_labels
+    return [labels[k] for k in range(len(labels))]
+
+
+def channel_axis(geometry):
+    '''Axis of 'channel' in the geometry, ValueError if there is none'''
+    labels = _labels(geometry)
+    if 'channel' not in labels:
+        raise ValueError('The geometry has no channel axis: {}'.format(labels))
+    return labels.index('channel')
+
+
+def channel_geometry(geometry, channels=1, keep_axis=False):
+    '''Copy of an ImageGeometry or AcquisitionGeometry with the given number of channels
+
+    With channels=1 the 'channel' axis is dropped, unless keep_axis is True.
+    '''
+    from ccpi.framework import ImageGeometry, AcquisitionGeometry
+    with_axis = channels > 1 or keep_axis
+    labels = [l for l in _labels(geometry) if l != 'channel' or with_axis]
+    if with_axis and 'channel' not in labels:
+        labels = ['channel'] + labels
+    if isinstance(geometry, ImageGeometry):
+        return ImageGeometry(voxel_num_x=geometry.voxel_num_x,
+                             voxel_num_y=geometry.voxel_num_y,
+                             voxel_num_z=geometry.voxel_num_z,
+                             voxel_size_x=geometry.voxel_size_x,
+                             voxel_size_y=geometry.voxel_size_y,
+                             voxel_size_z=geometry.voxel_size_z,
+                             channels=channels,
+                             dimension_labels=labels)
+    return AcquisitionGeometry(geometry.geom_type, geometry.dimension, geometry.angles,
+                               geometry.pixel_num_h, geometry.pixel_size_h,
+                               geometry.pixel_num_v, geometry.pixel_size_v,
+                               geometry.dist_source_center, geometry.dist_center_detector, channels,
+                               dimension_labels=labels)
+
+
+def default_projector(ig, ag):
+    '''ASTRA projector of a single channel: CPU in 2D, GPU in 3D'''
+    if ag.dimension == '2D':
+        from ccpi.astra.operators import AstraProjectorSimple
+        return AstraProjectorSimple(ig, ag, 'cpu')
+    from ccpi.astra.operators import AstraProjector3DSimple
+    return AstraProjector3DSimple(ig, ag)
+
+
+def _channel_index(axis, c, ndim):
+    idx = [slice(None)] * ndim
+    idx[axis] = c
+    return tuple(idx)
+
+
+def _chunks(num_channels, num_workers):
+    return [list(chunk) for chunk in numpy.array_split(numpy.arange(num_channels), num_workers) if chunk.size]
+
+
+def _pool(num_workers, initializer=None, initargs=()):
+    # fork shares the parent's modules (and the utilities package) with the workers
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    return ctx.Pool(num_workers, initializer=initializer, initargs=initargs)
+
+
+# channel-decoupled problems
+
+def _map_chunk(args):
+    worker, src, dst, src_axis, dst_axis, chunk, kwargs = args
+    try:
+        for c in chunk:
+            res = worker(src.array[_channel_index(src_axis, c, src.array.ndim)], **kwargs)
+            dst.array[_channel_index(dst_axis, c, dst.array.ndim)] = res
+    finally:
+        src.close()
+        dst.close()
+
+
+def map_channels(worker, data, out_geometry, num_workers=None, **kwargs):
+    '''Applies worker to every channel of data on a process pool
+
+    :param worker: picklable callable (channel_array, **kwargs) -> numpy array of one
+                   channel of out_geometry, e.g. cgls_channel
+    :param data: DataContainer with a 'channel' axis, or a shared_utilities.SharedDataContainer
+                 which the workers attach to without a copy
+    :param out_geometry: geometry of the result, with the same number of channels
+    :param num_workers: number of processes, defaults to min(os.cpu_count(), channels)
+    :returns: DataContainer allocated from out_geometry
+    '''
+    src_axis = channel_axis(data.geometry)
+    dst_axis = channel_axis(out_geometry)
+    num_channels = data.shape[src_axis]
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = max(min(num_workers, num_channels), 1)
+
+    shared = getattr(data, 'shared', None)
+    src = SharedArray.from_array(data.as_array()) if shared is None else shared
+    dst = SharedArray(out_geometry.shape)
+    try:
+        pool = _pool(num_workers)
+        try:
+            pool.map(_map_chunk, [(worker, src, dst, src_axis, dst_axis, chunk, kwargs)
+                                  for chunk in _chunks(num_channels, num_workers)])
+        finally:
+            pool.close()
+            pool.join()
+        out = out_geometry.allocate()
+        out.fill(dst.array)
+    finally:
+        if shared is None:
+            src.close()
+        dst.close()
+    return out
+
+
+def cgls_channel(sino, ig, ag, iterations=10, operator_factory=default_projector):
+    '''CGLS reconstruction of one channel, ig and ag single channel geometries'''
+    from ccpi.optimisation.algorithms import CGLS
+    data = ag.allocate()
+    data.fill(sino)
+    cgls = CGLS(x_init=ig.allocate(), operator=operator_factory(ig, ag), data=data)
+    cgls.max_iteration = iterations
+    cgls.run(iterations, verbose=False)
+    return cgls.get_output().as_array()
+
+
+def fdk_channel(sino, ig, ag, filter_type='ram-lak'):
+    '''CPU FBP/FDK reconstruction of one channel'''
+    from .fbp_utilities import FBPEngine
+    data = ag.allocate()
+    data.fill(sino)
+    return FBPEngine(ig, ag, filter_type, num_threads=1)(data).as_array()
+
+
+def tv_channel(noisy, alpha, fidelity='gaussian', iterations=200):
+    '''TV denoising of one channel'''
+    from .denoising_utilities import pdhg_vtv_denoising
+    denoised, _ = pdhg_vtv_denoising(noisy[None], alpha, fidelity=fidelity, iterations=iterations,
+                                     channel_axis=0)
+    return denoised[0]
+
+
+def reconstruct_channels(data, ig, method='cgls', num_workers=None, **kwargs):
+    '''Channel by channel reconstruction of multi-channel AcquisitionData on a process pool
+
+    :param data: AcquisitionData with a 'channel' axis
+    :param ig: multi-channel ImageGeometry
+    :param method: 'cgls' or 'fdk'
+    :param kwargs: passed to cgls_channel or fdk_channel, e.g. iterations
+    '''
+    workers = {'cgls': cgls_channel, 'fdk': fdk_channel}
+    if method not in workers:
+        raise ValueError('Unsupported method ', method)
+    return map_channels(workers[method], data, ig, num_workers,
+                        ig=channel_geometry(ig), ag=channel_geometry(data.geometry), **kwargs)
+
+
+# coupled problems: only the projector runs on the pool
+
+_WORKER = {}
+
+
+def _init_projector_worker(ig, ag, operator_factory, x, y, x_axis, y_axis):
+    _WORKER.update(operator=operator_factory(ig, ag), ig=ig, ag=ag, x=x, y=y,
+                   x_axis=x_axis, y_axis=y_axis)
+
+
+def _project_chunk(args):
+    mode, chunk = args
+    w = _WORKER
+    if mode == 'direct':
+        src, dst, src_axis, dst_axis = w['x'], w['y'], w['x_axis'], w['y_axis']
+        vin, vout, apply = w['ig'].allocate(), w['ag'].allocate(), w['operator'].direct
+    else:
+        src, dst, src_axis, dst_axis = w['y'], w['x'], w['y_axis'], w['x_axis']
+        vin, vout, apply = w['ag'].allocate(), w['ig'].allocate(), w['operator'].adjoint
+    for c in chunk:
+        vin.fill(src.array[_channel_index(src_axis, c, src.array.ndim)])
+        apply(vin, out=vout)
+        dst.array[_channel_index(dst_axis, c, dst.array.ndim)] = vout.as_array()
+
+
+class ChannelParallelOperator(LinearOperator):
+
+    '''Multi-channel projector applying a single-channel projector per channel on a process pool
+
+    :param ig: multi-channel ImageGeometry
+    :param ag: multi-channel AcquisitionGeometry
+    :param operator_factory: picklable callable (ig, ag) -> single-channel projector
+    :param num_workers: number of processes, defaults to min(os.cpu_count(), channels)
+
+    Call close() (or use it as a context manager) to stop the pool and free the buffers.
+    '''
+
+    def __init__(self, ig, ag, operator_factory=default_projector, num_workers=None):
+        super(ChannelParallelOperator, self).__init__()
+        self.ig = ig
+        self.ag = ag
+        self.x_axis = channel_axis(ig)
+        self.y_axis = channel_axis(ag)
+        num_channels = ig.shape[self.x_axis]
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        num_workers = max(min(num_workers, num_channels), 1)
+
+        self._x = SharedArray(ig.shape)
+        self._y = SharedArray(ag.shape)
+        self._chunks = _chunks(num_channels, num_workers)
+        self._pool = _pool(num_workers, _init_projector_worker,
+                           (channel_geometry(ig), channel_geometry(ag), operator_factory,
+                            self._x, self._y, self.x_axis, self.y_axis))
+
+    def _apply(self, mode, x, out, src, dst, geometry):
+        src.array[...] = x.as_array()
+        self._pool.map(_project_chunk, [(mode, chunk) for chunk in self._chunks])
+        if out is None:
+            out = geometry.allocate()
+            out.fill(dst.array)
+            return out
+        out.fill(dst.array)
+
+    def direct(self, x, out=None):
+        return self._apply('direct', x, out, self._x, self._y, self.ag)
+
+    def adjoint(self, x, out=None):
+        return self._apply('adjoint', x, out, self._y, self._x, self.ig)
+
+    def domain_geometry(self):
+        return self.ig
+
+    def range_geometry(self):
+        return self.ag
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._x.close()
+            self._y.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == '__main__':
+
+    from ccpi.framework import ImageGeometry, ImageData, AcquisitionGeometry
+    from ccpi.astra.operators import AstraProjectorMC
+    from ccpi.optimisation.algorithms import PDHG
+    from ccpi.optimisation.operators import BlockOperator, Gradient
+    from ccpi.optimisation.functions import L2NormSquared, MixedL21Norm, BlockFunction, ZeroFunction
+    import timeit
+
+    N = 128
+    channels = 8
+    ig = ImageGeometry(voxel_num_x=N, voxel_num_y=N, channels=channels)
+    angles = numpy.linspace(0, numpy.pi, 90, dtype=numpy.float32)
+    ag = AcquisitionGeometry('parallel', '2D', angles, N, channels=channels)
+
+    x = ig.allocate('random')
+    data = AstraProjectorMC(ig, ag, 'cpu').direct(x)
+
+    t0 = timeit.default_timer()
+    recon = reconstruct_channels(data, ig, 'cgls', iterations=20)
+    print('CGLS on {} channels: {:.2f} s'.format(channels, timeit.default_timer() - t0))
+
+    # coupled: spectral TV, the projector on the pool and the gradient here
+    with ChannelParallelOperator(ig, ag) as Aop:
+        op1 = Gradient(ig, correlation='SpaceChannels')
+        operator = BlockOperator(op1, Aop, shape=(2,1))
+        f = BlockFunction(0.1 * MixedL21Norm(), 0.5 * L2NormSquared(b=data))
+        normK = operator.norm()
+        sigma = 1
+        tau = 1/(sigma*normK**2)
+        pdhg = PDHG(f=f, g=ZeroFunction(), operator=operator, tau=tau, sigma=sigma)
+        pdhg.max_iteration = 100
+        pdhg.update_objective_interval = 20
+        pdhg.run(100, verbose=True)
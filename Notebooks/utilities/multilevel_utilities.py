@@ -0,0 +1,201 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Coarse-to-fine (multilevel) iterative reconstruction.
+
+Level l uses voxels and detector pixels 2^l times larger: the ImageGeometry and
+AcquisitionGeometry are coarsened with the same factor, and the data are binned
+by averaging detector pixels, which keeps the line integrals. The problem is
+solved at the coarsest level first, and each result is prolongated (linear
+interpolation) to the next level, where it is the x_init of the algorithm.
+Most of the iterations then run on grids 4x (2D) or 8x (3D) cheaper than the
+full resolution one.
+
+Sizes that are not a multiple of the factor are padded symmetrically: a coarse
+grid covers ceil(n / factor) * factor fine voxels (or detector pixels) centred
+on the fine grid, the extra one of an odd padding going to the end.
+"""
+
+from __future__ import print_function, division
+import numpy
+from scipy import ndimage
+
+if __package__:
+    from .multichannel_utilities import _labels
+else:
+    # loaded as a top-level module, e.g. python multilevel_utilities.py
+    from multichannel_utilities import _labels
+
+
+def _coarse(n, factor):
+    '''Number of coarse samples covering n fine ones, axes of length 1 are kept'''
+    return -(-n // factor) if n > 1 else n
+
+
+def _margins(n, factor):
+    '''Padding (before, after) of n samples to a multiple of factor'''
+    total = -n % factor
+    return total // 2, total - total // 2
+
+
+def coarsen_image_geometry(ig, factor):
+    '''ImageGeometry with factor times fewer and larger voxels, covering ig'''
+    from ccpi.framework import ImageGeometry
+    return ImageGeometry(voxel_num_x=_coarse(ig.voxel_num_x, factor),
+                         voxel_num_y=_coarse(ig.voxel_num_y, factor),
+                         voxel_num_z=_coarse(ig.voxel_num_z, factor),
+                         voxel_size_x=ig.voxel_size_x * factor,
+                         voxel_size_y=ig.voxel_size_y * factor,
+                         voxel_size_z=ig.voxel_size_z * factor,
+                         channels=ig.channels,
+                         dimension_labels=_labels(ig))
+
+
+def coarsen_acquisition_geometry(ag, factor):
+    '''AcquisitionGeometry with factor times fewer and larger detector pixels covering ag, same angles'''
+    from ccpi.framework import AcquisitionGeometry
+    return AcquisitionGeometry(ag.geom_type, ag.dimension, ag.angles,
+                               _coarse(ag.pixel_num_h, factor), ag.pixel_size_h * factor,
+                               _coarse(ag.pixel_num_v, factor),
+                               ag.pixel_size_v * factor,
+                               ag.dist_source_center, ag.dist_center_detector, ag.channels,
+                               dimension_labels=_labels(ag))
+
+
+def bin_array(arr, factors):
+    '''Averages blocks of factors[axis] elements along each axis
+
+    Axes that are not a multiple of the factor are first padded symmetrically
+    with their edge values.
+    '''
+    for axis, f in enumerate(factors):
+        if f == 1:
+            continue
+        pad = [(0, 0)] * arr.ndim
+        pad[axis] = _margins(arr.shape[axis], f)
+        if any(pad[axis]):
+            arr = numpy.pad(arr, pad, mode='edge')
+        n = arr.shape[axis] // f
+        shape = arr.shape[:axis] + (n, f) + arr.shape[axis + 1:]
+        arr = arr.reshape(shape).mean(axis=axis + 1)
+    return arr
+
+
+def downsample_data(data, coarse_ag, factor):
+    '''Bins the detector axes of AcquisitionData onto coarse_ag'''
+    factors = [factor if label in ('horizontal', 'vertical') and data.shape[k] > 1 else 1
+               for k, label in enumerate(_labels(data.geometry))]
+    out = coarse_ag.allocate()
+    out.fill(bin_array(data.as_array(), factors).astype(numpy.float32))
+    return out
+
+
+def prolongate(x, fine_ig, factor=2, order=1):
+    '''Interpolates ImageData x onto fine_ig
+
+    x is zoomed by factor along the axes where it is smaller than fine_ig,
+    with the edges (not the centres) of the first and last voxels aligned, and
+    the result cropped symmetrically to fine_ig, as coarsen_image_geometry pads.
+
+    :param factor: ratio of the voxel sizes of x and fine_ig
+    '''
+    arr = x.as_array()
+    zoom = [1 if nf == nc else factor for nf, nc in zip(fine_ig.shape, arr.shape)]
+    for nf, nc, z in zip(fine_ig.shape, arr.shape, zoom):
+        if nc * z < nf:
+            raise ValueError('A grid of {} voxels zoomed by {} does not cover {} voxels'.format(nc, z, nf))
+    res = ndimage.zoom(arr, zoom, order=order, mode='nearest', grid_mode=True)
+    # both grids are centred, the extra voxel of an odd margin is at the end
+    res = res[tuple(slice((s - nf) // 2, (s - nf) // 2 + nf) for nf, s in zip(fine_ig.shape, res.shape))]
+    out = fine_ig.allocate()
+    out.fill(res.astype(numpy.float32))
+    return out
+
+
+def default_algorithm(operator, data, x_init):
+    from ccpi.optimisation.algorithms import CGLS
+    return CGLS(x_init=x_init, operator=operator, data=data)
+
+
+def multilevel_reconstruction(ig, data, operator_factory, algorithm_factory=None,
+                              levels=3, iterations=(50, 20, 10), verbose=False):
+    '''Coarse-to-fine reconstruction
+
+    :param ig: ImageGeometry of the full resolution reconstruction
+    :param data: AcquisitionData at full resolution
+    :param operator_factory: callable (ig, ag) -> operator, e.g. lambda ig, ag: AstraProjectorSimple(ig, ag, 'cpu')
+    :param algorithm_factory: callable (operator, data, x_init) -> configured Algorithm, defaults to CGLS
+    :param levels: number of levels, the coarsest grid is 2^(levels-1) times coarser
+    :param iterations: iterations per level, from the coarsest to the finest
+    :returns: (x, algorithms) with x the full resolution ImageData and the Algorithm of each level
+    '''
+    if algorithm_factory is None:
+        algorithm_factory = default_algorithm
+    if len(iterations) != levels:
+        raise ValueError('iterations needs one entry per level, got {} for {} levels'.format(len(iterations), levels))
+
+    x = None
+    algorithms = []
+    for level in range(levels - 1, -1, -1):
+        factor = 2 ** level
+        if factor > 1:
+            ig_l = coarsen_image_geometry(ig, factor)
+            ag_l = coarsen_acquisition_geometry(data.geometry, factor)
+            data_l = downsample_data(data, ag_l, factor)
+        else:
+            ig_l, ag_l, data_l = ig, data.geometry, data
+
+        x_init = ig_l.allocate() if x is None else prolongate(x, ig_l)
+        operator = operator_factory(ig_l, ag_l)
+        algorithm = algorithm_factory(operator, data_l, x_init)
+        n = iterations[levels - 1 - level]
+        algorithm.max_iteration = max(algorithm.max_iteration, n)
+        algorithm.run(n, verbose=verbose)
+        algorithms.append(algorithm)
+        x = algorithm.get_output()
+        if verbose:
+            print('Level {} ({}) done after {} iterations'.format(level, ig_l.shape, n))
+    return x, algorithms
+
+
+if __name__ == '__main__':
+
+    from ccpi.framework import ImageGeometry, ImageData, AcquisitionGeometry
+    from ccpi.astra.operators import AstraProjectorSimple
+    import tomophantom
+    from tomophantom import TomoP2D
+    import os
+
+    N = 256
+    path = os.path.dirname(tomophantom.__file__)
+    path_library2D = os.path.join(path, "Phantom2DLibrary.dat")
+    phantom_2D = TomoP2D.Model(1, N, path_library2D)
+
+    ig = ImageGeometry(voxel_num_x = N, voxel_num_y = N)
+    data = ImageData(phantom_2D, geometry=ig)
+    angles = numpy.linspace(0, numpy.pi, 180, dtype=numpy.float32)
+    ag = AcquisitionGeometry('parallel','2D', angles, N)
+
+    factory = lambda ig, ag: AstraProjectorSimple(ig, ag, 'cpu')
+    sin = factory(ig, ag).direct(data)
+
+    x, algorithms = multilevel_reconstruction(ig, sin, factory, levels=3, iterations=(50, 20, 10), verbose=True)
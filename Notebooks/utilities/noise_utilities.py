@@ -0,0 +1,350 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Noise analysis for the denoising demos.
+
+estimate_noise looks at a noisy image and decides between the three noise
+models used in the demos ('gaussian', 'poisson', 's&p'):
+
+    impulse fraction:  pixels at the extremes of the range that jump away from
+                       their 3x3 median                      -> 's&p'
+    variance-mean:     local variance of the finest Haar detail regressed on
+                       the local mean, var = gain * mean + var0;
+                       a dominant gain term                  -> 'poisson'
+    wavelet MAD:       sigma = median(|HH1|) / 0.6745        -> 'gaussian'
+
+select_regularisation turns the estimate into a fidelity and an initial alpha,
+and optionally refines alpha with the discrepancy principle.
+
+add_noise simulates the same models, plus 'mixed' (Poisson followed by
+Gaussian read-out noise), in place. The array is processed in chunks, each with
+its own Generator seeded from numpy.random.SeedSequence(seed).spawn, so the result
+does not depend on the number of threads and only chunk-sized temporaries are
+allocated.
+"""
+
+from __future__ import print_function, division
+from concurrent.futures import ThreadPoolExecutor
+import os
+import numpy
+
+if __package__:
+    from .precision_utilities import _as_array, check_precision
+else:
+    # loaded as a top-level module, e.g. python noise_utilities.py
+    from precision_utilities import _as_array, check_precision
+
+NOISES = ['gaussian', 'poisson', 's&p']
+MODES = NOISES + ['mixed']
+
+# alpha = factor * noise level, calibrated on the 2D denoising demos
+_ALPHA_FACTOR = {'gaussian': 3., 'poisson': 0.8, 's&p': 6.}
+
+
+def haar_detail(img):
+    '''Finest diagonal Haar detail coefficients (HH1) over the last two axes'''
+    ny = img.shape[-2] - img.shape[-2] % 2
+    nx = img.shape[-1] - img.shape[-1] % 2
+    a = img[..., 0:ny:2, 0:nx:2]
+    b = img[..., 0:ny:2, 1:nx:2]
+    c = img[..., 1:ny:2, 0:nx:2]
+    d = img[..., 1:ny:2, 1:nx:2]
+    return (a - b - c + d) / 2.
+
+
+def wavelet_mad_sigma(img):
+    '''Robust Gaussian noise standard deviation, median(|HH1|) / 0.6745'''
+    hh = haar_detail(numpy.asarray(img, dtype=numpy.float64))
+    return numpy.median(numpy.abs(hh)) / 0.6745
+
+
+def median3x3(img):
+    '''3x3 median filter over the last two axes, edges replicated'''
+    pad = [(0, 0)] * (img.ndim - 2) + [(1, 1), (1, 1)]
+    p = numpy.pad(img, pad, mode='edge')
+    ny, nx = img.shape[-2:]
+    shifts = [p[..., i:i + ny, j:j + nx] for i in range(3) for j in range(3)]
+    return numpy.median(numpy.stack(shifts), axis=0)
+
+
+def impulse_fraction(img, tolerance=0.02):
+    '''Fraction of pixels that look like salt & pepper impulses
+
+    A pixel is an impulse if it lies within tolerance * range of the image minimum
+    or maximum and differs from its 3x3 median by more than a quarter of the range.
+    '''
+    img = numpy.asarray(img, dtype=numpy.float64)
+    lo, hi = img.min(), img.max()
+    rng = hi - lo
+    if rng == 0:
+        return 0.
+    extreme = (img <= lo + tolerance * rng) | (img >= hi - tolerance * rng)
+    jump = numpy.abs(img - median3x3(img)) > 0.25 * rng
+    return numpy.count_nonzero(extreme & jump) / img.size
+
+
+def variance_mean_fit(img, block=8):
+    '''Least squares fit of var = gain * mean + var0 over block x block tiles
+
+    The variance of each tile is taken from its Haar HH1 coefficients so that
+    image structure does not leak into the noise estimate.
+
+    :returns: (gain, var0, r2)
+    '''
+    img = numpy.asarray(img, dtype=numpy.float64)
+    if img.ndim > 2:
+        img = img.reshape((-1,) + img.shape[-2:])[0]
+    ny = img.shape[0] - img.shape[0] % block
+    nx = img.shape[1] - img.shape[1] % block
+    tiles = img[:ny, :nx].reshape(ny // block, block, nx // block, block).swapaxes(1, 2)
+    means = tiles.mean(axis=(2, 3)).ravel()
+    hh = haar_detail(tiles)
+    # robust per-tile variance
+    variances = (numpy.median(numpy.abs(hh), axis=(2, 3)).ravel() / 0.6745) ** 2
+
+    A = numpy.stack([means, numpy.ones_like(means)], axis=1)
+    (gain, var0), res, _, _ = numpy.linalg.lstsq(A, variances, rcond=None)
+    ss_tot = numpy.sum((variances - variances.mean()) ** 2)
+    r2 = 1 - res[0] / ss_tot if res.size and ss_tot > 0 else 0.
+    return gain, var0, r2
+
+
+def estimate_noise(noisy, impulse_threshold=0.01, block=8):
+    '''Estimates the noise model and level of a noisy image
+
+    :param noisy: DataContainer or numpy array
+    :param impulse_threshold: impulse fraction above which the noise is classed as 's&p'
+    :param block: tile size for the variance-mean fit
+    :returns: dict with keys noise, sigma, impulse_fraction, gain, var0, r2
+    '''
+    img = _as_array(noisy).astype(numpy.float64)
+
+    fraction = impulse_fraction(img)
+    sigma = wavelet_mad_sigma(img)
+    gain, var0, r2 = variance_mean_fit(img, block)
+
+    if fraction > impulse_threshold:
+        noise = 's&p'
+    else:
+        # signal dependent noise: the gain term explains most of the variance at the mean level
+        mean_level = max(img.mean(), 0)
+        if gain > 0 and r2 > 0.3 and gain * mean_level > 2 * abs(var0):
+            noise = 'poisson'
+        else:
+            noise = 'gaussian'
+
+    return {'noise': noise, 'sigma': sigma, 'impulse_fraction': fraction,
+            'gain': gain, 'var0': var0, 'r2': r2}
+
+
+def make_fidelity(noise, noisy_data):
+    '''Fidelity used by the denoising demos for the given noise model'''
+    from ccpi.optimisation.functions import L1Norm, KullbackLeibler, L2NormSquared
+    if noise == 's&p':
+        return L1Norm(b=noisy_data)
+    elif noise == 'poisson':
+        return KullbackLeibler(noisy_data)
+    elif noise == 'gaussian':
+        return 0.5 * L2NormSquared(b=noisy_data)
+    raise ValueError('Unsupported Noise ', noise)
+
+
+def initial_alpha(estimate):
+    '''Initial regularisation parameter from a noise estimate'''
+    noise = estimate['noise']
+    if noise == 'gaussian':
+        level = estimate['sigma']
+    elif noise == 'poisson':
+        # a Poisson image with gain k has counts x / k, fewer counts need a larger alpha
+        level = estimate['gain']
+    else:
+        level = estimate['impulse_fraction']
+    return _ALPHA_FACTOR[noise] * level
+
+
+def discrepancy(denoised, noisy, estimate):
+    '''Normalised discrepancy of a denoised image, ~1 at the right alpha'''
+    u = numpy.asarray(denoised, dtype=numpy.float64)
+    g = numpy.asarray(noisy, dtype=numpy.float64)
+    noise = estimate['noise']
+    if noise == 'gaussian':
+        return numpy.sum((u - g) ** 2) / (g.size * estimate['sigma'] ** 2)
+    elif noise == 'poisson':
+        # generalised discrepancy on counts: 2 * KL(g, u) ~ number of pixels
+        k = max(estimate['gain'], 1e-8)
+        uc = numpy.maximum(u, 1e-12) / k
+        gc = numpy.maximum(g, 0) / k
+        pos = gc > 0
+        kl = numpy.sum(uc - gc) + numpy.sum(gc[pos] * numpy.log(gc[pos] / uc[pos]))
+        return 2 * kl / g.size
+    else:
+        # fraction of pixels changed by the denoiser vs fraction of impulses
+        changed = numpy.count_nonzero(numpy.abs(u - g) > 0.1 * (g.max() - g.min()))
+        return changed / (g.size * max(estimate['impulse_fraction'], 1e-8))
+
+
+def select_regularisation(noisy, denoiser=None, search=False, iterations=12, tolerance=0.05, estimate=None):
+    '''Chooses the fidelity and alpha for denoising noisy
+
+    :param noisy: DataContainer or numpy array
+    :param denoiser: callable denoiser(noisy_array, noise, alpha) -> numpy array, used by the
+                     discrepancy search. Defaults to pdhg_vtv_denoising with 300 iterations
+    :param search: if True bisect alpha (in log scale) until the discrepancy is within tolerance of 1
+    :param iterations: maximum number of bisection steps
+    :param estimate: precomputed result of estimate_noise
+    :returns: (noise, fidelity, alpha, estimate) where fidelity is the CIL function for noisy
+    '''
+    if estimate is None:
+        estimate = estimate_noise(noisy)
+    noise = estimate['noise']
+    alpha = initial_alpha(estimate)
+
+    if search:
+        if denoiser is None:
+            from .denoising_utilities import pdhg_vtv_denoising
+
+            def denoiser(g, noise, alpha):
+                # a single channel on the last axis
+                u, _ = pdhg_vtv_denoising(g[..., None], alpha, fidelity=noise,
+                                          iterations=300, channel_axis=-1)
+                return u[..., 0]
+
+        g = _as_array(noisy)
+        lo, hi = alpha / 10., alpha * 10.
+        for i in range(iterations):
+            alpha = numpy.sqrt(lo * hi)
+            d = discrepancy(denoiser(g, noise, alpha), g, estimate)
+            if abs(d - 1) < tolerance:
+                break
+            # the residual grows with alpha
+            if d > 1:
+                hi = alpha
+            else:
+                lo = alpha
+
+    fidelity = make_fidelity(noise, noisy) if hasattr(noisy, 'as_array') else None
+    return noise, fidelity, alpha, estimate
+
+
+def _noise_chunk(chunk, rng, mode, mean, sigma, scale, amount, salt_vs_pepper, low, high):
+    # chunk is a view of the data, modified in place
+    if mode in ('poisson', 'mixed'):
+        lam = chunk / scale
+        numpy.maximum(lam, 0, out=lam)
+        chunk[...] = rng.poisson(lam)
+        chunk *= scale
+    if mode in ('gaussian', 'mixed'):
+        dtype = chunk.dtype if chunk.dtype in (numpy.float32, numpy.float64) else numpy.float32
+        noise = rng.standard_normal(chunk.shape, dtype=dtype)
+        if sigma != 1:
+            noise *= sigma
+        if mean != 0:
+            noise += mean
+        chunk += noise
+    if mode == 's&p':
+        u = rng.random(chunk.shape, dtype=numpy.float32)
+        chunk[u < amount * salt_vs_pepper] = high
+        chunk[(u >= amount * salt_vs_pepper) & (u < amount)] = low
+
+
+def add_noise(data, mode='gaussian', seed=None, chunk=1 << 20, num_threads=None, inplace=True,
+              mean=0., sigma=0.1, scale=1., amount=0.05, salt_vs_pepper=0.5, low=None, high=None):
+    '''Simulates noise on data chunk by chunk, in place
+
+    :param data: DataContainer or float numpy array, a PrecisionWarning is raised if it is
+                 wider than the storage dtype of precision_utilities
+    :param mode: 'gaussian', 'poisson', 's&p' or 'mixed' (Poisson followed by Gaussian)
+    :param seed: int seed, chunks draw from SeedSequence(seed).spawn so results are reproducible
+    :param chunk: number of elements per chunk
+    :param num_threads: number of worker threads, defaults to os.cpu_count()
+    :param inplace: if False the noise is added to a copy of data
+    :param mean, sigma: Gaussian noise parameters
+    :param scale: Poisson gain, the counts are data / scale
+    :param amount: fraction of pixels replaced by salt & pepper
+    :param salt_vs_pepper: fraction of the replaced pixels set to high
+    :param low, high: pepper and salt values, default to the data min and max
+    :returns: data (or its noisy copy)
+    '''
+    if mode not in MODES:
+        raise ValueError('Unsupported Noise ', mode)
+    if not inplace:
+        data = data.copy()
+    arr = _as_array(data)
+    if arr.dtype.kind != 'f':
+        raise TypeError('add_noise needs a floating point array, got {}'.format(arr.dtype))
+    check_precision(arr, 'add_noise data')
+    flat = arr.reshape(-1)
+    if not numpy.shares_memory(flat, arr):
+        raise ValueError('add_noise needs a contiguous array to work in place')
+
+    if mode == 's&p':
+        low = arr.min() if low is None else low
+        high = arr.max() if high is None else high
+
+    nchunks = (flat.size + chunk - 1) // chunk
+    seeds = numpy.random.SeedSequence(seed).spawn(nchunks)
+
+    def work(i):
+        rng = numpy.random.default_rng(seeds[i])
+        _noise_chunk(flat[i * chunk:(i + 1) * chunk], rng, mode, mean, sigma, scale,
+                     amount, salt_vs_pepper, low, high)
+
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    if num_threads > 1 and nchunks > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            list(pool.map(work, range(nchunks)))
+    else:
+        for i in range(nchunks):
+            work(i)
+    return data
+
+
+if __name__ == '__main__':
+
+    from ccpi.framework import TestData
+    import os
+    import sys
+
+    loader = TestData(data_dir=os.path.join(sys.prefix, 'share','ccpi'))
+    data = loader.load(TestData.SHAPES)
+    ig = data.geometry
+
+    for noise in NOISES:
+        if noise == 's&p':
+            n1 = TestData.random_noise(data.as_array(), mode = noise, salt_vs_pepper = 0.9, amount=0.2)
+        elif noise == 'poisson':
+            scale = 5
+            n1 = TestData.random_noise( data.as_array()/scale, mode = noise, seed = 10)*scale
+        elif noise == 'gaussian':
+            n1 = TestData.random_noise(data.as_array(), mode = noise, seed = 10)
+        noisy_data = ig.allocate()
+        noisy_data.fill(n1)
+
+        detected, fidelity, alpha, estimate = select_regularisation(noisy_data)
+        print('Applied {} noise, detected {} (sigma {:.3f}, impulses {:.3f}, gain {:.3f}), alpha {:.3f}'.format(
+            noise, detected, estimate['sigma'], estimate['impulse_fraction'], estimate['gain'], alpha))
+
+    # Noise simulated in place on a float32 4D spectral sinogram
+    sinogram = numpy.ones((40, 10, 180, 256), dtype=numpy.float32)
+    add_noise(sinogram, mode='mixed', seed=10, scale=0.1, sigma=0.05)
+    print('Mixed noise on {} {}, mean {:.3f}'.format(sinogram.shape, sinogram.dtype, sinogram.mean()))
@@ -0,0 +1,186 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Precision helpers for the demos.
+
+The policy is opt-in: only code that calls these helpers follows it. It sets
+the storage dtype, float32 (or float16 to halve memory again), and the dtype
+used to accumulate sums, inner products and norms chunk by chunk, float64, so
+no float64 copy of a full volume is ever made. zeros and standard_normal
+allocate in the storage dtype, to_storage casts arrays that arrived wider, e.g.
+after adding np.random.normal noise, and check_precision reports them with a
+PrecisionWarning. noise_utilities.add_noise checks its input this way.
+
+    set_precision('float32')
+    data_pad = zeros(shape)                      # float32 padding
+    noisy = to_storage(sin.as_array() + noise)   # warns if the sum upcast
+    print(norm(noisy))                           # float64 accumulation
+"""
+
+from __future__ import print_function, division
+import warnings
+import numpy
+
+
+class PrecisionWarning(UserWarning):
+    '''Raised when an array is silently wider than the storage precision'''
+    pass
+
+
+_policy = {'storage': numpy.dtype(numpy.float32),
+           'accumulate': numpy.dtype(numpy.float64),
+           'report': True,
+           'chunk': 1 << 20}
+
+
+def set_precision(storage='float32', accumulate='float64', report=True, chunk=None):
+    '''Sets the global precision policy
+
+    :param storage: dtype of stored arrays, 'float32' or 'float16'
+    :param accumulate: dtype used for reductions and norms
+    :param report: if True upcasts found by check_precision/to_storage raise a PrecisionWarning
+    :param chunk: number of elements accumulated at a time
+    '''
+    storage = numpy.dtype(storage)
+    if storage not in (numpy.dtype(numpy.float16), numpy.dtype(numpy.float32)):
+        raise ValueError('Unsupported storage dtype {}, expected float32 or float16'.format(storage))
+    _policy['storage'] = storage
+    _policy['accumulate'] = numpy.dtype(accumulate)
+    _policy['report'] = report
+    if chunk is not None:
+        _policy['chunk'] = int(chunk)
+
+
+def get_storage_dtype():
+    return _policy['storage']
+
+
+def get_accumulate_dtype():
+    return _policy['accumulate']
+
+
+def _as_array(data):
+    return data.as_array() if hasattr(data, 'as_array') else numpy.asarray(data)
+
+
+def check_precision(data, name='array'):
+    '''Reports data whose dtype is wider than the storage dtype
+
+    :returns: True if data matches the storage dtype
+    '''
+    dtype = _as_array(data).dtype
+    storage = _policy['storage']
+    if dtype == storage:
+        return True
+    if _policy['report'] and (dtype.itemsize > storage.itemsize or dtype.kind not in 'f'):
+        warnings.warn('{} is {} but the storage precision is {}'.format(name, dtype, storage),
+                      PrecisionWarning, stacklevel=3)
+    return False
+
+
+def to_storage(data, name='array'):
+    '''Casts data to the storage dtype, reporting upcasts
+
+    A DataContainer is converted in place and returned, a numpy array is returned cast.
+    '''
+    arr = _as_array(data)
+    if check_precision(arr, name):
+        return data
+    arr = arr.astype(_policy['storage'])
+    if hasattr(data, 'as_array'):
+        data.array = arr
+        return data
+    return arr
+
+
+def zeros(shape):
+    '''numpy.zeros in the storage dtype'''
+    return numpy.zeros(shape, dtype=_policy['storage'])
+
+
+def standard_normal(shape, scale=1., seed=None, out=None):
+    '''Gaussian samples generated directly in single precision
+
+    :param shape: shape of the samples
+    :param scale: standard deviation
+    :param seed: seed or numpy.random.Generator
+    :param out: optional storage array to fill
+    '''
+    rng = seed if isinstance(seed, numpy.random.Generator) else numpy.random.default_rng(seed)
+    if out is None:
+        out = numpy.empty(shape, dtype=_policy['storage'])
+    if out.dtype in (numpy.float32, numpy.float64):
+        rng.standard_normal(out=out, dtype=out.dtype)
+    else:
+        out[...] = rng.standard_normal(out.shape, dtype=numpy.float32)
+    if scale != 1:
+        out *= scale
+    return out
+
+
+def _chunks(*arrays):
+    flat = [numpy.ravel(a) for a in arrays]
+    size = flat[0].size
+    step = _policy['chunk']
+    for start in range(0, size, step):
+        yield [f[start:start + step] for f in flat]
+
+
+def reduce_sum(x):
+    '''Sum of x accumulated in the accumulation dtype'''
+    acc = _policy['accumulate']
+    total = acc.type(0)
+    for (c,) in _chunks(_as_array(x)):
+        total += numpy.sum(c, dtype=acc)
+    return total
+
+
+def dot(x, y):
+    '''Inner product of x and y accumulated in the accumulation dtype'''
+    acc = _policy['accumulate']
+    total = acc.type(0)
+    for cx, cy in _chunks(_as_array(x), _as_array(y)):
+        total += numpy.dot(cx.astype(acc), cy.astype(acc))
+    return total
+
+
+def squared_norm(x):
+    '''||x||_{2}^{2} accumulated in the accumulation dtype'''
+    return dot(x, x)
+
+
+def norm(x):
+    '''||x||_{2} accumulated in the accumulation dtype'''
+    return numpy.sqrt(squared_norm(x))
+
+
+if __name__ == '__main__':
+
+    set_precision('float32')
+
+    x = numpy.ones((64, 64, 64), dtype=numpy.float32)
+    # np.random.normal returns float64, the sum silently upcasts
+    noisy = to_storage(x + numpy.random.normal(0, 1, x.shape), name='noisy')
+    print(noisy.dtype, norm(noisy), squared_norm(noisy) / noisy.size)
+
+    noisy = x + standard_normal(x.shape, scale=1., seed=10)
+    print(noisy.dtype, norm(noisy))
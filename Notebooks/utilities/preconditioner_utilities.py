@@ -0,0 +1,122 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Preconditioners for the least squares solvers PCGLS and PSIRT
+(reconstruction_utilities).
+
+Image space preconditioners C approximate (A^T W A)^{-1}:
+
+    DiagonalPreconditioner.column_sum(A)          C = 1 / A^T A 1
+    DiagonalPreconditioner.tikhonov(A, alpha)     C = 1 / (A^T A 1 + alpha^2 diag(\nabla^T \nabla))
+                                                  for the block system [A; alpha \nabla]
+
+Data space weights W change the metric of the residual:
+
+    DiagonalPreconditioner.row_sum(A)             W = 1 / A 1            (SIRT)
+    FourierPreconditioner(ag)                     W = ramp filter along the detector
+
+For parallel beam A^T F A is close to the identity when F is the ramp filter,
+so W = F makes the normal equations well conditioned.
+"""
+
+from __future__ import print_function, division
+import numpy
+
+
+class DiagonalPreconditioner(object):
+
+    '''Multiplies by a fixed DataContainer d'''
+
+    def __init__(self, d):
+        self.d = d
+
+    def apply(self, x, out=None):
+        return x.multiply(self.d, out=out)
+
+    @classmethod
+    def column_sum(cls, operator, eps=1e-8):
+        '''C = 1 / A^T A 1, an upper bound of the Jacobi preconditioner for nonnegative A'''
+        d = operator.adjoint(operator.direct(operator.domain_geometry().allocate(1)))
+        return cls(1. / d.maximum(eps))
+
+    @classmethod
+    def row_sum(cls, operator, eps=1e-8):
+        '''W = 1 / A 1, the SIRT data weighting'''
+        d = operator.direct(operator.domain_geometry().allocate(1))
+        return cls(1. / d.maximum(eps))
+
+    @classmethod
+    def tikhonov(cls, operator, alpha, eps=1e-8):
+        '''C for the block system [A; alpha \\nabla], \\nabla with Neumann boundary
+
+        \\nabla 1 = 0, so the gradient term of A^T A 1 is replaced by the diagonal of
+        \\nabla^T \\nabla: 2 per axis inside the image and 1 per axis on its boundary.
+        '''
+        ig = operator.domain_geometry()
+        d = operator.adjoint(operator.direct(ig.allocate(1)))
+        diag = numpy.zeros(ig.shape, dtype=numpy.float32)
+        for axis, n in enumerate(ig.shape):
+            if n < 2 or ig.dimension_labels[axis] == 'channel':
+                continue
+            w = numpy.full(n, 2, dtype=numpy.float32)
+            w[0] = w[-1] = 1
+            shape = [1] * len(ig.shape)
+            shape[axis] = n
+            diag += w.reshape(shape)
+        d += alpha ** 2 * diag
+        return cls(1. / d.maximum(eps))
+
+
+class FourierPreconditioner(object):
+
+    '''Ramp filter along the detector of parallel beam AcquisitionData
+
+    :param ag: AcquisitionGeometry
+    :param padding: zero padding factor of the detector before the rFFT
+    :param floor: value of the filter at zero frequency, relative to the first nonzero one,
+                  keeps the weight positive definite
+    '''
+
+    def __init__(self, ag, padding=2, floor=0.5):
+        self.ag = ag
+        labels = ag.dimension_labels
+        self.axis = [k for k in range(len(labels)) if labels[k] == 'horizontal'][0]
+        self.n = ag.shape[self.axis]
+        self.npad = int(2 ** numpy.ceil(numpy.log2(padding * self.n)))
+        freq = numpy.fft.rfftfreq(self.npad)
+        ramp = numpy.maximum(numpy.abs(freq), floor / self.npad)
+        # scaled so that A^T F A has eigenvalues close to 1 for unit pixels
+        self.filter = (2 * numpy.pi / len(ag.angles) * ramp).astype(numpy.float32)
+
+    def apply(self, x, out=None):
+        arr = x.as_array()
+        f = numpy.fft.rfft(arr, n=self.npad, axis=self.axis)
+        shape = [1] * arr.ndim
+        shape[self.axis] = -1
+        f *= self.filter.reshape(shape)
+        res = numpy.fft.irfft(f, n=self.npad, axis=self.axis)
+        res = numpy.take(res, numpy.arange(self.n), axis=self.axis).astype(numpy.float32)
+        if out is None:
+            out = x.copy()
+            out.fill(res)
+            return out
+        out.fill(res)
@@ -0,0 +1,249 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Progress previews of long CGLS/PDHG/FISTA runs.
+
+ProgressMonitor is the callback of Algorithm.run, called every
+update_objective_interval iterations with (iteration, objective, x):
+
+    monitor = ProgressMonitor(FileSink('run.log'), every=10, decimate=4)
+    algo.run(1000, verbose=False, callback=monitor)
+    monitor.close()
+
+On the calling thread it only copies a decimated 2D slice of x (a strided
+view, a few kB) and queues it with the objective. A background thread hands
+the updates to the sink, which writes a log and preview file, fills a
+queue.Queue or updates an ipywidgets Image, so the algorithm is not held up
+by rendering or I/O. When the sink falls behind, the oldest updates are
+dropped rather than blocking the run.
+"""
+
+from __future__ import print_function, division
+import io
+import os
+import queue
+import threading
+import time
+import numpy
+
+if __package__:
+    from .precision_utilities import _as_array
+else:
+    # loaded as a top-level module, e.g. python progress_utilities.py
+    from precision_utilities import _as_array
+
+
+def preview(x, slices=None, decimate=1):
+    '''Decimated 2D slice of a DataContainer or numpy array, as a small float32 copy
+
+    :param slices: index of every axis but the last two, defaults to their middle
+    :param decimate: stride along the last two axes
+    '''
+    arr = _as_array(x)
+    if slices is None:
+        slices = [n // 2 for n in arr.shape[:-2]]
+    view = arr[tuple(slices) + (slice(None, None, decimate), slice(None, None, decimate))]
+    return numpy.array(view, dtype=numpy.float32)
+
+
+class ProgressUpdate(object):
+
+    '''Iteration, objective, preview image and wall time of one update'''
+
+    __slots__ = ['iteration', 'objective', 'image', 'time']
+
+    def __init__(self, iteration, objective, image, time):
+        self.iteration = iteration
+        self.objective = objective
+        self.image = image
+        self.time = time
+
+
+class FileSink(object):
+
+    '''Appends "iteration time objective" lines to path and saves the latest preview next to it
+
+    :param path: log file
+    :param image_format: 'npy' or 'png' for the preview, None for no preview
+    '''
+
+    def __init__(self, path, image_format='npy'):
+        self.path = path
+        self.image_format = image_format
+        self._log = open(path, 'a')
+
+    def __call__(self, update):
+        self._log.write('{} {:.3f} {}\n'.format(update.iteration, update.time, update.objective))
+        self._log.flush()
+        if update.image is None or self.image_format is None:
+            return
+        fname = '{}_preview.{}'.format(os.path.splitext(self.path)[0], self.image_format)
+        # write then rename, readers never see a partial file
+        tmp = fname + '.tmp'
+        if self.image_format == 'npy':
+            with open(tmp, 'wb') as f:
+                numpy.save(f, update.image)
+        else:
+            import matplotlib.image
+            matplotlib.image.imsave(tmp, update.image, format='png')
+        os.replace(tmp, fname)
+
+    def close(self):
+        self._log.close()
+
+
+class QueueSink(object):
+
+    '''Puts every ProgressUpdate into a queue.Queue, e.g. for another thread or process'''
+
+    def __init__(self, q=None):
+        self.queue = queue.Queue() if q is None else q
+
+    def __call__(self, update):
+        self.queue.put(update)
+
+
+class WidgetSink(object):
+
+    '''Shows the preview in an ipywidgets.Image and the objective in an ipywidgets.Label
+
+    :param cmap: matplotlib colour map of the preview
+    :param minmax: fixed colour limits, None for the range of each preview
+    '''
+
+    def __init__(self, cmap='gray', minmax=None, width=300):
+        import ipywidgets as widgets
+        self.cmap = cmap
+        self.minmax = minmax
+        self.image = widgets.Image(format='png', width=width)
+        self.label = widgets.Label()
+        self.widget = widgets.VBox([self.label, self.image])
+
+    def _ipython_display_(self):
+        from IPython.display import display
+        display(self.widget)
+
+    def __call__(self, update):
+        self.label.value = 'Iteration {}, objective {}, {:.1f} s'.format(update.iteration, update.objective,
+                                                                          update.time)
+        if update.image is None:
+            return
+        import matplotlib.image
+        buf = io.BytesIO()
+        vmin, vmax = (None, None) if self.minmax is None else self.minmax
+        matplotlib.image.imsave(buf, update.image, cmap=self.cmap, vmin=vmin, vmax=vmax, format='png')
+        self.image.value = buf.getvalue()
+
+
+class ProgressMonitor(object):
+
+    '''Algorithm.run callback sending decimated previews and objectives to a sink
+
+    :param sink: callable taking a ProgressUpdate (FileSink, QueueSink, WidgetSink, ...)
+    :param every: forwards every k-th iteration, on top of update_objective_interval
+    :param decimate: stride of the preview along its two axes
+    :param slices: indices of the leading axes of the preview, e.g. [channel, vertical]
+    :param with_image: if False only the objective is forwarded
+    :param maxsize: updates waiting for the sink before the oldest are dropped
+    '''
+
+    def __init__(self, sink, every=1, decimate=1, slices=None, with_image=True, maxsize=4):
+        self.sink = sink
+        self.every = every
+        self.decimate = decimate
+        self.slices = slices
+        self.with_image = with_image
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._t0 = time.time()
+        self._thread = threading.Thread(target=self._worker, name='ProgressMonitor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __call__(self, iteration, objective, x):
+        if iteration % self.every != 0:
+            return
+        image = preview(x, self.slices, self.decimate) if self.with_image else None
+        update = ProgressUpdate(iteration, objective, image, time.time() - self._t0)
+        while True:
+            try:
+                self._queue.put_nowait(update)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def _worker(self):
+        while True:
+            update = self._queue.get()
+            if update is None:
+                break
+            try:
+                self.sink(update)
+            except Exception as e:
+                # monitoring must never stop the reconstruction
+                print('ProgressMonitor: sink failed at iteration {}: {}'.format(update.iteration, e))
+
+    def close(self):
+        '''Waits for the pending updates to reach the sink and stops the thread'''
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        if hasattr(self.sink, 'close'):
+            self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == '__main__':
+
+    from ccpi.framework import ImageGeometry, AcquisitionGeometry
+    from ccpi.astra.operators import AstraProjectorSimple
+    from ccpi.optimisation.algorithms import CGLS
+
+    N = 256
+    ig = ImageGeometry(voxel_num_x = N, voxel_num_y = N)
+    angles = numpy.linspace(0, numpy.pi, 180, dtype=numpy.float32)
+    ag = AcquisitionGeometry('parallel','2D', angles, N)
+    Aop = AstraProjectorSimple(ig, ag, 'cpu')
+    data = Aop.direct(ig.allocate('random'))
+
+    sink = QueueSink()
+    cgls = CGLS(x_init=ig.allocate(), operator=Aop, data=data)
+    cgls.max_iteration = 100
+    cgls.update_objective_interval = 10
+    with ProgressMonitor(sink, decimate=4) as monitor:
+        cgls.run(100, verbose=False, callback=monitor)
+
+    while not sink.queue.empty():
+        update = sink.queue.get()
+        print('Iteration {}: objective {}, preview {}'.format(update.iteration, update.objective,
+                                                              update.image.shape))
@@ -0,0 +1,231 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Matrix backed projectors for small and medium 2D problems on CPU.
+
+The ASTRA system matrix of a geometry is built once, converted to CSR and
+stored as .npz in a cache directory keyed by the geometry. MatrixProjector
+then applies direct and adjoint as sparse mat-vecs, split over row blocks on
+a thread pool, instead of calling the ASTRA CPU projector every iteration.
+"""
+
+from __future__ import print_function, division
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import tempfile
+import numpy
+import scipy.sparse
+
+from ccpi.optimisation.operators import LinearOperator
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ccpi', 'matrix_cache')
+
+
+def geometry_key(ig, ag, projector='line'):
+    '''Hash identifying the system matrix of an ImageGeometry/AcquisitionGeometry pair'''
+    h = hashlib.sha1()
+    params = (ag.geom_type, ag.dimension, ag.pixel_num_h, ag.pixel_size_h, ag.pixel_num_v,
+              ag.pixel_size_v, ag.dist_source_center, ag.dist_center_detector,
+              ig.voxel_num_x, ig.voxel_num_y, ig.voxel_num_z,
+              ig.voxel_size_x, ig.voxel_size_y, ig.voxel_size_z, projector)
+    h.update(repr(params).encode('utf-8'))
+    h.update(numpy.ascontiguousarray(ag.angles, dtype=numpy.float64).tobytes())
+    return h.hexdigest()
+
+
+def astra_system_matrix(ig, ag, projector='line'):
+    '''Builds the ASTRA system matrix of a 2D geometry as scipy CSR'''
+    if ag.dimension != '2D':
+        raise ValueError('System matrices are only built for 2D geometries, got {}'.format(ag.dimension))
+    import astra
+
+    vol_geom = astra.create_vol_geom(ig.voxel_num_y, ig.voxel_num_x)
+    if ag.geom_type == 'parallel':
+        proj_geom = astra.create_proj_geom('parallel', ag.pixel_size_h / ig.voxel_size_x,
+                                           ag.pixel_num_h, ag.angles)
+    elif ag.geom_type == 'cone':
+        proj_geom = astra.create_proj_geom('fanflat', ag.pixel_size_h / ig.voxel_size_x,
+                                           ag.pixel_num_h, ag.angles,
+                                           ag.dist_source_center / ig.voxel_size_x,
+                                           ag.dist_center_detector / ig.voxel_size_x)
+        if projector == 'line':
+            projector = 'line_fanflat'
+    else:
+        raise ValueError('Unsupported geometry ', ag.geom_type)
+
+    proj_id = astra.create_projector(projector, proj_geom, vol_geom)
+    matrix_id = astra.projector.matrix(proj_id)
+    try:
+        # the matrix is expressed in pixel units, scale to the voxel size
+        A = scipy.sparse.csr_matrix(astra.matrix.get(matrix_id), dtype=numpy.float32)
+        A *= ig.voxel_size_x
+    finally:
+        astra.matrix.delete(matrix_id)
+        astra.projector.delete(proj_id)
+    return A
+
+
+def cached_system_matrix(ig, ag, projector='line', cache_dir=None):
+    '''System matrix of the geometry, loaded from cache_dir or built and saved there'''
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    fname = os.path.join(cache_dir, 'system_matrix_{}.npz'.format(geometry_key(ig, ag, projector)))
+    if os.path.exists(fname):
+        return scipy.sparse.load_npz(fname).tocsr()
+    A = astra_system_matrix(ig, ag, projector)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # write then rename, an interrupted write never leaves a truncated matrix in the cache
+    fd, tmp = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+    os.close(fd)
+    try:
+        scipy.sparse.save_npz(tmp, A)
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return A
+
+
+def row_blocks(A, nblocks):
+    '''Splits the CSR matrix A into nblocks row blocks, returns [(start, stop, block)]'''
+    edges = numpy.linspace(0, A.shape[0], nblocks + 1).astype(int)
+    return [(edges[i], edges[i + 1], A[edges[i]:edges[i + 1]])
+            for i in range(nblocks) if edges[i + 1] > edges[i]]
+
+
+def threaded_matvec(blocks, x, out, pool=None):
+    '''out = A x where A is given by its row blocks'''
+    def work(block):
+        start, stop, Ab = block
+        out[start:stop] = Ab.dot(x)
+    if pool is None or len(blocks) == 1:
+        for block in blocks:
+            work(block)
+    else:
+        list(pool.map(work, blocks))
+    return out
+
+
+class MatrixProjector(LinearOperator):
+
+    '''Projector applying a cached CSR system matrix
+
+    :param ig: ImageGeometry (2D)
+    :param ag: AcquisitionGeometry (2D, parallel or cone)
+    :param projector: ASTRA projector type used to build the matrix
+    :param cache_dir: directory of the .npz cache, None for ~/.ccpi/matrix_cache
+    :param num_threads: number of threads for the mat-vecs, defaults to os.cpu_count()
+    :param matrix: optional precomputed sparse matrix, skips ASTRA and the cache
+
+    Call close() (or use it as a context manager) to stop the thread pool.
+    '''
+
+    def __init__(self, ig, ag, projector='line', cache_dir=None, num_threads=None, matrix=None):
+        super(MatrixProjector, self).__init__()
+        self.ig = ig
+        self.ag = ag
+        if matrix is None:
+            matrix = cached_system_matrix(ig, ag, projector, cache_dir)
+        self.A = scipy.sparse.csr_matrix(matrix, dtype=numpy.float32)
+        # keep the transpose in CSR so that the adjoint also splits over rows
+        self.AT = self.A.T.tocsr()
+
+        if num_threads is None:
+            num_threads = os.cpu_count() or 1
+        self.num_threads = num_threads
+        self._pool = ThreadPoolExecutor(max_workers=num_threads) if num_threads > 1 else None
+        self._direct_blocks = row_blocks(self.A, num_threads)
+        self._adjoint_blocks = row_blocks(self.AT, num_threads)
+
+    def direct(self, x, out=None):
+        xv = numpy.ascontiguousarray(x.as_array(), dtype=numpy.float32).ravel()
+        res = numpy.empty(self.A.shape[0], dtype=numpy.float32)
+        threaded_matvec(self._direct_blocks, xv, res, self._pool)
+        if out is None:
+            out = self.range_geometry().allocate()
+            out.fill(res.reshape(out.shape))
+            return out
+        else:
+            out.fill(res.reshape(out.shape))
+
+    def adjoint(self, x, out=None):
+        xv = numpy.ascontiguousarray(x.as_array(), dtype=numpy.float32).ravel()
+        res = numpy.empty(self.AT.shape[0], dtype=numpy.float32)
+        threaded_matvec(self._adjoint_blocks, xv, res, self._pool)
+        if out is None:
+            out = self.domain_geometry().allocate()
+            out.fill(res.reshape(out.shape))
+            return out
+        else:
+            out.fill(res.reshape(out.shape))
+
+    def domain_geometry(self):
+        return self.ig
+
+    def range_geometry(self):
+        return self.ag
+
+    def close(self):
+        '''Stops the thread pool, later mat-vecs run on the calling thread'''
+        pool, self._pool = getattr(self, '_pool', None), None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+
+if __name__ == '__main__':
+
+    from ccpi.framework import ImageGeometry, AcquisitionGeometry
+    from ccpi.optimisation.algorithms import CGLS
+    from ccpi.astra.operators import AstraProjectorSimple
+    import timeit
+
+    N = 128
+    ig = ImageGeometry(voxel_num_x = N, voxel_num_y = N)
+    angles = numpy.linspace(0, numpy.pi, 180, dtype=numpy.float32)
+    ag = AcquisitionGeometry('parallel','2D', angles, N)
+
+    Aop = AstraProjectorSimple(ig, ag, 'cpu')
+    Mop = MatrixProjector(ig, ag)
+
+    x = ig.allocate('random')
+    for name, op in [('ASTRA cpu', Aop), ('CSR matrix', Mop)]:
+        t0 = timeit.default_timer()
+        for i in range(20):
+            op.adjoint(op.direct(x))
+        print('{}: {:.4f} s per direct/adjoint'.format(name, (timeit.default_timer() - t0) / 20))
+
+    sin = Aop.direct(x)
+    cgls = CGLS(x_init=ig.allocate(), operator=Mop, data=sin)
+    cgls.max_iteration = 100
+    cgls.run(100, verbose=False)
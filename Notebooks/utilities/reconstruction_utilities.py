@@ -0,0 +1,846 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Reconstruction algorithms that extend the ccpi.optimisation.algorithms set.
+
+BlockCGLS solves K least squares problems that share one operator,
+
+             min_{u_k} || A u_k - g_k ||_{2}^{2},   k = 1, ..., K
+
+e.g. the slices of a dataset, the frames of a dynamic scan or the channels
+of a spectral scan. The K iterates are stacked along a leading axis, every
+projector call processes the whole stack and the CG scalars are kept per
+column. Converged columns are frozen and dropped from the projector calls.
+
+OSSIRT, OSFISTA and SPDHG split the projection angles into subsets, each with
+its own AcquisitionGeometry, data and projector (see split_acquisition_data),
+and sweep the subsets once per epoch. One iteration is one subset update, so
+an epoch costs about the same projector work as a single full-batch iteration.
+
+PCGLS and PSIRT accept an image space preconditioner C and a data space weight W
+(see preconditioner_utilities) and solve the weighted normal equations
+
+             A^T W A x = A^T W b
+
+RegularisedCGLS solves min ||A x - b||^2 + alpha^2 ||\nabla x||^2 (or any column
+BlockOperator least squares problem) with conjugate gradients on the fused
+normal equations of block_utilities.NormalOperator, without the stacked
+residual or the zero data block.
+
+BacktrackingFISTA is FISTA with the backtracking line search of Beck and
+Teboulle for smooth terms without a known Lipschitz constant.
+"""
+
+from __future__ import print_function, division
+import numpy
+
+from ccpi.optimisation.algorithms import Algorithm
+if __package__:
+    from .precision_utilities import _as_array
+else:
+    # loaded as a top-level module, e.g. python reconstruction_utilities.py
+    from precision_utilities import _as_array
+
+
+class StackedOperator(object):
+
+    '''Applies a LinearOperator to a numpy stack with a leading batch axis
+
+    If the operator holds a sparse system matrix A (see projector_utilities.MatrixProjector)
+    the stack is processed with a single sparse matrix - dense matrix product, otherwise
+    the operator is applied to each item through reusable containers.
+    '''
+
+    def __init__(self, operator):
+        self.operator = operator
+        self.domain_shape = tuple(operator.domain_geometry().shape)
+        self.range_shape = tuple(operator.range_geometry().shape)
+        self.A = getattr(operator, 'A', None)
+        self.AT = getattr(operator, 'AT', None)
+        if self.A is not None and self.AT is None:
+            self.AT = self.A.T.tocsr()
+        self._x = None
+        self._y = None
+
+    def _containers(self):
+        if self._x is None:
+            self._x = self.operator.domain_geometry().allocate()
+            self._y = self.operator.range_geometry().allocate()
+        return self._x, self._y
+
+    def direct(self, X, out):
+        if self.A is not None:
+            out.reshape(X.shape[0], -1)[...] = self.A.dot(X.reshape(X.shape[0], -1).T).T
+            return out
+        x, y = self._containers()
+        for k in range(X.shape[0]):
+            x.fill(X[k])
+            self.operator.direct(x, out=y)
+            out[k] = y.as_array()
+        return out
+
+    def adjoint(self, Y, out):
+        if self.A is not None:
+            out.reshape(Y.shape[0], -1)[...] = self.AT.dot(Y.reshape(Y.shape[0], -1).T).T
+            return out
+        x, y = self._containers()
+        for k in range(Y.shape[0]):
+            y.fill(Y[k])
+            self.operator.adjoint(y, out=x)
+            out[k] = x.as_array()
+        return out
+
+
+def _column_dot(X, Y):
+    # per column inner products accumulated in float64
+    return numpy.einsum('ki,ki->k', X.reshape(X.shape[0], -1), Y.reshape(Y.shape[0], -1),
+                        dtype=numpy.float64)
+
+
+class BlockCGLS(Algorithm):
+
+    '''CGLS for K right hand sides sharing one operator
+
+    :param operator: LinearOperator A
+    :param data: list of AcquisitionData or numpy array of shape (K,) + range shape
+    :param x_init: optional list/stack of initial images, defaults to zeros
+    :param tolerance: a column stops once ||A^T r_k|| < tolerance * ||A^T r_k^0||
+    '''
+
+    def __init__(self, **kwargs):
+        super(BlockCGLS, self).__init__()
+        self.tolerance = kwargs.get('tolerance', 1e-6)
+        if kwargs.get('operator', None) is not None and kwargs.get('data', None) is not None:
+            print(self.__class__.__name__, "set_up called from creator")
+            self.set_up(operator=kwargs['operator'], data=kwargs['data'],
+                        x_init=kwargs.get('x_init', None))
+
+    def set_up(self, operator, data, x_init=None):
+        self.operator = operator
+        self.stacked = StackedOperator(operator)
+
+        if isinstance(data, (list, tuple)):
+            data = numpy.stack([_as_array(d) for d in data])
+        self.data = numpy.asarray(data, dtype=numpy.float32)
+        K = self.data.shape[0]
+
+        self.x = numpy.zeros((K,) + self.stacked.domain_shape, dtype=numpy.float32)
+        if x_init is not None:
+            if isinstance(x_init, (list, tuple)):
+                x_init = numpy.stack([_as_array(x) for x in x_init])
+            self.x[...] = x_init
+
+        self.r = self.data.copy()
+        if x_init is not None:
+            self.r -= self.stacked.direct(self.x, numpy.empty_like(self.data))
+        self.s = self.stacked.adjoint(self.r, numpy.empty_like(self.x))
+        self.p = self.s.copy()
+        self.q = numpy.empty_like(self.data)
+
+        self.gamma = _column_dot(self.s, self.s)
+        self.norms0 = numpy.sqrt(self.gamma)
+        self.norms = self.norms0.copy()
+        self.active = self.norms0 > 0
+        self.configured = True
+
+    def update(self):
+        idx = numpy.flatnonzero(self.active)
+        if idx.size == 0:
+            return
+        p = self.p[idx]
+        q = self.stacked.direct(p, self.q[:idx.size])
+
+        delta = _column_dot(q, q)
+        alpha = numpy.where(delta > 0, self.gamma[idx] / numpy.where(delta > 0, delta, 1), 0)
+        shape = (-1,) + (1,) * (self.x.ndim - 1)
+        self.x[idx] += (alpha.reshape(shape) * p).astype(self.x.dtype)
+        r = self.r[idx]
+        r -= (alpha.reshape(shape) * q).astype(r.dtype)
+        self.r[idx] = r
+
+        s = self.stacked.adjoint(r, numpy.empty_like(p))
+        gamma = _column_dot(s, s)
+        beta = gamma / numpy.where(self.gamma[idx] > 0, self.gamma[idx], 1)
+        p *= beta.reshape(shape).astype(p.dtype)
+        p += s
+        self.p[idx] = p
+        self.s[idx] = s
+        self.gamma[idx] = gamma
+        self.norms[idx] = numpy.sqrt(gamma)
+
+        # freeze the columns that reached the tolerance
+        self.active[idx] = self.norms[idx] > self.tolerance * self.norms0[idx]
+
+    def update_objective(self):
+        self.residuals = _column_dot(self.r, self.r)
+        a = self.residuals.sum()
+        if numpy.isnan(a):
+            raise StopIteration()
+        self.loss.append(a)
+
+    def should_stop(self):
+        return self.max_iteration_stop_cryterion() or not self.active.any()
+
+    def get_outputs(self):
+        '''The K solutions as ImageData'''
+        out = []
+        for k in range(self.x.shape[0]):
+            u = self.operator.domain_geometry().allocate()
+            u.fill(self.x[k])
+            out.append(u)
+        return out
+
+
+def subset_indices(num_angles, num_subsets, method='interleaved'):
+    '''Angle indices of each subset
+
+    :param method: 'interleaved' takes every num_subsets-th angle, 'contiguous' takes blocks
+    '''
+    if method == 'interleaved':
+        return [numpy.arange(s, num_angles, num_subsets) for s in range(num_subsets)]
+    elif method == 'contiguous':
+        return numpy.array_split(numpy.arange(num_angles), num_subsets)
+    raise ValueError('Unsupported subset method ', method)
+
+
+def subset_geometry(ag, indices):
+    '''AcquisitionGeometry restricted to the angles at indices'''
+    from ccpi.framework import AcquisitionGeometry
+    return AcquisitionGeometry(ag.geom_type, ag.dimension, numpy.asarray(ag.angles)[indices],
+                               ag.pixel_num_h, ag.pixel_size_h, ag.pixel_num_v, ag.pixel_size_v,
+                               ag.dist_source_center, ag.dist_center_detector, ag.channels,
+                               dimension_labels=[ag.dimension_labels[i] for i in range(len(ag.dimension_labels))])
+
+
+def split_acquisition_data(data, num_subsets, ig=None, projector_factory=None, method='interleaved'):
+    '''Splits AcquisitionData into angle subsets
+
+    :param data: AcquisitionData
+    :param num_subsets: number of subsets
+    :param ig: ImageGeometry, needed to create the projectors
+    :param projector_factory: callable (ig, ag) -> LinearOperator, defaults to the ASTRA cpu projector
+    :returns: (subset_data, subset_operators), operators is None if ig is None
+    '''
+    ag = data.geometry
+    axis = data.get_dimension_axis('angle')
+    subset_data = []
+    operators = []
+    if ig is not None and projector_factory is None:
+        from ccpi.astra.operators import AstraProjectorSimple
+        projector_factory = lambda ig, ag: AstraProjectorSimple(ig, ag, 'cpu')
+    for idx in subset_indices(len(ag.angles), num_subsets, method):
+        sub_ag = subset_geometry(ag, idx)
+        sub = sub_ag.allocate()
+        sub.fill(numpy.take(data.as_array(), idx, axis=axis))
+        subset_data.append(sub)
+        if ig is not None:
+            operators.append(projector_factory(ig, sub_ag))
+    return subset_data, (operators if ig is not None else None)
+
+
+class OSSIRT(Algorithm):
+
+    '''Ordered subsets SIRT
+
+    x = x + relax * C_s A_s^T R_s (b_s - A_s x), R_s = 1 / A_s 1, C_s = 1 / A_s^T 1
+
+    :param x_init: initial image
+    :param operators: list of subset operators A_s
+    :param data: list of subset data b_s
+    :param relaxation: relaxation parameter
+    :param constraint: optional function with a proximal, e.g. IndicatorBox(lower=0)
+    '''
+
+    def __init__(self, **kwargs):
+        super(OSSIRT, self).__init__()
+        if kwargs.get('operators', None) is not None and kwargs.get('data', None) is not None:
+            print(self.__class__.__name__, "set_up called from creator")
+            self.set_up(x_init=kwargs['x_init'], operators=kwargs['operators'], data=kwargs['data'],
+                        relaxation=kwargs.get('relaxation', 1.), constraint=kwargs.get('constraint', None))
+
+    def set_up(self, x_init, operators, data, relaxation=1., constraint=None):
+        self.x = x_init.copy()
+        self.operators = operators
+        self.data = data
+        self.relaxation = relaxation
+        self.constraint = constraint
+        self.num_subsets = len(operators)
+
+        self.R = []
+        self.C = []
+        for A in operators:
+            r = A.direct(A.domain_geometry().allocate(1))
+            self.R.append(1. / r.maximum(1e-8))
+            c = A.adjoint(A.range_geometry().allocate(1))
+            self.C.append(relaxation / c.maximum(1e-8))
+        self.r = [A.range_geometry().allocate() for A in operators]
+        self.tmp = self.x.copy()
+        self.configured = True
+
+    def update(self):
+        s = self.iteration % self.num_subsets
+        A = self.operators[s]
+        A.direct(self.x, out=self.r[s])
+        self.data[s].subtract(self.r[s], out=self.r[s])
+        self.r[s] *= self.R[s]
+        A.adjoint(self.r[s], out=self.tmp)
+        self.tmp *= self.C[s]
+        self.x += self.tmp
+        if self.constraint is not None:
+            self.constraint.proximal(self.x, 1., out=self.x)
+
+    def update_objective(self):
+        self.loss.append(sum((A.direct(self.x) - b).squared_norm()
+                             for A, b in zip(self.operators, self.data)))
+
+
+class OSFISTA(Algorithm):
+
+    '''Ordered subsets FISTA for min_x 0.5 * sum_s ||A_s x - b_s||^2 + g(x)
+
+    Each iteration is a proximal gradient step on one subset, with the subset gradient
+    scaled by the number of subsets and step size 1 / (num_subsets * max_s ||A_s||^2).
+    The FISTA momentum is applied once per epoch, after the sweep over the subsets:
+    momentum on every subset step amplifies the subset gradient errors and diverges.
+
+    :param x_init: initial image
+    :param operators: list of subset operators A_s
+    :param data: list of subset data b_s
+    :param g: function with a proximal, defaults to ZeroFunction
+    '''
+
+    def __init__(self, **kwargs):
+        super(OSFISTA, self).__init__()
+        if kwargs.get('operators', None) is not None and kwargs.get('data', None) is not None:
+            print(self.__class__.__name__, "set_up called from creator")
+            self.set_up(x_init=kwargs['x_init'], operators=kwargs['operators'], data=kwargs['data'],
+                        g=kwargs.get('g', None))
+
+    def set_up(self, x_init, operators, data, g=None):
+        if g is None:
+            from ccpi.optimisation.functions import ZeroFunction
+            g = ZeroFunction()
+        self.operators = operators
+        self.data = data
+        self.g = g
+        self.num_subsets = len(operators)
+        from .lipschitz_utilities import cached_norm
+        L = self.num_subsets * max(cached_norm(A) for A in operators) ** 2
+        self.invL = 1. / L
+
+        self.x = x_init.copy()
+        self.x_old = x_init.copy()
+        self.y = x_init.copy()
+        self.z = x_init.copy()
+        self.u = x_init.copy()
+        self.r = [A.range_geometry().allocate() for A in operators]
+        self.t = 1.
+        self.configured = True
+
+    def update(self):
+        s = self.iteration % self.num_subsets
+        if s == 0:
+            self.z.fill(self.y)
+
+        # proximal gradient step on subset s
+        A = self.operators[s]
+        A.direct(self.z, out=self.r[s])
+        self.r[s] -= self.data[s]
+        A.adjoint(self.r[s], out=self.u)
+        self.u *= - self.num_subsets * self.invL
+        self.u += self.z
+        self.g.proximal(self.u, self.invL, out=self.z)
+
+        # momentum at the end of the epoch
+        if s == self.num_subsets - 1:
+            self.x_old.fill(self.x)
+            self.x.fill(self.z)
+            t_old = self.t
+            self.t = 0.5 * (1 + numpy.sqrt(1 + 4 * t_old ** 2))
+            self.x.subtract(self.x_old, out=self.y)
+            self.y *= (t_old - 1) / self.t
+            self.y += self.x
+
+    def update_objective(self):
+        self.loss.append(0.5 * sum((A.direct(self.x) - b).squared_norm()
+                                   for A, b in zip(self.operators, self.data)) + self.g(self.x))
+
+
+class SPDHG(Algorithm):
+
+    '''Stochastic PDHG (Chambolle, Ehrhardt, Richtarik, Schoenlieb 2018)
+
+    min_x sum_i f_i(A_i x) + g(x), one randomly chosen dual block i is updated per iteration.
+
+    :param f: list of functions f_i, e.g. 0.5 * L2NormSquared(b=b_i) or KullbackLeibler(b_i)
+    :param g: function with a proximal
+    :param operators: list of operators A_i
+    :param x_init: optional initial image
+    :param prob: probabilities of choosing each block, uniform by default
+    :param gamma: balance between the primal and dual step sizes
+    :param seed: seed of the block sampling
+    '''
+
+    def __init__(self, **kwargs):
+        super(SPDHG, self).__init__()
+        if kwargs.get('operators', None) is not None and kwargs.get('f', None) is not None:
+            print(self.__class__.__name__, "set_up called from creator")
+            self.set_up(f=kwargs['f'], g=kwargs['g'], operators=kwargs['operators'],
+                        x_init=kwargs.get('x_init', None), prob=kwargs.get('prob', None),
+                        gamma=kwargs.get('gamma', 1.), seed=kwargs.get('seed', None))
+
+    def set_up(self, f, g, operators, x_init=None, prob=None, gamma=1., seed=None):
+        self.f = f
+        self.g = g
+        self.operators = operators
+        n = len(operators)
+        self.prob = numpy.ones(n) / n if prob is None else numpy.asarray(prob, dtype=numpy.float64)
+        self.rng = numpy.random.RandomState(seed)
+
+        rho = 0.99
+        from .lipschitz_utilities import cached_norm
+        norms = [cached_norm(A) for A in operators]
+        self.sigma = [gamma * rho / nA for nA in norms]
+        self.tau = min(rho * p / (gamma * nA) for p, nA in zip(self.prob, norms))
+
+        ig = operators[0].domain_geometry()
+        self.x = ig.allocate() if x_init is None else x_init.copy()
+        self.x_tmp = self.x.copy()
+        self.y = [A.range_geometry().allocate() for A in operators]
+        self.y_old = [A.range_geometry().allocate() for A in operators]
+        self.z = ig.allocate()
+        self.zbar = ig.allocate()
+        self.dz = ig.allocate()
+        self.configured = True
+
+    def update(self):
+        # primal step
+        self.zbar.multiply(self.tau, out=self.x_tmp)
+        self.x.subtract(self.x_tmp, out=self.x_tmp)
+        self.g.proximal(self.x_tmp, self.tau, out=self.x)
+
+        # dual step on one block
+        i = self.rng.choice(len(self.operators), p=self.prob)
+        A = self.operators[i]
+        self.y_old[i].fill(self.y[i])
+        A.direct(self.x, out=self.y[i])
+        self.y[i] *= self.sigma[i]
+        self.y[i] += self.y_old[i]
+        self.f[i].proximal_conjugate(self.y[i], self.sigma[i], out=self.y[i])
+
+        # z = A^T y, extrapolated with 1 / p_i
+        self.y_old[i].subtract(self.y[i], out=self.y_old[i])
+        A.adjoint(self.y_old[i], out=self.dz)
+        self.z -= self.dz
+        self.z.subtract(self.dz * (1. / self.prob[i]), out=self.zbar)
+
+    def update_objective(self):
+        self.loss.append(sum(fi(A.direct(self.x)) for fi, A in zip(self.f, self.operators)) + self.g(self.x))
+
+
+class PCGLS(Algorithm):
+
+    '''Preconditioned CGLS: conjugate gradients on A^T W A x = A^T W b with preconditioner C
+
+    :param x_init: initial image
+    :param operator: LinearOperator A, e.g. a projector or BlockOperator(A, alpha * Gradient)
+    :param data: data b
+    :param preconditioner: object with apply(x, out) in image space, C, None for the identity
+    :param weight: object with apply(y, out) in data space, W, None for the identity
+    :param tolerance: stops once ||A^T W r|| < tolerance * ||A^T W r_0||
+    '''
+
+    def __init__(self, **kwargs):
+        super(PCGLS, self).__init__()
+        self.tolerance = kwargs.get('tolerance', 1e-6)
+        if kwargs.get('operator', None) is not None and kwargs.get('data', None) is not None:
+            print(self.__class__.__name__, "set_up called from creator")
+            self.set_up(x_init=kwargs['x_init'], operator=kwargs['operator'], data=kwargs['data'],
+                        preconditioner=kwargs.get('preconditioner', None),
+                        weight=kwargs.get('weight', None))
+
+    def set_up(self, x_init, operator, data, preconditioner=None, weight=None):
+        self.operator = operator
+        self.data = data
+        self.preconditioner = preconditioner
+        self.weight = weight
+
+        self.x = x_init.copy()
+        self.r = data - operator.direct(self.x)
+        self.wr = self.r.copy()
+        self.q = operator.range_geometry().allocate()
+        self.wq = self.q.copy()
+        self.s = operator.domain_geometry().allocate()
+        self.z = self.s.copy()
+
+        self._weighted(self.r, self.wr)
+        operator.adjoint(self.wr, out=self.s)
+        self._precondition(self.s, self.z)
+        self.p = self.z.copy()
+
+        self.gamma = self.s.dot(self.z)
+        self.norms0 = self.s.norm()
+        self.norms = self.norms0
+        self.configured = True
+
+    def _weighted(self, y, out):
+        if self.weight is None:
+            out.fill(y)
+        else:
+            self.weight.apply(y, out=out)
+
+    def _precondition(self, x, out):
+        if self.preconditioner is None:
+            out.fill(x)
+        else:
+            self.preconditioner.apply(x, out=out)
+
+    def update(self):
+        self.operator.direct(self.p, out=self.q)
+        self._weighted(self.q, self.wq)
+        delta = self.q.dot(self.wq)
+        alpha = self.gamma / delta
+
+        self.x += alpha * self.p
+        self.r -= alpha * self.q
+        self.wr -= alpha * self.wq
+
+        self.operator.adjoint(self.wr, out=self.s)
+        self._precondition(self.s, self.z)
+        gamma = self.s.dot(self.z)
+        beta = gamma / self.gamma
+        self.gamma = gamma
+        self.p *= beta
+        self.p += self.z
+        self.norms = self.s.norm()
+
+    def update_objective(self):
+        a = self.r.dot(self.wr)
+        if numpy.isnan(a):
+            raise StopIteration()
+        self.loss.append(a)
+
+    def should_stop(self):
+        return self.max_iteration_stop_cryterion() or self.norms <= self.tolerance * self.norms0
+
+
+class PSIRT(Algorithm):
+
+    '''Preconditioned SIRT (Landweber) iteration x = x + step * C A^T W (b - A x)
+
+    With C and W the SIRT diagonals this is SIRT. With W a FourierPreconditioner it is an
+    FBP-like iteration. The step is relaxation / lambda_max(C A^T W A), with lambda_max
+    estimated by power iteration at set up.
+
+    :param x_init: initial image
+    :param operator: LinearOperator A
+    :param data: data b
+    :param preconditioner: C, defaults to 1 / A^T 1
+    :param weight: W, defaults to 1 / A 1
+    :param relaxation: relaxation parameter in (0, 2)
+    :param constraint: optional function with a proximal, e.g. IndicatorBox(lower=0)
+    '''
+
+    def __init__(self, **kwargs):
+        super(PSIRT, self).__init__()
+        if kwargs.get('operator', None) is not None and kwargs.get('data', None) is not None:
+            print(self.__class__.__name__, "set_up called from creator")
+            self.set_up(x_init=kwargs['x_init'], operator=kwargs['operator'], data=kwargs['data'],
+                        preconditioner=kwargs.get('preconditioner', None),
+                        weight=kwargs.get('weight', None),
+                        relaxation=kwargs.get('relaxation', 1.),
+                        constraint=kwargs.get('constraint', None))
+
+    def set_up(self, x_init, operator, data, preconditioner=None, weight=None, relaxation=1.,
+               constraint=None, power_iterations=10):
+        from .preconditioner_utilities import DiagonalPreconditioner
+        if preconditioner is None:
+            d = operator.adjoint(operator.range_geometry().allocate(1))
+            preconditioner = DiagonalPreconditioner(1. / d.maximum(1e-8))
+        if weight is None:
+            weight = DiagonalPreconditioner.row_sum(operator)
+        self.operator = operator
+        self.data = data
+        self.preconditioner = preconditioner
+        self.weight = weight
+        self.constraint = constraint
+
+        self.x = x_init.copy()
+        self.r = operator.range_geometry().allocate()
+        self.tmp = operator.domain_geometry().allocate()
+
+        # power iteration for the largest eigenvalue of C A^T W A
+        v = operator.domain_geometry().allocate('random')
+        lam = 1.
+        for i in range(power_iterations):
+            self._apply_normal(v, self.tmp)
+            lam = self.tmp.norm() / v.norm()
+            v.fill(self.tmp / self.tmp.norm())
+        self.step = relaxation / lam
+        self.configured = True
+
+    def _apply_normal(self, x, out):
+        self.operator.direct(x, out=self.r)
+        self.weight.apply(self.r, out=self.r)
+        self.operator.adjoint(self.r, out=out)
+        self.preconditioner.apply(out, out=out)
+
+    def update(self):
+        self.operator.direct(self.x, out=self.r)
+        self.data.subtract(self.r, out=self.r)
+        self.weight.apply(self.r, out=self.r)
+        self.operator.adjoint(self.r, out=self.tmp)
+        self.preconditioner.apply(self.tmp, out=self.tmp)
+        self.tmp *= self.step
+        self.x += self.tmp
+        if self.constraint is not None:
+            self.constraint.proximal(self.x, 1., out=self.x)
+
+    def update_objective(self):
+        self.loss.append((self.operator.direct(self.x) - self.data).squared_norm())
+
+
+class RegularisedCGLS(Algorithm):
+
+    '''CGLS for \sum_i w_i ||K_i x - b_i||^2 on the fused normal equations
+
+    :param x_init: initial image
+    :param operator: column BlockOperator, e.g. BlockOperator(A, alpha * Gradient), list of
+                     operators or a NormalOperator
+    :param data: BlockDataContainer, list with None for the zero blocks, or only b_0
+    :param tolerance: stops once ||K^T (b - K x)|| < tolerance * ||K^T (b - K x_0)||
+    '''
+
+    def __init__(self, **kwargs):
+        super(RegularisedCGLS, self).__init__()
+        self.tolerance = kwargs.get('tolerance', 1e-6)
+        if kwargs.get('operator', None) is not None and kwargs.get('data', None) is not None:
+            print(self.__class__.__name__, "set_up called from creator")
+            self.set_up(x_init=kwargs['x_init'], operator=kwargs['operator'], data=kwargs['data'])
+
+    def set_up(self, x_init, operator, data):
+        from .block_utilities import NormalOperator, normal_rhs, split_block_data
+
+        self.normal = operator if isinstance(operator, NormalOperator) else NormalOperator(operator)
+        self.data = split_block_data(data, len(self.normal.operators))
+
+        self.x = x_init.copy()
+        self.r = normal_rhs(self.normal, self.data)
+        self.q = self.normal.direct(self.x)
+        self.r -= self.q
+        self.p = self.r.copy()
+        self.tmp = self.r.copy()
+
+        self.gamma = self.r.squared_norm()
+        self.norms0 = self.gamma ** 0.5
+        self.norms = self.norms0
+        self.configured = True
+
+    def update(self):
+        self.normal.direct(self.p, out=self.q)
+        alpha = self.gamma / self.p.dot(self.q)
+
+        self.p.multiply(alpha, out=self.tmp)
+        self.x += self.tmp
+        self.q.multiply(alpha, out=self.tmp)
+        self.r -= self.tmp
+
+        gamma = self.r.squared_norm()
+        beta = gamma / self.gamma
+        self.gamma = gamma
+        self.p *= beta
+        self.p += self.r
+        self.norms = gamma ** 0.5
+
+    def update_objective(self):
+        a = sum(self.normal.residual_norms(self.x, self.data))
+        if numpy.isnan(a):
+            raise StopIteration()
+        self.loss.append(a)
+
+    def should_stop(self):
+        return self.max_iteration_stop_cryterion() or self.norms <= self.tolerance * self.norms0
+
+
+class BacktrackingFISTA(Algorithm):
+
+    '''FISTA for min_x f(x) + g(x) with a backtracking estimate of the Lipschitz constant of f
+
+    Every iteration L is multiplied by eta until
+    f(x) <= f(y) + <grad f(y), x - y> + L/2 ||x - y||^2, so L only grows and
+    stays within eta of the smallest constant accepted so far.
+
+    :param x_init: initial image
+    :param f: smooth function with gradient(x, out)
+    :param g: function with a proximal, defaults to ZeroFunction
+    :param L: initial estimate, defaults to 1
+    :param eta: growth factor of L, > 1
+    :param backtracking: if False, runs plain FISTA with f.L (see lipschitz_utilities.LeastSquares)
+    :param rtol: relative tolerance of the sufficient decrease test
+    '''
+
+    def __init__(self, **kwargs):
+        super(BacktrackingFISTA, self).__init__()
+        if kwargs.get('x_init', None) is not None and kwargs.get('f', None) is not None:
+            print(self.__class__.__name__, "set_up called from creator")
+            self.set_up(x_init=kwargs['x_init'], f=kwargs['f'], g=kwargs.get('g', None),
+                        L=kwargs.get('L', None), eta=kwargs.get('eta', 2.),
+                        backtracking=kwargs.get('backtracking', True), rtol=kwargs.get('rtol', 1e-6))
+
+    def set_up(self, x_init, f, g=None, L=None, eta=2., backtracking=True, rtol=1e-6):
+        if g is None:
+            from ccpi.optimisation.functions import ZeroFunction
+            g = ZeroFunction()
+        if eta <= 1:
+            raise ValueError('eta must be larger than 1, got {}'.format(eta))
+        self.f = f
+        self.g = g
+        self.eta = eta
+        self.backtracking = backtracking
+        self.rtol = rtol
+        if L is None:
+            L = 1. if backtracking else f.L
+        self.L = L
+        self.backtracks = 0
+
+        self.x = x_init.copy()
+        self.x_old = x_init.copy()
+        self.y = x_init.copy()
+        self.u = x_init.copy()
+        self.grad = x_init.copy()
+        self.d = x_init.copy()
+        self.t = 1.
+        self.configured = True
+
+    def _step(self):
+        # x = prox_{g/L}(y - grad / L)
+        self.grad.multiply(-1. / self.L, out=self.u)
+        self.u += self.y
+        self.g.proximal(self.u, 1. / self.L, out=self.x)
+
+    def update(self):
+        self.x_old.fill(self.x)
+        self.f.gradient(self.y, out=self.grad)
+        self._step()
+        if self.backtracking:
+            fy = self.f(self.y)
+            # float32 round off in f, otherwise L grows without bound near convergence
+            slack = self.rtol * abs(fy)
+            while True:
+                self.x.subtract(self.y, out=self.d)
+                bound = fy + self.grad.dot(self.d) + 0.5 * self.L * self.d.squared_norm()
+                if self.f(self.x) <= bound + slack:
+                    break
+                self.L *= self.eta
+                self.backtracks += 1
+                self._step()
+
+        t_old = self.t
+        self.t = 0.5 * (1 + numpy.sqrt(1 + 4 * t_old ** 2))
+        self.x.subtract(self.x_old, out=self.y)
+        self.y *= (t_old - 1) / self.t
+        self.y += self.x
+
+    def update_objective(self):
+        self.loss.append(self.f(self.x) + self.g(self.x))
+
+
+if __name__ == '__main__':
+
+    import os
+    import sys
+    # run as a script: the lazy relative imports resolve through the utilities package
+    if not __package__:
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        __package__ = 'utilities'
+
+    from ccpi.framework import ImageGeometry, AcquisitionGeometry
+    from ccpi.optimisation.algorithms import CGLS
+    from ccpi.astra.operators import AstraProjectorSimple
+    import timeit
+
+    N = 64
+    K = 16
+    ig = ImageGeometry(voxel_num_x = N, voxel_num_y = N)
+    angles = numpy.linspace(0, numpy.pi, 180, dtype=numpy.float32)
+    ag = AcquisitionGeometry('parallel','2D', angles, N)
+    Aop = AstraProjectorSimple(ig, ag, 'cpu')
+
+    sinograms = [Aop.direct(ig.allocate('random')) for k in range(K)]
+
+    t0 = timeit.default_timer()
+    for sin in sinograms:
+        cgls = CGLS(x_init=ig.allocate(), operator=Aop, data=sin)
+        cgls.max_iteration = 50
+        cgls.run(50, verbose=False)
+    print('{} CGLS runs: {:.2f} s'.format(K, timeit.default_timer() - t0))
+
+    t0 = timeit.default_timer()
+    bcgls = BlockCGLS(operator=Aop, data=sinograms)
+    bcgls.max_iteration = 50
+    bcgls.update_objective_interval = 10
+    bcgls.run(50, verbose=True)
+    print('BlockCGLS: {:.2f} s'.format(timeit.default_timer() - t0))
+
+    # Ordered subsets on 10 subsets of the 180 angles
+    data = Aop.direct(ig.allocate('random'))
+    subset_data, subset_ops = split_acquisition_data(data, 10, ig=ig)
+
+    ossirt = OSSIRT(x_init=ig.allocate(), operators=subset_ops, data=subset_data)
+    ossirt.max_iteration = 100
+    ossirt.update_objective_interval = 10
+    ossirt.run(100, verbose=True)
+
+    # Preconditioned CGLS with the ramp filter as data weight
+    from utilities.preconditioner_utilities import FourierPreconditioner
+
+    pcgls = PCGLS(x_init=ig.allocate(), operator=Aop, data=data, weight=FourierPreconditioner(ag))
+    pcgls.max_iteration = 50
+    pcgls.update_objective_interval = 5
+    pcgls.run(50, verbose=True)
+
+    # Tikhonov regularised CGLS without the stacked residual
+    from ccpi.optimisation.operators import BlockOperator, Gradient
+
+    Grad = Gradient(ig)
+    rcgls = RegularisedCGLS(x_init=ig.allocate(), operator=BlockOperator(Aop, 0.5 * Grad, shape=(2,1)),
+                            data=[data, None])
+    rcgls.max_iteration = 50
+    rcgls.update_objective_interval = 10
+    rcgls.run(50, verbose=True)
+
+    # FISTA with the Lipschitz constant of the projector shared across instances
+    from ccpi.optimisation.algorithms import FISTA
+    from ccpi.optimisation.functions import IndicatorBox
+    from utilities.lipschitz_utilities import LeastSquares
+
+    f = LeastSquares(Aop, data, c=0.5)
+    for g in [None, IndicatorBox(lower=0)]:
+        fista = FISTA(x_init=ig.allocate(), f=f, g=g)
+        fista.max_iteration = 50
+        fista.run(50, verbose=False)
+
+    bfista = BacktrackingFISTA(x_init=ig.allocate(), f=f, g=IndicatorBox(lower=0))
+    bfista.max_iteration = 50
+    bfista.update_objective_interval = 10
+    bfista.run(50, verbose=True)
+    print('L estimated by backtracking {:.3f}, from the operator norm {:.3f}'.format(bfista.L, f.L))
@@ -0,0 +1,183 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+ImageData and AcquisitionData in shared memory, for process pools.
+
+A SharedDataContainer is a multiprocessing.shared_memory segment with its
+geometry. It pickles to the segment name and the geometry, so a worker
+attaches to the same buffer instead of receiving a copy of the array, and
+results written by the workers land directly in a shared output volume:
+
+    data = SharedDataContainer.from_container(sinogram)     # one copy, in the parent
+    recon = SharedDataContainer(ig)
+    map_axis(fbp_slice, data, recon, axis='vertical', ig=ig2d, ag=ag2d)
+    recon.container                                          # ImageData, no copy
+
+container is a regular ImageData/AcquisitionData whose array is the shared
+buffer, so CIL operators and algorithms can read and write it in place.
+
+The demo runs with python shared_utilities.py or, from Notebooks,
+python -m utilities.shared_utilities.
+"""
+
+from __future__ import print_function, division
+import os
+import numpy
+
+
+def _wrap(geometry, array):
+    '''ImageData/AcquisitionData of geometry around array, without copying'''
+    from ccpi.framework import ImageGeometry, ImageData, AcquisitionData
+    from .multichannel_utilities import _labels
+    cls = ImageData if isinstance(geometry, ImageGeometry) else AcquisitionData
+    return cls(array, deep_copy=False, geometry=geometry, dimension_labels=_labels(geometry))
+
+
+class SharedDataContainer(object):
+
+    '''ImageData or AcquisitionData backed by shared memory, pickled by segment name and geometry
+
+    :param geometry: ImageGeometry or AcquisitionGeometry
+    :param dtype: numpy dtype of the array
+    :param name: name of an existing segment to attach to, None creates one (filled with 0)
+    '''
+
+    def __init__(self, geometry, dtype=numpy.float32, name=None):
+        from .multichannel_utilities import SharedArray
+        self.geometry = geometry
+        self.shared = SharedArray(geometry.shape, dtype, name)
+        self._container = None
+
+    @classmethod
+    def from_container(cls, x, dtype=numpy.float32):
+        '''Copies a DataContainer into a new shared segment'''
+        out = cls(x.geometry, dtype)
+        out.shared.array[...] = x.as_array()
+        return out
+
+    @property
+    def name(self):
+        return self.shared.name
+
+    @property
+    def shape(self):
+        return self.shared.shape
+
+    @property
+    def container(self):
+        '''ImageData/AcquisitionData sharing the buffer'''
+        if self._container is None:
+            self._container = _wrap(self.geometry, self.shared.array)
+        return self._container
+
+    def as_array(self):
+        return self.shared.array
+
+    def fill(self, x):
+        self.shared.array[...] = x.as_array() if hasattr(x, 'as_array') else x
+
+    def get_dimension_axis(self, label):
+        from .multichannel_utilities import _labels
+        return _labels(self.geometry).index(label)
+
+    def __getstate__(self):
+        return {'geometry': self.geometry, 'shared': self.shared}
+
+    def __setstate__(self, state):
+        self.geometry = state['geometry']
+        self.shared = state['shared']
+        self._container = None
+
+    def close(self):
+        '''Detaches, and frees the segment if this process created it
+
+        The container must not be used afterwards.
+        '''
+        self._container = None
+        self.shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def map_axis(worker, data, out, axis='vertical', out_axis=None, num_workers=None, **kwargs):
+    '''Applies worker to every slice of data along axis on a process pool, writing into out
+
+    Neither data nor out is copied: the workers attach to their segments.
+
+    :param worker: picklable callable (slice_array, **kwargs) -> numpy array of one slice of out
+    :param data: SharedDataContainer
+    :param out: SharedDataContainer with as many slices along out_axis
+    :param axis: label of the axis of data, e.g. 'vertical' or 'channel'
+    :param out_axis: label of the axis of out, defaults to axis
+    :param num_workers: number of processes, defaults to min(os.cpu_count(), slices)
+    :returns: out
+    '''
+    from .multichannel_utilities import _chunks, _map_chunk, _pool
+    src_axis = data.get_dimension_axis(axis)
+    dst_axis = out.get_dimension_axis(axis if out_axis is None else out_axis)
+    num_slices = data.shape[src_axis]
+    if out.shape[dst_axis] != num_slices:
+        raise ValueError('Expected {} slices in the output, got {}'.format(num_slices, out.shape[dst_axis]))
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = max(min(num_workers, num_slices), 1)
+
+    pool = _pool(num_workers)
+    try:
+        # the workers attach to the segments of data and out
+        pool.map(_map_chunk, [(worker, data.shared, out.shared, src_axis, dst_axis, chunk, kwargs)
+                              for chunk in _chunks(num_slices, num_workers)])
+    finally:
+        pool.close()
+        pool.join()
+    return out
+
+
+if __name__ == '__main__':
+
+    import sys
+    # run as a script: the lazy relative imports resolve through the utilities package
+    if not __package__:
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        __package__ = 'utilities'
+
+    from ccpi.framework import ImageGeometry, AcquisitionGeometry
+    from ccpi.astra.operators import AstraProjector3DSimple
+    from .multichannel_utilities import fdk_channel
+
+    N = 128
+    ig = ImageGeometry(voxel_num_x=N, voxel_num_y=N, voxel_num_z=N)
+    angles = numpy.linspace(0, numpy.pi, 180, dtype=numpy.float32)
+    ag = AcquisitionGeometry('parallel', '3D', angles, pixel_num_h=N, pixel_num_v=N,
+                             dimension_labels=['vertical', 'angle', 'horizontal'])
+    sino = AstraProjector3DSimple(ig, ag).direct(ig.allocate('random'))
+
+    # parallel beam: the vertical slices are independent 2D problems
+    ig2d = ImageGeometry(voxel_num_x=N, voxel_num_y=N)
+    ag2d = AcquisitionGeometry('parallel', '2D', angles, N)
+    with SharedDataContainer.from_container(sino) as data, SharedDataContainer(ig) as recon:
+        map_axis(fdk_channel, data, recon, axis='vertical', ig=ig2d, ag=ag2d)
+        print('Reconstruction', recon.container.shape, recon.as_array().mean())
@@ -9,27 +9,63 @@ Created on Mon Oct  7 00:32:44 2019
 from ccpi.framework import ImageGeometry
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
+import numpy
+if __package__:
+    from .precision_utilities import _as_array
+else:
+    # loaded as a top-level module, e.g. python show_utilities.py
+    from precision_utilities import _as_array
 
 
-def channel_to_energy(channel):
+_default_calibration = None
+
+
+def default_calibration():
+    # Linear fit m = 0.2786, c = 0.8575 with the +100 offset of the restricted channel range,
+    # pass calibration=EnergyCalibration.from_file(...) to the show functions for other data
+    global _default_calibration
+    if _default_calibration is None:
+        from .spectral_utilities import EnergyCalibration
+        _default_calibration = EnergyCalibration()
+    return _default_calibration
+
+
+def channel_to_energy(channel, calibration=None, num_channels=None):
     # Convert from channel number to energy using calibration linear fit
-    m = 0.2786
-    c = 0.8575
-    # Add on the offset due to using a restricted number of channel (varies based on user choice)
-    shifted_channel = channel + 100
-    energy = (shifted_channel * m) + c
-    energy = format(energy,".3f")
-    return energy
+    if calibration is None:
+        calibration = default_calibration()
+    return calibration.label(channel, num_channels)
+
+
+def channel_view(x, channel):
+    '''View (no copy) of one channel of a DataContainer, unlike x.subset(channel=...)'''
+    labels = x.dimension_labels
+    axis = [k for k in range(len(labels)) if labels[k] == 'channel'][0]
+    idx = [slice(None)] * len(x.shape)
+    idx[axis] = channel
+    return x.as_array()[tuple(idx)]
+
+
+def montage(arr, ncols=None, pad=1, fill=numpy.nan):
+    '''Tiles the images arr[0], arr[1], ... into one 2D array, ncols per row'''
+    n, h, w = arr.shape
+    if ncols is None:
+        ncols = int(numpy.ceil(numpy.sqrt(n)))
+    nrows = int(numpy.ceil(n / ncols))
+    out = numpy.full((nrows * (h + pad) - pad, ncols * (w + pad) - pad), fill, dtype=numpy.float32)
+    for i in range(n):
+        r, c = divmod(i, ncols)
+        out[r * (h + pad):r * (h + pad) + h, c * (w + pad):c * (w + pad) + w] = arr[i]
+    return out
 
 
 def show2D(x, title='', **kwargs):
     
     cmap = kwargs.get('cmap', 'gray')
     font_size = kwargs.get('font_size', [12, 12])
-    minmax = (kwargs.get('minmax', (x.as_array().min(),x.as_array().max())))
-    
-    # get numpy array
-    tmp = x.as_array()
+    # get numpy array, x may also be a numpy view
+    tmp = _as_array(x)
+    minmax = (kwargs.get('minmax', (tmp.min(),tmp.max())))
       
     # labels for x, y      
     labels = kwargs.get('labels', ['x','y']) 
@@ -64,7 +100,8 @@ def show3D(x, title , **kwargs):
     font_size = kwargs.get('font_size', [12, 12])
 
     # Default minmax scaling
-    minmax = (kwargs.get('minmax', (x.as_array().min(),x.as_array().max())))
+    tmp = _as_array(x)
+    minmax = (kwargs.get('minmax', (tmp.min(),tmp.max())))
     
     labels = kwargs.get('labels', ['x','y','z'])     
             
@@ -72,8 +109,6 @@ def show3D(x, title , **kwargs):
 
     fig, axs = plt.subplots(1, 3, figsize = figure_size)
     
-    tmp = x.as_array()
-    
     im1 = axs[0].imshow(tmp[show_slices[0],:,:], cmap=cmap, vmin=min(minmax), vmax=max(minmax))
     axs[0].set_title(title_subplot[0], fontsize = font_size[0])
     axs[0].set_xlabel(labels[0], fontsize = font_size[1])
@@ -116,15 +151,21 @@ def show2D_channels(x, title, show_channels = [1], **kwargs):
     # Default minmax scaling
     minmax = (kwargs.get('minmax', (x.as_array().min(),x.as_array().max()))) 
     
+    # energies of all the channels shown, in one lookup
+    calibration = kwargs.pop('calibration', None)
+    if calibration is None:
+        calibration = default_calibration()
+    energies = calibration(show_channels, x.geometry.channels)
+    
     if len(show_channels)==1:
-        show2D(x.subset(channel=show_channels[0]), title + ' Energy {}'.format(channel_to_energy(show_channels[0])) + " keV", **kwargs)        
+        show2D(channel_view(x, show_channels[0]), title + ' Energy {:.3f}'.format(energies[0]) + " keV", **kwargs)        
     else:
         
         fig, axs = plt.subplots(1, len(show_channels), sharey=True, figsize = figure_size)    
     
         for i in range(len(show_channels)):
-            im = axs[i].imshow(x.subset(channel=show_channels[i]).as_array(), cmap = cmap, vmin=min(minmax), vmax=max(minmax))
-            axs[i].set_title('Energy {}'.format(channel_to_energy(show_channels[i])) + "keV", fontsize = font_size[0])
+            im = axs[i].imshow(channel_view(x, show_channels[i]), cmap = cmap, vmin=min(minmax), vmax=max(minmax))
+            axs[i].set_title('Energy {:.3f}'.format(energies[i]) + "keV", fontsize = font_size[0])
             axs[i].set_xlabel(labels[0], fontsize = font_size[1])
             divider = make_axes_locatable(axs[i])
             cax1 = divider.append_axes("right", size="5%", pad=0.1)    
@@ -135,7 +176,9 @@ def show2D_channels(x, title, show_channels = [1], **kwargs):
         
 def show3D_channels(x, title = None, show_channels = 0, **kwargs):
     
-    show3D(x.subset(channel=show_channels), title + ' Energy {}'.format(channel_to_energy(show_channels))  + " keV", **kwargs)        
+    calibration = kwargs.pop('calibration', None)
+    energy = channel_to_energy(show_channels, calibration, x.geometry.channels)
+    show3D(channel_view(x, show_channels), title + ' Energy {}'.format(energy)  + " keV", **kwargs)        
         
 def show(x, title = None, show_channels = [1], **kwargs):
     
@@ -159,6 +202,117 @@ def show(x, title = None, show_channels = [1], **kwargs):
             
             
             
+class SpectralViewer(object):
+
+    '''Multi-channel viewer drawing into one figure that is updated on every call
+
+    Calling show() in a loop (e.g. every few iterations of an algorithm)
+    updates the images, titles and colour limits of the same figure instead of
+    creating a new one, and reads the channels as views.
+
+        viewer = SpectralViewer(cmap='inferno', minmax=(0.0,0.4))
+        for i in range(...):
+            algo.run(step)
+            viewer.show(algo.get_output(), show_channels=20, title='Iteration {}'.format(...))
+
+    :param cmap: colour map
+    :param minmax: fixed colour limits, None for the range of each call
+    :param figure_size: size of the figure
+    :param font_size: [title, labels]
+    :param calibration: EnergyCalibration of the channel titles
+    '''
+
+    def __init__(self, cmap='gray', minmax=None, figure_size=(15,6), font_size=(12,12), calibration=None):
+        self.cmap = cmap
+        self.minmax = minmax
+        self.figure_size = figure_size
+        self.font_size = font_size
+        self.calibration = default_calibration() if calibration is None else calibration
+        self.fig = None
+        self.axs = None
+        self.images = None
+        self._layout = None
+        self._handle = None
+
+    def _figure(self, layout, ncols, shapes):
+        if self._layout == (layout, shapes):
+            return
+        try:
+            from IPython import get_ipython
+            inline = get_ipython() is not None and 'inline' in plt.get_backend()
+        except ImportError:
+            inline = False
+        if self.fig is None:
+            if inline:
+                # not registered with pyplot: not shown again at the end of every cell
+                from matplotlib.figure import Figure
+                self.fig = Figure(figsize=self.figure_size)
+            else:
+                self.fig = plt.figure(figsize=self.figure_size)
+        self.fig.clf()
+        self.axs = [self.fig.add_subplot(1, ncols, i + 1) for i in range(ncols)]
+        self.images = [None] * ncols
+        self._layout = (layout, shapes)
+
+    def _draw(self, panels, title):
+        limits = self.minmax
+        if limits is None:
+            limits = (min(numpy.nanmin(p) for _, p in panels), max(numpy.nanmax(p) for _, p in panels))
+        for i, (subtitle, img) in enumerate(panels):
+            if self.images[i] is None:
+                self.images[i] = self.axs[i].imshow(img, cmap=self.cmap, vmin=min(limits), vmax=max(limits))
+                self.fig.colorbar(self.images[i], ax=self.axs[i], fraction=0.046, pad=0.04)
+            else:
+                self.images[i].set_data(img)
+                self.images[i].set_clim(min(limits), max(limits))
+            self.axs[i].set_title(subtitle, fontsize=self.font_size[1])
+        self.fig.suptitle(title, fontsize=self.font_size[0])
+        self._refresh()
+
+    def _refresh(self):
+        if plt.fignum_exists(getattr(self.fig, 'number', -1)):
+            self.fig.canvas.draw_idle()
+            plt.pause(0.001)
+            return
+        from IPython.display import display
+        if self._handle is None:
+            self._handle = display(self.fig, display_id=True)
+        else:
+            self._handle.update(self.fig)
+
+    def _energy(self, channel, num_channels):
+        return 'Energy {:.3f} keV'.format(float(self.calibration(channel, num_channels)))
+
+    def show(self, x, show_channels=0, title='', show_slices=None):
+        '''2D channels side by side, or the axial/coronal/sagittal slices of one 3D channel'''
+        channels = numpy.atleast_1d(show_channels)
+        first = channel_view(x, int(channels[0]))
+        num_channels = x.geometry.channels
+        if first.ndim == 3:
+            if show_slices is None:
+                show_slices = [n // 2 for n in first.shape]
+            panels = [('Axial', first[show_slices[0]]), ('Coronal', first[:, show_slices[1]]),
+                      ('Sagittal', first[:, :, show_slices[2]])]
+            title = '{} {}'.format(title, self._energy(channels[0], num_channels))
+        else:
+            panels = [(self._energy(c, num_channels), channel_view(x, int(c))) for c in channels]
+        self._figure('3D' if first.ndim == 3 else '2D', len(panels), tuple(p.shape for _, p in panels))
+        self._draw(panels, title)
+
+    def show_montage(self, x, show_channels=None, title='', ncols=None, show_slice=None):
+        '''All the channels (of one axial slice for 3D) tiled in a single imshow'''
+        labels = x.dimension_labels
+        axis = [k for k in range(len(labels)) if labels[k] == 'channel'][0]
+        arr = numpy.moveaxis(x.as_array(), axis, 0)
+        if show_channels is not None:
+            arr = arr[numpy.atleast_1d(show_channels)]
+        if arr.ndim == 4:
+            arr = arr[:, arr.shape[1] // 2 if show_slice is None else show_slice]
+        tiled = montage(arr, ncols)
+        self._figure('montage', 1, (tiled.shape,))
+        self._draw([('{} channels'.format(arr.shape[0]), tiled)], title)
+
+
 from IPython.display import HTML
 import random
 
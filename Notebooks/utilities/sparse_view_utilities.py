@@ -0,0 +1,266 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Sparse-view studies from one full-angle sinogram.
+
+The phantom is projected once, on the full set of angles. Every sparse view
+is a subset of its angles, taken by index from the sinogram with the matching
+AcquisitionGeometry (reconstruction_utilities.subset_geometry), so nothing is
+reprojected. The reconstructions run in parallel on a process pool: the full
+sinogram is shared with the workers (shared_utilities.SharedDataContainer)
+and every worker writes its image into a shared output stack.
+
+    sino = Aop.direct(phantom)                             # 180 angles
+    results = sparse_view_study(sino, ig, [20, 45, 90, 180], method='cgls',
+                                ground_truth=phantom, iterations=20)
+    print_study(results)
+    plot_study(results)
+
+Without a ground truth the images are compared with the reconstruction from
+the largest number of views. The keyword arguments of the study go to the
+method and must be ones it takes, e.g. iterations for 'cgls' and 'sirt',
+filter_type for 'fbp'.
+"""
+
+from __future__ import print_function, division
+import inspect
+import os
+import time
+import numpy
+
+
+def angle_indices(num_angles, num_views, offset=0):
+    '''Indices of num_views angles spread evenly over num_angles, starting at offset'''
+    if not 0 < num_views <= num_angles:
+        raise ValueError('Expected between 1 and {} views, got {}'.format(num_angles, num_views))
+    indices = numpy.floor(numpy.arange(num_views) * (num_angles / num_views)).astype(int)
+    return (indices + offset) % num_angles
+
+
+def subsample(data, indices):
+    '''AcquisitionData of data restricted to the angles at indices, without reprojection
+
+    :param data: AcquisitionData or SharedDataContainer
+    '''
+    from .reconstruction_utilities import subset_geometry
+    ag = subset_geometry(data.geometry, indices)
+    sub = ag.allocate()
+    sub.fill(numpy.take(data.as_array(), indices, axis=data.get_dimension_axis('angle')))
+    return sub
+
+
+def fbp_method(ig, data, filter_type='ram-lak'):
+    '''FBP/FDK of data on ig, see fbp_utilities'''
+    from .fbp_utilities import fbp
+    return fbp(ig, data, filter_type=filter_type, num_threads=1)
+
+
+def cgls_method(ig, data, iterations=20, operator_factory=None):
+    '''CGLS reconstruction of data on ig, operator_factory defaults to the ASTRA projector'''
+    from ccpi.optimisation.algorithms import CGLS
+    from .multichannel_utilities import default_projector
+    operator_factory = operator_factory or default_projector
+    cgls = CGLS(x_init=ig.allocate(), operator=operator_factory(ig, data.geometry), data=data)
+    cgls.max_iteration = iterations
+    cgls.run(iterations, verbose=False)
+    return cgls.get_output()
+
+
+def sirt_method(ig, data, iterations=100, operator_factory=None):
+    '''SIRT reconstruction of data on ig, operator_factory defaults to the ASTRA projector'''
+    from ccpi.optimisation.algorithms import SIRT
+    from .multichannel_utilities import default_projector
+    operator_factory = operator_factory or default_projector
+    sirt = SIRT(x_init=ig.allocate(), operator=operator_factory(ig, data.geometry), data=data)
+    sirt.max_iteration = iterations
+    sirt.run(iterations, verbose=False)
+    return sirt.get_output()
+
+
+METHODS = {'fbp': fbp_method, 'cgls': cgls_method, 'sirt': sirt_method}
+
+
+def _check_kwargs(method, kwargs):
+    '''Raises ValueError on keyword arguments that method does not take'''
+    params = inspect.signature(method).parameters
+    if any(p.kind == p.VAR_KEYWORD for p in params.values()):
+        return
+    unknown = sorted(set(kwargs) - set(list(params)[2:]))
+    if unknown:
+        raise ValueError('{} does not take {}'.format(getattr(method, '__name__', method), ', '.join(unknown)))
+
+
+class SparseViewResult(object):
+
+    '''Reconstruction from num_views angles with its run time and quality'''
+
+    def __init__(self, num_views, indices, image, time, psnr=None, rmse=None):
+        self.num_views = num_views
+        self.indices = indices
+        self.image = image
+        self.time = time
+        self.psnr = psnr
+        self.rmse = rmse
+
+    def __repr__(self):
+        return 'SparseViewResult(num_views={}, time={:.2f}, psnr={}, rmse={})'.format(
+            self.num_views, self.time, self.psnr, self.rmse)
+
+
+def _run_view(args):
+    method, data, out, k, indices, ig, kwargs = args
+    try:
+        sub = subsample(data, indices)
+        t0 = time.time()
+        x = method(ig, sub, **kwargs)
+        elapsed = time.time() - t0
+        out.array[k] = x.as_array()
+        return elapsed
+    finally:
+        data.close()
+        out.close()
+
+
+def _quality(image, reference):
+    rmse = float(numpy.sqrt(numpy.mean((image.astype(numpy.float64) - reference) ** 2)))
+    data_range = float(reference.max() - reference.min())
+    if data_range == 0:
+        raise ValueError('The reference image is constant, its PSNR is undefined')
+    psnr = float('inf') if rmse == 0 else 20 * numpy.log10(data_range / rmse)
+    return psnr, rmse
+
+
+def sparse_view_study(data, ig, num_views, method='fbp', ground_truth=None, num_workers=None, **kwargs):
+    '''Reconstructs data from subsets of its angles in parallel
+
+    :param data: full-angle AcquisitionData
+    :param ig: ImageGeometry of the reconstructions
+    :param num_views: list of numbers of angles, e.g. [20, 45, 90, 180]
+    :param method: 'fbp', 'cgls', 'sirt' or a picklable callable (ig, data, **kwargs) -> ImageData
+    :param ground_truth: ImageData or array the reconstructions are compared with,
+                         by default the reconstruction from the most views
+    :param num_workers: number of processes, defaults to min(os.cpu_count(), len(num_views))
+    :param kwargs: passed to the method, e.g. iterations, ValueError if it does not take them
+    :returns: list of SparseViewResult, by increasing number of views
+    '''
+    from .multichannel_utilities import SharedArray, _pool
+    from .shared_utilities import SharedDataContainer
+    if not callable(method):
+        if method not in METHODS:
+            raise ValueError('Unsupported method ', method)
+        method = METHODS[method]
+    _check_kwargs(method, kwargs)
+    if method is fbp_method:
+        # unsupported geometries raise here rather than in the workers
+        from .fbp_utilities import FBPEngine
+        FBPEngine(ig, data.geometry, num_threads=1)
+    num_views = sorted(set(int(n) for n in num_views))
+    num_angles = data.shape[data.get_dimension_axis('angle')]
+    views = [angle_indices(num_angles, n) for n in num_views]
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = max(min(num_workers, len(views)), 1)
+
+    shared = SharedDataContainer.from_container(data)
+    out = SharedArray((len(views),) + tuple(ig.shape))
+    try:
+        pool = _pool(num_workers)
+        try:
+            # the largest problems first, the others fill in around them
+            order = sorted(range(len(views)), key=lambda k: -len(views[k]))
+            times = pool.map(_run_view, [(method, shared, out, k, views[k], ig, kwargs) for k in order],
+                             chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        times = dict(zip(order, times))
+        images = numpy.array(out.array, copy=True)
+    finally:
+        shared.close()
+        out.close()
+
+    if ground_truth is None:
+        reference = images[-1].astype(numpy.float64)
+    else:
+        reference = numpy.asarray(ground_truth.as_array() if hasattr(ground_truth, 'as_array') else ground_truth,
+                                  dtype=numpy.float64)
+    results = []
+    for k, n in enumerate(num_views):
+        if not numpy.isfinite(images[k]).all() or not images[k].any():
+            raise ValueError('The reconstruction from {} views is empty or not finite'.format(n))
+        psnr, rmse = _quality(images[k], reference)
+        results.append(SparseViewResult(n, views[k], images[k], times[k], psnr, rmse))
+    return results
+
+
+def print_study(results):
+    print('{:>8} {:>10} {:>10} {:>12}'.format('views', 'time [s]', 'PSNR', 'RMSE'))
+    for r in results:
+        print('{:>8} {:>10.2f} {:>10.2f} {:>12.4g}'.format(r.num_views, r.time, r.psnr, r.rmse))
+
+
+def plot_study(results, figure_size=(12, 4)):
+    '''Plots PSNR and run time against the number of views'''
+    import matplotlib.pyplot as plt
+    views = [r.num_views for r in results]
+    fig, (ax0, ax1) = plt.subplots(1, 2, figsize=figure_size)
+    ax0.plot(views, [r.psnr for r in results], 'o-')
+    ax0.set_xlabel('Number of views')
+    ax0.set_ylabel('PSNR [dB]')
+    ax1.plot(views, [r.time for r in results], 'o-')
+    ax1.set_xlabel('Number of views')
+    ax1.set_ylabel('Time [s]')
+    plt.tight_layout()
+    plt.show()
+    return fig
+
+
+if __name__ == '__main__':
+
+    import sys
+    # run as a script: the lazy relative imports resolve through the utilities package
+    if not __package__:
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        __package__ = 'utilities'
+
+    from ccpi.framework import ImageGeometry, AcquisitionGeometry, ImageData
+    from ccpi.astra.operators import AstraProjectorSimple
+    import tomophantom
+    from tomophantom import TomoP2D
+
+    N = 256
+    model = 1
+    path_library2D = os.path.join(os.path.dirname(tomophantom.__file__), "Phantom2DLibrary.dat")
+    phantom = TomoP2D.Model(model, N, path_library2D)
+    ig = ImageGeometry(voxel_num_x=N, voxel_num_y=N)
+    ground_truth = ImageData(phantom.astype(numpy.float32), geometry=ig)
+
+    # the full sinogram, projected once
+    angles = numpy.linspace(0, numpy.pi, 180, dtype=numpy.float32)
+    ag = AcquisitionGeometry('parallel', '2D', angles, N)
+    sino = AstraProjectorSimple(ig, ag, 'cpu').direct(ground_truth)
+
+    for method, kwargs in [('fbp', {'filter_type': 'ram-lak'}), ('cgls', {'iterations': 20})]:
+        print(method)
+        results = sparse_view_study(sino, ig, [20, 45, 90, 180], method=method, ground_truth=ground_truth,
+                                    **kwargs)
+        print_study(results)
@@ -0,0 +1,443 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Lazy loading of multi-channel (spectral) sinograms stored in HDF5.
+
+SpectralDataReader opens the file read-only and keeps the 'SC' dataset as an
+h5py.Dataset, so nothing is read until read() is called with the channel,
+vertical and angle selection. Only those hyperslabs are read, one block of
+channels at a time, straight into the float32 array of an AcquisitionData
+whose geometry matches the selection.
+
+The default geometry is the one of sinogram_centered_channels100_140.h5 used
+in notebook 05: cone beam, labels ['channel', 'vertical', 'angle', 'horizontal'].
+
+SpectralPCA compresses the channel axis with a truncated SVD,
+
+             X (channels x rest) ~ U_k Z,   Z = U_k^T X (k x rest)
+
+Projection acts on each channel with the same linear operator, so it commutes
+with the channel mixing: reconstructing the k rows of Z and expanding with U_k
+gives the channel reconstructions of any linear method (FDK, CGLS at a fixed
+iteration count) at the cost of k channels, and is an approximation for
+nonlinear ones (TV).
+
+EnergyCalibration maps channels to energies [keV] with one vectorised lookup
+table per number of channels, and sums adjacent channels into energy windows
+(bin_channels) to reconstruct fewer, less noisy channels.
+"""
+
+from __future__ import print_function, division
+import json
+import numpy
+
+LABELS = ['channel', 'vertical', 'angle', 'horizontal']
+
+# acquisition settings of sinogram_centered_channels100_140.h5
+DISTANCE_SOURCE_CENTER = 233.0  # [mm]
+DISTANCE_CENTER_DETECTOR = 245.0  # [mm]
+DETECTOR_PIXEL_SIZE = 0.25  # [mm]
+
+# linear energy calibration of the detector, channel 0 of the file is detector channel 100
+CALIBRATION_SLOPE = 0.2786  # [keV / channel]
+CALIBRATION_INTERCEPT = 0.8575  # [keV]
+CALIBRATION_OFFSET = 100
+
+
+def default_angles(num_angles):
+    '''Projection angles [rad] of the notebook 05 dataset'''
+    return numpy.linspace(-180 - 55, 180 - 55, num_angles, endpoint=False) * numpy.pi / 180
+
+
+def _selection(sel, n):
+    '''Converts None, an int, a (start, stop) pair, a slice (step > 0) or a list of indices to a slice or sorted index array'''
+    if sel is None:
+        return slice(0, n)
+    if isinstance(sel, (int, numpy.integer)):
+        return slice(int(sel), int(sel) + 1)
+    if isinstance(sel, tuple) and len(sel) == 2:
+        sel = slice(*sel)
+    if isinstance(sel, slice):
+        if (sel.step or 1) < 0:
+            # h5py reads increasing selections only, and the geometry follows the file order
+            raise ValueError('Negative slice steps are not supported, got {}'.format(sel))
+        return slice(*sel.indices(n))
+    idx = numpy.unique(numpy.asarray(sel, dtype=numpy.int64))
+    if idx.size and (idx[0] < 0 or idx[-1] >= n):
+        raise ValueError('Index out of range [0, {})'.format(n))
+    return idx
+
+
+def _read_hyperslab(dataset, sel):
+    '''dataset[sel + (:,)], with sel made of slices and sorted index arrays
+
+    h5py accepts a single index list per read: the first list is passed to
+    h5py, the others are read as their bounding slice and indexed in memory.
+    '''
+    h5sel = []
+    post = []
+    has_list = False
+    for s in sel:
+        if isinstance(s, slice):
+            h5sel.append(s)
+            post.append(slice(None))
+        elif not has_list:
+            h5sel.append(list(s))
+            post.append(slice(None))
+            has_list = True
+        else:
+            h5sel.append(slice(int(s[0]), int(s[-1]) + 1))
+            post.append(s - s[0])
+    arr = dataset[tuple(h5sel) + (slice(None),)]
+    for axis, p in enumerate(post):
+        if not isinstance(p, slice):
+            arr = numpy.take(arr, p, axis=axis)
+    return arr
+
+
+def _indices(sel, n):
+    return numpy.arange(n)[sel] if isinstance(sel, slice) else sel
+
+
+class SpectralDataReader(object):
+
+    '''Read-only, lazy reader of a multi-channel sinogram in HDF5
+
+    :param path: HDF5 file
+    :param dataset: name of the dataset, 'SC' by default
+    :param angles: all the projection angles [rad], defaults to default_angles
+    :param dist_source_center: distance source - rotation axis
+    :param dist_center_detector: distance rotation axis - detector
+    :param pixel_size: detector pixel size
+    :param chunk_channels: number of channels read per h5py call
+    '''
+
+    def __init__(self, path, dataset='SC', angles=None, dist_source_center=DISTANCE_SOURCE_CENTER,
+                 dist_center_detector=DISTANCE_CENTER_DETECTOR, pixel_size=DETECTOR_PIXEL_SIZE,
+                 chunk_channels=4):
+        import h5py
+        self.path = path
+        self.file = h5py.File(path, 'r')
+        self.dataset = self.file[dataset]
+        if self.dataset.ndim != 4:
+            raise ValueError('Expected a 4D dataset (channel, vertical, angle, horizontal), got shape {}'
+                             .format(self.dataset.shape))
+        self.num_channels, self.num_pixels_v, self.num_angles, self.num_pixels_h = self.dataset.shape
+        self.angles = default_angles(self.num_angles) if angles is None else numpy.asarray(angles)
+        self.dist_source_center = dist_source_center
+        self.dist_center_detector = dist_center_detector
+        self.pixel_size = pixel_size
+        self.chunk_channels = chunk_channels
+
+    @property
+    def shape(self):
+        return self.dataset.shape
+
+    @property
+    def chunks(self):
+        '''HDF5 chunk shape of the dataset, None if contiguous'''
+        return self.dataset.chunks
+
+    def geometry(self, channels=None, vertical=None, angles=None):
+        '''AcquisitionGeometry of a selection
+
+        A vertical range is modelled as a centred detector of that height; for
+        cone beam, off-centre ranges are only approximate.
+        '''
+        from ccpi.framework import AcquisitionGeometry
+        c = _indices(_selection(channels, self.num_channels), self.num_channels)
+        v = _indices(_selection(vertical, self.num_pixels_v), self.num_pixels_v)
+        a = _indices(_selection(angles, self.num_angles), self.num_angles)
+        return AcquisitionGeometry('cone',
+                                   '3D',
+                                   self.angles[a],
+                                   pixel_num_h=self.num_pixels_h,
+                                   pixel_size_h=self.pixel_size,
+                                   pixel_num_v=len(v),
+                                   pixel_size_v=self.pixel_size,
+                                   dist_source_center=self.dist_source_center,
+                                   dist_center_detector=self.dist_center_detector,
+                                   channels=len(c),
+                                   dimension_labels=LABELS)
+
+    def read_array(self, channels=None, vertical=None, angles=None, out=None):
+        '''Reads the selection into a float32 numpy array (channel, vertical, angle, horizontal)
+
+        :param channels: None (all), int, (start, stop), slice or list of indices
+        :param vertical: as channels
+        :param angles: as channels, e.g. slice(None, None, 4) for every 4th angle
+        '''
+        cs = _selection(channels, self.num_channels)
+        vs = _selection(vertical, self.num_pixels_v)
+        as_ = _selection(angles, self.num_angles)
+        c = _indices(cs, self.num_channels)
+        shape = (len(c), len(_indices(vs, self.num_pixels_v)), len(_indices(as_, self.num_angles)),
+                 self.num_pixels_h)
+        if out is None:
+            out = numpy.empty(shape, dtype=numpy.float32)
+
+        for start in range(0, len(c), self.chunk_channels):
+            block = c[start:start + self.chunk_channels]
+            if isinstance(cs, slice) and cs.step == 1:
+                csel = slice(int(block[0]), int(block[-1]) + 1)
+            else:
+                csel = block
+            out[start:start + len(block)] = _read_hyperslab(self.dataset, (csel, vs, as_))
+        return out
+
+    def read(self, channels=None, vertical=None, angles=None):
+        '''Reads the selection into an AcquisitionData with the matching geometry'''
+        ag = self.geometry(channels, vertical, angles)
+        data = ag.allocate()
+        data.fill(self.read_array(channels, vertical, angles))
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_spectral_data(path, channels=None, vertical=None, angles=None, **kwargs):
+    '''Opens path read-only and returns the selection as AcquisitionData'''
+    with SpectralDataReader(path, **kwargs) as reader:
+        return reader.read(channels, vertical, angles)
+
+
+class SpectralPCA(object):
+
+    '''Low-rank basis of the channel axis of a DataContainer
+
+    :param n_components: number of components k, None to choose it from energy
+    :param energy: fraction of the squared singular values kept when n_components is None
+    '''
+
+    def __init__(self, n_components=None, energy=0.999):
+        self.n_components = n_components
+        self.energy = energy
+        self.basis = None
+        self.singular_values = None
+
+    def fit(self, data):
+        '''Computes the basis U_k from the channels x channels Gram matrix of data'''
+        from .multichannel_utilities import channel_axis
+        arr = data.as_array()
+        axis = channel_axis(data.geometry)
+        other = [a for a in range(arr.ndim) if a != axis]
+        # C x C, without reshaping (copying) the data
+        gram = numpy.tensordot(arr, arr, axes=(other, other)).astype(numpy.float64)
+        w, v = numpy.linalg.eigh(gram)
+        order = numpy.argsort(w)[::-1]
+        w = numpy.maximum(w[order], 0)
+        v = v[:, order]
+        self.singular_values = numpy.sqrt(w)
+        k = self.n_components
+        if k is None:
+            cumulative = numpy.cumsum(w) / max(w.sum(), numpy.finfo(numpy.float64).tiny)
+            k = int(numpy.searchsorted(cumulative, self.energy) + 1)
+        self.k = min(k, len(w))
+        self.basis = v[:, :self.k].astype(numpy.float32)
+        return self
+
+    @property
+    def explained_energy(self):
+        w = self.singular_values ** 2
+        return w[:self.k].sum() / w.sum()
+
+    def _mix(self, data, matrix, geometry):
+        from .multichannel_utilities import channel_axis
+        axis = channel_axis(data.geometry)
+        res = numpy.tensordot(matrix, data.as_array(), axes=([1], [axis]))
+        out = geometry.allocate()
+        out.fill(numpy.moveaxis(res, 0, channel_axis(geometry)))
+        return out
+
+    def compress(self, data):
+        '''DataContainer with k channels, the components Z = U_k^T X
+
+        The channel axis is kept for k = 1.
+        '''
+        from .multichannel_utilities import channel_geometry
+        return self._mix(data, self.basis.T, channel_geometry(data.geometry, self.k, keep_axis=True))
+
+    def expand(self, components, geometry):
+        '''Channels U_k Z of the components, on geometry with the original number of channels'''
+        return self._mix(components, self.basis, geometry)
+
+
+def compressed_reconstruction(data, ig, reconstruct, n_components=None, energy=0.999):
+    '''Reconstructs the k principal components of the channels of data and expands them
+
+    :param data: multi-channel AcquisitionData
+    :param ig: multi-channel ImageGeometry of the result
+    :param reconstruct: callable (data_k, ig_k) -> ImageData on the k channel geometry ig_k
+                        (with a channel axis, also for k = 1),
+                        e.g. lambda d, g: reconstruct_channels(d, g, 'fdk')
+    :returns: (ImageData on ig, SpectralPCA)
+    '''
+    from .multichannel_utilities import channel_geometry
+    pca = SpectralPCA(n_components, energy).fit(data)
+    components = reconstruct(pca.compress(data), channel_geometry(ig, pca.k, keep_axis=True))
+    return pca.expand(components, ig), pca
+
+
+class EnergyCalibration(object):
+
+    '''Channel to energy [keV] calibration
+
+    Linear, energy = slope * (channel + offset) + intercept, or given by a table
+    of the energy of every channel.
+
+    :param slope: keV per channel
+    :param intercept: keV
+    :param offset: index of channel 0 on the detector
+    :param table: optional energies of channels 0, 1, ..., overrides the linear fit
+    '''
+
+    def __init__(self, slope=CALIBRATION_SLOPE, intercept=CALIBRATION_INTERCEPT,
+                 offset=CALIBRATION_OFFSET, table=None):
+        self.slope = slope
+        self.intercept = intercept
+        self.offset = offset
+        self.table = None if table is None else numpy.asarray(table, dtype=numpy.float64)
+        self._energies = {}
+
+    @classmethod
+    def from_file(cls, path):
+        '''Loads a calibration
+
+        .json: {"slope": ..., "intercept": ..., "offset": ...}
+        otherwise: text file with the energy of each channel in the last column
+        '''
+        if path.endswith('.json'):
+            with open(path) as f:
+                params = json.load(f)
+            return cls(**params)
+        table = numpy.loadtxt(path, ndmin=2)
+        return cls(table=table[:, -1])
+
+    def energies(self, num_channels):
+        '''Energies of channels 0, ..., num_channels - 1, computed once per num_channels'''
+        if num_channels not in self._energies:
+            if self.table is not None:
+                if num_channels > len(self.table):
+                    raise ValueError('The calibration table has {} channels, {} requested'
+                                     .format(len(self.table), num_channels))
+                e = self.table[:num_channels].copy()
+            else:
+                e = self.slope * (numpy.arange(num_channels) + self.offset) + self.intercept
+            e.setflags(write=False)
+            self._energies[num_channels] = e
+        return self._energies[num_channels]
+
+    def for_geometry(self, geometry):
+        '''Energies of the channel axis of an ImageGeometry or AcquisitionGeometry'''
+        return self.energies(geometry.channels)
+
+    def __call__(self, channels, num_channels=None):
+        '''Energy of a channel index or array of indices
+
+        :param num_channels: number of channels of the data, e.g. geometry.channels, the
+                             energies are looked up in the table of that many channels.
+                             By default the whole calibration table, or for the linear fit
+                             the energies of the given channels only.
+        '''
+        channels = numpy.asarray(channels, dtype=numpy.int64)
+        if num_channels is None:
+            if self.table is None:
+                return self.slope * (channels + self.offset) + self.intercept
+            num_channels = len(self.table)
+        if channels.size and (channels.min() < 0 or channels.max() >= num_channels):
+            raise ValueError('Expected channels between 0 and {}, got {}'.format(num_channels - 1, channels))
+        return self.energies(num_channels)[channels]
+
+    def label(self, channel, num_channels=None):
+        return '{:.3f}'.format(float(self(channel, num_channels)))
+
+    def windows(self, num_channels, width=None, edges=None):
+        '''Start index of each window of adjacent channels
+
+        :param width: number of channels per window, the last one may be narrower
+        :param edges: increasing energy edges [keV] of the windows, channels outside are dropped
+        :returns: (starts, stops) arrays of channel indices
+        '''
+        if (width is None) == (edges is None):
+            raise ValueError('Give either width or edges')
+        if width is not None:
+            starts = numpy.arange(0, num_channels, width)
+            stops = numpy.minimum(starts + width, num_channels)
+        else:
+            e = self.energies(num_channels)
+            bounds = numpy.searchsorted(e, numpy.asarray(edges, dtype=numpy.float64))
+            starts, stops = bounds[:-1], bounds[1:]
+            keep = stops > starts
+            starts, stops = starts[keep], stops[keep]
+        return starts, stops
+
+    def bin_channels(self, data, width=None, edges=None):
+        '''Sums adjacent channels of data into energy windows
+
+        :param data: DataContainer with a 'channel' axis
+        :returns: (binned DataContainer, mean energy of each window)
+        '''
+        from .multichannel_utilities import channel_axis, channel_geometry
+        axis = channel_axis(data.geometry)
+        num_channels = data.shape[axis]
+        starts, stops = self.windows(num_channels, width, edges)
+        # the windows are contiguous, from starts[0] to stops[-1]
+        arr = numpy.take(data.as_array(), numpy.arange(starts[0], stops[-1]), axis=axis)
+        binned = numpy.add.reduceat(arr, starts - starts[0], axis=axis)
+        out = channel_geometry(data.geometry, len(starts)).allocate()
+        out.fill(binned.reshape(out.shape))
+        e = self.energies(num_channels)
+        centres = numpy.array([e[a:b].mean() for a, b in zip(starts, stops)])
+        return out, centres
+
+
+if __name__ == '__main__':
+
+    import os
+    import sys
+    # run as a script: the lazy relative imports resolve through the utilities package
+    if not __package__:
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        __package__ = 'utilities'
+
+    from ccpi.framework import ImageGeometry
+
+    # strongly correlated channels: a single spectrum times an image, k = 1
+    ig = ImageGeometry(voxel_num_x=64, voxel_num_y=64, channels=20)
+    spectrum = numpy.linspace(1, 2, ig.channels, dtype=numpy.float32)
+    image = numpy.random.rand(64, 64).astype(numpy.float32)
+    x = ig.allocate()
+    x.fill(spectrum[:, None, None] * image[None])
+
+    pca = SpectralPCA(energy=0.999).fit(x)
+    components = pca.compress(x)
+    restored = pca.expand(components, ig)
+    print('k =', pca.k, 'components', components.shape)
+    assert pca.k == 1 and components.shape == (1, 64, 64)
+    assert numpy.allclose(restored.as_array(), x.as_array(), rtol=1e-4, atol=1e-5)
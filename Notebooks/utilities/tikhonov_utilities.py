@@ -0,0 +1,289 @@
+#========================================================================
+# Copyright 2019 Science Technology Facilities Council
+# Copyright 2019 University of Manchester
+#
+# This work is part of the Core Imaging Library developed by Science Technology
+# Facilities Council and University of Manchester
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0.txt
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#=========================================================================
+
+"""
+Direct solvers for Tikhonov denoising and deblurring with a gradient regulariser.
+
+Problem:     min_u || K u - g ||^{2}_{2} + alpha^{2} || \nabla u ||^{2}_{2}
+
+             K: Identity (denoising) or a convolution with a symmetric kernel (deblurring)
+             \nabla: forward differences, Neumann or Periodic boundary
+
+The normal equations (K^T K + alpha^2 \nabla^T \nabla) u = K^T g are diagonal
+in the DCT-II basis for Neumann boundaries (with K using reflective
+boundaries) and in the Fourier basis for periodic ones, so
+
+             u = T^{-1} [ s * T(g) / (|s|^2 + alpha^2 lambda) ]
+
+with T = dctn/rfftn, s the eigenvalues of K and lambda those of \nabla^T \nabla.
+This is the exact solution in O(N log N); method='cgls' runs the block CGLS of
+Denoising/2D/Regularised_CGLS_Denoising.py instead, for comparison.
+"""
+
+from __future__ import print_function, division
+import numpy
+from scipy import fft, ndimage
+
+from ccpi.optimisation.operators import LinearOperator
+
+BOUNDARIES = ['Neumann', 'Periodic']
+
+
+def _spatial_axes(data):
+    '''Axes of a DataContainer or numpy array excluding the channel axis'''
+    if hasattr(data, 'dimension_labels'):
+        labels = data.dimension_labels
+        return tuple(k for k in range(len(labels)) if labels[k] != 'channel')
+    return tuple(range(numpy.ndim(data)))
+
+
+def _forward(arr, axes, bnd_cond):
+    if bnd_cond == 'Neumann':
+        return fft.dctn(arr, type=2, axes=axes, norm='ortho')
+    return fft.rfftn(arr, axes=axes)
+
+
+def _inverse(arr, shape, axes, bnd_cond):
+    if bnd_cond == 'Neumann':
+        return fft.idctn(arr, type=2, axes=axes, norm='ortho')
+    return fft.irfftn(arr, s=[shape[a] for a in axes], axes=axes)
+
+
+def _transform_shape(shape, axes, bnd_cond):
+    shape = list(shape)
+    if bnd_cond == 'Periodic':
+        shape[axes[-1]] = shape[axes[-1]] // 2 + 1
+    return tuple(shape)
+
+
+def laplacian_eigenvalues(shape, axes=None, bnd_cond='Neumann'):
+    '''Eigenvalues of \\nabla^T \\nabla in the basis of the DCT-II (Neumann) or rFFT (Periodic)'''
+    if bnd_cond not in BOUNDARIES:
+        raise ValueError('Unsupported boundary condition ', bnd_cond)
+    if axes is None:
+        axes = tuple(range(len(shape)))
+    tshape = _transform_shape(shape, axes, bnd_cond)
+    lam = numpy.zeros(tshape, dtype=numpy.float64)
+    for axis in axes:
+        n = shape[axis]
+        k = numpy.arange(tshape[axis])
+        if bnd_cond == 'Neumann':
+            ev = 2 - 2 * numpy.cos(numpy.pi * k / n)
+        else:
+            ev = 2 - 2 * numpy.cos(2 * numpy.pi * k / n)
+        bshape = [1] * len(shape)
+        bshape[axis] = tshape[axis]
+        lam = lam + ev.reshape(bshape)
+    return lam
+
+
+def _blur_mode(bnd_cond):
+    # half sample symmetric extension is the one diagonalised by the DCT-II
+    return 'reflect' if bnd_cond == 'Neumann' else 'wrap'
+
+
+def _check_kernel(kernel, bnd_cond):
+    kernel = numpy.asarray(kernel, dtype=numpy.float64)
+    if any(n % 2 == 0 for n in kernel.shape):
+        raise ValueError('The kernel needs a centre voxel, got the even shape {}'.format(kernel.shape))
+    if bnd_cond == 'Neumann' and not numpy.allclose(kernel, kernel[tuple(slice(None, None, -1) for _ in kernel.shape)]):
+        raise ValueError('The DCT solver needs a kernel symmetric about its centre')
+    return kernel
+
+
+def blur_eigenvalues(kernel, shape, axes=None, bnd_cond='Neumann'):
+    '''Eigenvalues of the convolution with kernel in the basis of the DCT-II (Neumann) or rFFT (Periodic)'''
+    if axes is None:
+        axes = tuple(range(len(shape)))
+    kernel = _check_kernel(kernel, bnd_cond)
+    sub = tuple(shape[a] for a in axes)
+    e1 = numpy.zeros(sub)
+    e1[(0,) * len(sub)] = 1
+    col = ndimage.convolve(e1, kernel, mode=_blur_mode(bnd_cond))
+    if bnd_cond == 'Neumann':
+        # K = C^T diag(s) C, the first column of K gives s
+        s = fft.dctn(col, type=2, norm='ortho') / fft.dctn(e1, type=2, norm='ortho')
+    else:
+        s = fft.rfftn(col)
+    bshape = [shape[a] if a in axes else 1 for a in range(len(shape))]
+    return s.reshape(_transform_shape(bshape, axes, bnd_cond))
+
+
+def tikhonov_solve(g, alpha, kernel=None, axes=None, bnd_cond='Neumann'):
+    '''Exact minimiser of ||K u - g||^2 + alpha^2 ||\\nabla u||^2 for a numpy array g'''
+    g = numpy.asarray(g)
+    if axes is None:
+        axes = tuple(range(g.ndim))
+    lam = laplacian_eigenvalues(g.shape, axes, bnd_cond)
+    G = _forward(g.astype(numpy.float64), axes, bnd_cond)
+    if kernel is None:
+        G /= 1 + alpha ** 2 * lam
+    else:
+        s = blur_eigenvalues(kernel, g.shape, axes, bnd_cond)
+        G *= numpy.conj(s)
+        G /= numpy.abs(s) ** 2 + alpha ** 2 * lam
+    return _inverse(G, g.shape, axes, bnd_cond).astype(numpy.float32)
+
+
+class BlurOperator(LinearOperator):
+
+    '''Convolution with a kernel over the spatial axes of an ImageGeometry
+
+    :param ig: ImageGeometry
+    :param kernel: numpy array, one axis per spatial axis of ig
+    :param bnd_cond: 'Neumann' (reflective extension) or 'Periodic'
+    '''
+
+    def __init__(self, ig, kernel, bnd_cond='Neumann'):
+        super(BlurOperator, self).__init__()
+        self.ig = ig
+        self.bnd_cond = bnd_cond
+        self.kernel = _check_kernel(kernel, bnd_cond).astype(numpy.float32)
+        axes = _spatial_axes(ig.allocate())
+        # broadcast the kernel over the channel axis
+        shape = [self.kernel.shape[axes.index(a)] if a in axes else 1 for a in range(len(ig.shape))]
+        self.kernel = self.kernel.reshape(shape)
+
+    def direct(self, x, out=None):
+        res = ndimage.convolve(x.as_array(), self.kernel, mode=_blur_mode(self.bnd_cond))
+        if out is None:
+            out = self.ig.allocate()
+            out.fill(res)
+            return out
+        out.fill(res)
+
+    def adjoint(self, x, out=None):
+        res = ndimage.correlate(x.as_array(), self.kernel, mode=_blur_mode(self.bnd_cond))
+        if out is None:
+            out = self.ig.allocate()
+            out.fill(res)
+            return out
+        out.fill(res)
+
+    def domain_geometry(self):
+        return self.ig
+
+    def range_geometry(self):
+        return self.ig
+
+
+def _cgls(operator, data, alpha, bnd_cond, iterations, verbose):
+    from ccpi.framework import BlockDataContainer
+    from ccpi.optimisation.algorithms import CGLS
+    from ccpi.optimisation.operators import BlockOperator, Gradient
+
+    ig = operator.domain_geometry()
+    Grad = Gradient(ig, bnd_cond=bnd_cond)
+    block_op = BlockOperator(operator, alpha * Grad, shape=(2,1))
+    block_data = BlockDataContainer(data, Grad.range_geometry().allocate())
+    cgls = CGLS(x_init=ig.allocate(), operator=block_op, data=block_data)
+    cgls.max_iteration = iterations
+    cgls.update_objective_interval = max(iterations // 10, 1)
+    cgls.run(iterations, verbose=verbose)
+    return cgls.get_output()
+
+
+def tikhonov_denoising(noisy, alpha, bnd_cond='Neumann', method='direct', iterations=200, verbose=False):
+    '''min_u ||u - g||^2 + alpha^2 ||\\nabla u||^2
+
+    :param noisy: ImageData g
+    :param method: 'direct' (DCT/FFT) or 'cgls' (block CGLS)
+    :param iterations: CGLS iterations, ignored by the direct method
+    :returns: ImageData
+    '''
+    if method == 'cgls':
+        from ccpi.optimisation.operators import Identity
+        return _cgls(Identity(noisy.geometry), noisy, alpha, bnd_cond, iterations, verbose)
+    elif method != 'direct':
+        raise ValueError('Unsupported method ', method)
+    out = noisy.geometry.allocate()
+    out.fill(tikhonov_solve(noisy.as_array(), alpha, axes=_spatial_axes(noisy), bnd_cond=bnd_cond))
+    return out
+
+
+def tikhonov_deblurring(blurred, kernel, alpha, bnd_cond='Neumann', method='direct', iterations=200,
+                        verbose=False):
+    '''min_u ||K u - g||^2 + alpha^2 ||\\nabla u||^2 with K the convolution with kernel
+
+    :param blurred: ImageData g
+    :param kernel: numpy array, symmetric about its centre for Neumann boundaries
+    :param method: 'direct' (DCT/FFT) or 'cgls' (block CGLS with BlurOperator)
+    :param iterations: CGLS iterations, ignored by the direct method
+    :returns: ImageData
+    '''
+    if method == 'cgls':
+        K = BlurOperator(blurred.geometry, kernel, bnd_cond)
+        return _cgls(K, blurred, alpha, bnd_cond, iterations, verbose)
+    elif method != 'direct':
+        raise ValueError('Unsupported method ', method)
+    out = blurred.geometry.allocate()
+    out.fill(tikhonov_solve(blurred.as_array(), alpha, kernel, axes=_spatial_axes(blurred),
+                            bnd_cond=bnd_cond))
+    return out
+
+
+def gaussian_kernel(sigma, ndim=2, truncate=3.):
+    '''Normalised, centred Gaussian kernel'''
+    r = int(numpy.ceil(truncate * sigma))
+    x = numpy.arange(-r, r + 1)
+    k1 = numpy.exp(-0.5 * (x / sigma) ** 2)
+    k = k1
+    for _ in range(ndim - 1):
+        k = numpy.multiply.outer(k, k1)
+    return k / k.sum()
+
+
+if __name__ == '__main__':
+
+    from ccpi.framework import TestData, ImageData
+    import matplotlib.pyplot as plt
+    import os
+    import sys
+    import timeit
+
+    loader = TestData(data_dir=os.path.join(sys.prefix, 'share','ccpi'))
+    data = loader.load(TestData.SHAPES)
+    ig = data.geometry
+
+    noisy_data = ImageData(TestData.random_noise(data.as_array(), mode = 'gaussian', seed = 1), geometry=ig)
+    alpha = 2
+
+    results = {}
+    for method in ['direct', 'cgls']:
+        t0 = timeit.default_timer()
+        results[method] = tikhonov_denoising(noisy_data, alpha, method=method, iterations=200)
+        print('Tikhonov denoising ({}): {:.3f} s'.format(method, timeit.default_timer() - t0))
+    diff = (results['direct'] - results['cgls']).abs().as_array()
+    print('max |direct - cgls| = {:.2e}'.format(diff.max()))
+
+    kernel = gaussian_kernel(2.)
+    K = BlurOperator(ig, kernel)
+    blurred = K.direct(data)
+    blurred.fill(TestData.random_noise(blurred.as_array(), mode = 'gaussian', var = 1e-4, seed = 1))
+    deblurred = tikhonov_deblurring(blurred, kernel, alpha=0.05)
+
+    plt.figure(figsize=(20,5))
+    for i, (title, img) in enumerate([('Noisy', noisy_data), ('Tikhonov (DCT)', results['direct']),
+                                      ('Blurred', blurred), ('Deblurred (DCT)', deblurred)]):
+        plt.subplot(1,4,i+1)
+        plt.imshow(img.as_array())
+        plt.title(title)
+    plt.show()
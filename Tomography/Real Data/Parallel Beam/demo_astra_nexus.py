@@ -40,7 +40,7 @@ center_of_rotation = cor.get_output()
 # From computed center, determine amount of zero-padding to apply, apply
 # and update geometry to wider detector.
 cor_pad = int(2*(center_of_rotation - data.shape[2]/2))
-data_pad = numpy.zeros((data.shape[0],data.shape[1],data.shape[2]+cor_pad))
+data_pad = numpy.zeros((data.shape[0],data.shape[1],data.shape[2]+cor_pad), dtype=numpy.float32)
 data_pad[:,:,:-cor_pad] = data.as_array()
 data.geometry.pixel_num_h = data.geometry.pixel_num_h + cor_pad
 data.array = data_pad
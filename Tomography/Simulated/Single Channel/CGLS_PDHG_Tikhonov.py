@@ -67,7 +67,7 @@ else:
 Aop = AstraProjectorSimple(ig, ag, dev)    
 sin = Aop.direct(data)
 
-noisy_data = AcquisitionData( sin.as_array() + np.random.normal(0,3,ig.shape))
+noisy_data = AcquisitionData( sin.as_array() + np.random.normal(0,3,ig.shape).astype(np.float32))
 
 # Setup and run the CGLS algorithm  
 alpha = 50
@@ -74,7 +74,7 @@ Aop = AstraProjectorSimple(ig, ag, dev)
 sin = Aop.direct(data)
 
 np.random.seed(10)
-noisy_data = AcquisitionData( sin.as_array() + np.random.normal(0,1,ag.shape))
+noisy_data = AcquisitionData( sin.as_array() + np.random.normal(0,1,ag.shape).astype(np.float32))
 
 # Show Ground Truth and Noisy Data
 plt.figure(figsize=(10,10))
@@ -83,7 +83,7 @@ else:
 Aop = AstraProjectorSimple(ig, ag, dev)
 sin = Aop.direct(data)
 eta = 0
-noisy_data = AcquisitionData(sin.as_array() + np.random.normal(0,1,ag.shape))
+noisy_data = AcquisitionData(sin.as_array() + np.random.normal(0,1,ag.shape).astype(np.float32))
 back_proj = Aop.adjoint(noisy_data)
 
 # Define Least Squares
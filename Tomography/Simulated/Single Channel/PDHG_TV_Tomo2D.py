@@ -91,9 +91,9 @@ noise = noises[which_noise]
 if noise == 'poisson':
     scale = 5
     eta = 0
-    noisy_data = AcquisitionData(np.random.poisson( scale * (eta + sin.as_array()))/scale, ag)
+    noisy_data = AcquisitionData(np.random.poisson( scale * (eta + sin.as_array())).astype(np.float32)/scale, ag)
 elif noise == 'gaussian':
-    n1 = np.random.normal(0, 1, size = ag.shape)
+    n1 = np.random.normal(0, 1, size = ag.shape).astype(np.float32)
     noisy_data = AcquisitionData(n1 + sin.as_array(), ag)
     
 else: